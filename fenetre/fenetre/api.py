@@ -4,7 +4,7 @@ from .auth import admin_required, eula_required
 from . import auth, lockbox
 from quart_auth import login_required, current_user, logout_user
 import quart_auth
-from .db import User, SignupProvider, Course, Form, gridfs, FormField, FormFillingTest, TestFillFormResult
+from .db import User, SignupProvider, Course, Form, gridfs, bump_config_version, FormField, FormFillingTest, TestFillFormResult
 from umongo.marshmallow_bonus import ObjectId as ObjectIdField
 from gridfs.errors import NoFile
 from .formutil import form_geometry_compatible, create_default_fields_from_geometry
@@ -531,6 +531,7 @@ async def adm_course_update(idx):
         obj.configuration_locked = payload["configuration_locked"]
 
     await obj.commit()
+    await bump_config_version()
     return '', 204
 
 class UserFormDump(Form.schema.as_marshmallow_schema()):
@@ -777,6 +778,7 @@ async def configure_course_user(idx):
 
     obj.has_attendance_form = payload["has_form_url"]
     await obj.commit()
+    await bump_config_version()
 
     return '', 204
 
@@ -983,6 +985,7 @@ async def update_form_thumb(idx):
 
     form.representative_thumbnail = geometry.screenshot_id
     await form.commit()
+    await bump_config_version()
 
     return {
         "form": condensed_form_dump.dump(form),
@@ -1023,6 +1026,7 @@ async def delete_form_specific(idx):
                 pass
 
     await obj.remove()
+    await bump_config_version()
 
     return '', 204
 
@@ -1071,6 +1075,7 @@ async def update_patch_form(idx):
         form.is_default = payload["is_default"]
 
     await form.commit()
+    await bump_config_version()
     return '', 204
 
 
@@ -1081,6 +1086,31 @@ async def update_all_user_courses():
 
     return '', 204
 
+@blueprint.route("/admin/update_user_courses")
+@admin_required
+async def get_update_all_user_courses_progress():
+    progress = await lockbox.get_update_all_user_courses_progress()
+    if progress is None:
+        return {"error": "no update in progress"}, 404
+
+    for i in ("time_started", "time_finished", "eta"):
+        if progress.get(i) is not None:
+            progress[i] += "Z"
+
+    return progress
+
+@blueprint.route("/admin/fill_stats")
+@admin_required
+async def get_fill_stats():
+    try:
+        days = int(request.args.get("days", 30))
+    except ValueError:
+        return {"error": "invalid days"}, 400
+
+    return {
+        "stats": await lockbox.get_fill_stats(days, request.args.get("by", "course"))
+    }
+
 @blueprint.route("/admin/debug/tasks")
 @admin_required
 async def get_active_tasks():
@@ -1,4 +1,4 @@
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
 from quart import Quart, current_app
 from umongo.frameworks import MotorAsyncIOInstance
 from marshmallow import fields as ma_fields, missing as missing_
@@ -8,6 +8,8 @@ import asyncio
 import enum
 import bson
 import itertools
+from pymongo import ASCENDING, IndexModel
+from . import mongo
 
 def private_db() -> AsyncIOMotorDatabase:
     return current_app.priv_db
@@ -18,6 +20,17 @@ def shared_db() -> AsyncIOMotorDatabase:
 def gridfs() -> AsyncIOMotorGridFSBucket:
     return current_app.gridfs_shared
 
+# The version counter of courses and forms read by lockbox
+# Same as VERSION_COLLECTION and VERSION_ID in lockbox/configcache.py; keep the two in sync
+CONFIG_VERSION_COLLECTION = "config_versions"
+CONFIG_VERSION_ID = "course_config"
+
+async def bump_config_version():
+    """
+    Tell lockbox to drop its cached courses and forms; call after changing any of them (see lockbox/configcache.py).
+    """
+    await shared_db()[CONFIG_VERSION_COLLECTION].update_one({"_id": CONFIG_VERSION_ID}, {"$inc": {"version": 1}}, upsert=True)
+
 _shared_instance = MotorAsyncIOInstance()
 _private_instance = MotorAsyncIOInstance()
 
@@ -43,8 +56,9 @@ class BinaryField(fields.BaseField, ma_fields.Field):
 
 def init_db_in_cli_context():
     # connect to the database
-    client = AsyncIOMotorClient("db", 27017)
-    priv_db = client['fenetre']
+    client = mongo.create_client()
+    # only users and signup providers live here, so every write gets the credentials write concern
+    priv_db = client.get_database('fenetre', write_concern=mongo.CREDENTIALS_WRITE_CONCERN)
     shared_db = client['shared']
     _private_instance.set_db(priv_db)
     _shared_instance.set_db(shared_db)
@@ -52,8 +66,8 @@ def init_db_in_cli_context():
 def init_app(app: Quart):
     @app.before_serving
     async def load_database():
-        current_app.client = AsyncIOMotorClient("db", 27017)
-        current_app.priv_db = current_app.client['fenetre']
+        current_app.client = mongo.create_client()
+        current_app.priv_db = current_app.client.get_database('fenetre', write_concern=mongo.CREDENTIALS_WRITE_CONCERN)
         current_app.shared_db = current_app.client['shared']
         current_app.gridfs_shared = AsyncIOMotorGridFSBucket(current_app.shared_db)
 
@@ -65,6 +79,7 @@ def init_app(app: Quart):
 
         await Course.ensure_indexes()
         await Form.ensure_indexes()
+        await FormFillingTest.ensure_indexes()
 
 @_private_instance.register
 class User(Document):
@@ -137,6 +152,10 @@ class Form(Document):
     # TODO: use io_validate to check that
     is_default = fields.BoolField(default=False)
 
+    class Meta:
+        # Finding forms sharing a thumbnail (before deleting it)
+        indexes = ["representative_thumbnail"]
+
 @_shared_instance.register
 class Course(Document):
     # Course code including cohort str
@@ -162,6 +181,13 @@ class Course(Document):
     # Teacher name
     teacher_name = fields.StrField(default="")
 
+    class Meta:
+        indexes = [
+            # Courses using a form or form config
+            "form_url",
+            "form_config",
+        ]
+
 # test result structures
 @_shared_instance.register
 class TestFillFormResult(EmbeddedDocument): # pylint: disable=abstract-method
@@ -207,3 +233,13 @@ class FormFillingTest(Document):
     # results
     errors = fields.ListField(fields.EmbeddedField(TestFillLockboxFailure), default=[])
     fill_result = fields.EmbeddedField(TestFillFormResult, default=None, allow_none=True)
+
+    # Removed by MongoDB at this time, set by lockbox when the test is started
+    expires_at = fields.DateTimeField(required=False, allow_none=True, default=None)
+
+    class Meta:
+        indexes = [
+            # A user's tests of a course config, newest first
+            ["course_config", "requested_by", "-time_executed"],
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        ]
@@ -151,22 +151,30 @@ lockbox_failure_schema = LockboxFailureSchema()
 
 async def get_errors_for(user: User) -> typing.AsyncIterable[LockboxFailure]:
     """
-    Retrieve all lockbox errors for a specific user.
+    Retrieve all lockbox errors for a specific user, newest first.
 
+    Errors are fetched a page at a time as they're iterated over.
     No results if the user doesn't have a lockbox identity
     """
 
     if user.lockbox_token is None:
         return
 
-    async with _lockbox_sess().get("http://lockbox/user", headers=_headers_for_user(user)) as resp:
-        if not resp.ok:
-            raise LockboxError("failed to get: " + resp.reason, resp.status)
+    params = {}
+    while True:
+        async with _lockbox_sess().get("http://lockbox/user/errors", headers=_headers_for_user(user), params=params) as resp:
+            if not resp.ok:
+                raise LockboxError("failed to get: " + resp.reason, resp.status)
+
+            page = await resp.json()
+            data = lockbox_failure_schema.load(page["errors"], many=True)
 
-        data = lockbox_failure_schema.load((await resp.json())["errors"], many=True)
+        for failure in data:
+            yield LockboxFailure(failure["_id"], failure["kind"], failure["message"], failure["time_logged"])
 
-    for failure in data:
-        yield LockboxFailure(failure["_id"], failure["kind"], failure["message"], failure["time_logged"])
+        if page["next"] is None:
+            return
+        params = {"before": page["next"]}
 
 async def clear_error(for_: User, error_id: str):
     """
@@ -309,6 +317,38 @@ async def update_all_user_courses():
         if not resp.ok:
             raise LockboxError("failed to update all courses", resp.status)
         
+async def get_update_all_user_courses_progress():
+    """
+    Calls GET /update_all_courses
+
+    Returns None if all courses were never updated.
+    """
+
+    async with _lockbox_sess().get("http://lockbox/update_all_courses") as resp:
+        payload = await resp.json()
+
+        if resp.status == 404:
+            return None
+        if not resp.ok:
+            raise LockboxError(payload.get("error", ""), resp.status)
+
+        return payload
+
+async def get_fill_stats(days: int = 30, by: str = "course"):
+    """
+    Calls GET /fill_stats
+
+    Returns the daily counts of each fill result type, by course or form.
+    """
+
+    async with _lockbox_sess().get("http://lockbox/fill_stats", params={"days": days, "by": by}) as resp:
+        payload = await resp.json()
+
+        if not resp.ok:
+            raise LockboxError(payload.get("error", ""), resp.status)
+
+        return payload["stats"]
+
 async def get_debug_tasks():
     """
     Calls /update_all_courses
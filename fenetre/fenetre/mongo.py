@@ -0,0 +1,88 @@
+"""
+MongoDB connection settings.
+
+Lockbox and fenetre read the same NFFU_MONGO_* environment variables, so both services can be pointed at the same
+server or replica set and tuned in one place. See the lockbox package docstring for the variables.
+
+This is a copy of lockbox/mongo.py (the services are packaged separately); keep the two in sync.
+"""
+
+import os
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.write_concern import WriteConcern
+
+
+# Connection string; overrides the host and port given to create_client()
+URI = None
+# The client options below are only passed to the client if they're set, since they'd override the same options in
+# URI; None (or empty) leaves them to the URI or the driver's defaults (given in brackets)
+# Max and min number of connections kept in the pool for each server (100 and 0)
+MAX_POOL_SIZE = None
+MIN_POOL_SIZE = None
+# Timeouts in seconds for server selection, connecting and responses (30, 20 and no timeout)
+SERVER_SELECTION_TIMEOUT = None
+CONNECT_TIMEOUT = None
+SOCKET_TIMEOUT = None
+# Wire protocol compressors to offer, in order of preference, e.g. ["zstd", "snappy", "zlib"] (none)
+COMPRESSORS = []
+# Write concern of ordinary writes (the server's default)
+WRITE_CONCERN = WriteConcern()
+# Write concerns of writes of user credentials, and writes of stats that can be lost (set where they're used)
+CREDENTIALS_WRITE_CONCERN = WriteConcern(w="majority")
+METRICS_WRITE_CONCERN = WriteConcern(w=0)
+
+
+def _parse_write_concern(value: str) -> WriteConcern:
+    """
+    Parse a write concern, either "majority" or a number of nodes.
+    """
+    value = value.strip()
+    return WriteConcern(w=value if value == "majority" else int(value))
+
+
+if os.environ.get("NFFU_MONGO_URI"):
+    URI = os.environ["NFFU_MONGO_URI"]
+if os.environ.get("NFFU_MONGO_MAX_POOL_SIZE"):
+    MAX_POOL_SIZE = max(int(os.environ["NFFU_MONGO_MAX_POOL_SIZE"]), 1)
+if os.environ.get("NFFU_MONGO_MIN_POOL_SIZE"):
+    MIN_POOL_SIZE = max(int(os.environ["NFFU_MONGO_MIN_POOL_SIZE"]), 0)
+if os.environ.get("NFFU_MONGO_SERVER_SELECTION_TIMEOUT"):
+    SERVER_SELECTION_TIMEOUT = float(os.environ["NFFU_MONGO_SERVER_SELECTION_TIMEOUT"])
+if os.environ.get("NFFU_MONGO_CONNECT_TIMEOUT"):
+    CONNECT_TIMEOUT = float(os.environ["NFFU_MONGO_CONNECT_TIMEOUT"])
+if os.environ.get("NFFU_MONGO_SOCKET_TIMEOUT"):
+    SOCKET_TIMEOUT = float(os.environ["NFFU_MONGO_SOCKET_TIMEOUT"])
+if os.environ.get("NFFU_MONGO_COMPRESSORS"):
+    COMPRESSORS = [c.strip() for c in os.environ["NFFU_MONGO_COMPRESSORS"].split(",") if c.strip()]
+if os.environ.get("NFFU_MONGO_WRITE_CONCERN"):
+    WRITE_CONCERN = _parse_write_concern(os.environ["NFFU_MONGO_WRITE_CONCERN"])
+if os.environ.get("NFFU_MONGO_CREDENTIALS_WRITE_CONCERN"):
+    CREDENTIALS_WRITE_CONCERN = _parse_write_concern(os.environ["NFFU_MONGO_CREDENTIALS_WRITE_CONCERN"])
+if os.environ.get("NFFU_MONGO_METRICS_WRITE_CONCERN"):
+    METRICS_WRITE_CONCERN = _parse_write_concern(os.environ["NFFU_MONGO_METRICS_WRITE_CONCERN"])
+
+
+def create_client(host: str = "db", port: int = 27017) -> AsyncIOMotorClient:
+    """
+    Create a client with the configured pool, timeouts, compression and default write concern.
+
+    host and port are only used if NFFU_MONGO_URI is not set. Options that are set with both an NFFU_MONGO_*
+    variable and in NFFU_MONGO_URI use the variable.
+    """
+    kwargs = {}
+    if MAX_POOL_SIZE is not None:
+        kwargs["maxPoolSize"] = MAX_POOL_SIZE
+    if MIN_POOL_SIZE is not None:
+        kwargs["minPoolSize"] = MIN_POOL_SIZE
+    if SERVER_SELECTION_TIMEOUT is not None:
+        kwargs["serverSelectionTimeoutMS"] = int(SERVER_SELECTION_TIMEOUT * 1000)
+    if CONNECT_TIMEOUT is not None:
+        kwargs["connectTimeoutMS"] = int(CONNECT_TIMEOUT * 1000)
+    if SOCKET_TIMEOUT is not None:
+        kwargs["socketTimeoutMS"] = int(SOCKET_TIMEOUT * 1000)
+    if COMPRESSORS:
+        kwargs["compressors"] = ",".join(COMPRESSORS)
+    kwargs.update(WRITE_CONCERN.document)
+    if URI is not None:
+        return AsyncIOMotorClient(URI, **kwargs)
+    return AsyncIOMotorClient(host, port, **kwargs)
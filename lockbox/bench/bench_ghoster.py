@@ -0,0 +1,244 @@
+"""
+Benchmarks ghoster against the fake Google Forms server (see fakeforms.py).
+
+For every fixture form, runs get_form_geometry() and fill_form() in headless Firefox and reports
+the latency of each, the peak memory (RSS) and CPU time of the browser processes, and whether the
+result matched what was expected (including the submission recorded by the fake server).
+
+Needs lockbox to be importable and Firefox/geckodriver installed where ghoster expects them
+(e.g. the lockbox image, with this directory mounted into it). From the lockbox directory:
+    python bench/bench_ghoster.py [--runs 3] [--forms text,dropdown] [--auth] [--dry-run] [--no-screenshots] [--latency SECONDS]
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import statistics
+import threading
+import time
+import typing
+
+from fakeforms import FakeFormsServer
+from lockbox import ghoster
+from lockbox.documents import FormFieldType
+
+
+CREDENTIALS = ghoster.GhosterCredentials("first.last1@tdsb.ca", "123456789", "hunter2")
+
+TODAY = datetime.date.today()
+
+# Components to fill (index, title, kind, value, critical) for each fixture form,
+# and the fields the fake server should then receive
+BENCH_FORMS = {
+    "text": ([(0, "Student number", FormFieldType.TEXT, "123456789", True)],
+             {"entry.101": ["123456789"]}),
+    "long-text": ([(0, "What did you work on", FormFieldType.LONG_TEXT, "Nothing much", True)],
+                  {"entry.102": ["Nothing much"]}),
+    "date": ([(0, "date", FormFieldType.DATE, TODAY, True)],
+             {"entry.103_month": [str(TODAY.month)], "entry.103_day": [str(TODAY.day)], "entry.103_year": [str(TODAY.year)]}),
+    "multiple-choice": ([(0, "Attendance", FormFieldType.MULTIPLE_CHOICE, 0, True)],
+                        {"entry.104": ["Present"]}),
+    "checkbox": ([(0, "I confirm", FormFieldType.CHECKBOX, 1, True)],
+                 {"entry.105": ["I have done the work"]}),
+    "dropdown": ([(0, "Period", FormFieldType.DROPDOWN, 2, True)],
+                 {"entry.106": ["Period 3"]}),
+    "attendance": ([
+        (1, "Student number", FormFieldType.TEXT, "123456789", True),
+        (2, "Full name", FormFieldType.TEXT, "First Last", True),
+        (3, "date", FormFieldType.DATE, TODAY, True),
+        (4, "Period", FormFieldType.DROPDOWN, 0, True),
+        (5, "Attendance", FormFieldType.MULTIPLE_CHOICE, 0, True),
+        (6, "I confirm", FormFieldType.CHECKBOX, 0, True),
+        (7, "Comments", FormFieldType.LONG_TEXT, "n/a", False),
+    ], {"entry.201": ["123456789"], "entry.202": ["First Last"], "entry.204": ["Period 1"], "entry.205": ["Present"],
+        "entry.206": ["I am present"], "entry.207": ["n/a"]}),
+    # These are expected to fail
+    "multi-page": ([(0, "Student number", FormFieldType.TEXT, "123456789", True)], ghoster.GhosterInvalidForm),
+    "alreadyresponded": ([(0, "Student number", FormFieldType.TEXT, "123456789", True)], ghoster.GhosterInvalidForm),
+    "formrestricted": ([(0, "Student number", FormFieldType.TEXT, "123456789", True)], ghoster.GhosterAuthFailed),
+}
+
+
+class BrowserSampler(threading.Thread):
+    """
+    Samples the memory and CPU usage of all descendant processes of this process (i.e. geckodriver and Firefox).
+
+    Uses /proc, so this only works on Linux; on other platforms nothing is recorded.
+    """
+
+    def __init__(self, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_rss = 0
+        # Highest CPU time seen for each process, since processes are gone by the time sampling stops
+        self._cpu = {} # type: typing.Dict[int, float]
+        self._stop_event = threading.Event()
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    @property
+    def cpu_time(self) -> float:
+        return sum(self._cpu.values())
+
+    def _descendants(self) -> typing.List[int]:
+        parents = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # The command name can contain spaces, so split after it
+                    fields = f.read().rsplit(")", 1)[1].split()
+                parents[int(entry)] = int(fields[1])
+            except (OSError, IndexError, ValueError):
+                continue
+        found = []
+        frontier = [os.getpid()]
+        while frontier:
+            pid = frontier.pop()
+            children = [child for child, parent in parents.items() if parent == pid]
+            found.extend(children)
+            frontier.extend(children)
+        return found
+
+    def _sample(self):
+        rss = 0
+        for pid in self._descendants():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                # utime and stime are fields 14 and 15, rss is field 24 (1-indexed, fields here start at 3)
+                self._cpu[pid] = max(self._cpu.get(pid, 0), (int(fields[11]) + int(fields[12])) / self._ticks)
+                rss += int(fields[21]) * self._page_size
+            except (OSError, IndexError, ValueError):
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self):
+        if not os.path.isdir("/proc"):
+            return
+        while not self._stop_event.is_set():
+            self._sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class RunResult(typing.NamedTuple):
+    operation: str
+    form: str
+    ok: bool
+    latency: float
+    peak_rss: int
+    cpu_time: float
+    message: str
+
+
+async def _measure(operation: str, form: str, func: typing.Callable[[], typing.Any],
+                   check: typing.Callable[[typing.Any, typing.Optional[Exception]], typing.Tuple[bool, str]]) -> RunResult:
+    """
+    Run a blocking ghoster function in an executor (like lockbox does) while sampling the browser.
+    """
+    sampler = BrowserSampler()
+    sampler.start()
+    start = time.perf_counter()
+    result, error = None, None
+    try:
+        result = await asyncio.get_event_loop().run_in_executor(None, func)
+    except Exception as e: # pylint: disable=broad-except
+        error = e
+    latency = time.perf_counter() - start
+    sampler.stop()
+    ok, message = check(result, error)
+    return RunResult(operation, form, ok, latency, sampler.peak_rss, sampler.cpu_time, message)
+
+
+async def bench_form(server: FakeFormsServer, name: str, auth: bool, dry_run: bool,
+                     screenshots: bool = True) -> typing.List[RunResult]:
+    """
+    Benchmark getting the geometry of and filling in one form.
+    """
+    components, expected = BENCH_FORMS[name]
+    url = server.form_url(name, auth=auth)
+    expect_error = isinstance(expected, type) and issubclass(expected, Exception)
+
+    def check_geometry(result, error):
+        if expect_error:
+            return isinstance(error, expected), repr(error)
+        if error is not None:
+            return False, repr(error)
+        needs_signin, fields, _ = result
+        kinds = {index: kind for index, _, kind in fields}
+        for index, _, kind, _, _ in components:
+            if kinds.get(index) != kind:
+                return False, f"field {index} detected as {kinds.get(index)}, expected {kind}"
+        if needs_signin != auth:
+            return False, f"needs_signin was {needs_signin}"
+        return True, f"{len(fields)} fields"
+
+    def check_fill(result, error):
+        if expect_error:
+            return isinstance(error, expected), repr(error)
+        if error is not None:
+            return False, repr(error)
+        warnings = result[2]
+        if dry_run:
+            return True, f"{len(warnings)} warnings"
+        if not server.submissions or server.submissions[-1]["form"] != name:
+            return False, "no submission recorded"
+        fields = server.submissions[-1]["fields"]
+        for key, values in expected.items():
+            if fields.get(key) != values:
+                return False, f"submitted {key}={fields.get(key)}, expected {values}"
+        return True, f"{len(warnings)} warnings"
+
+    return [
+        await _measure("geometry", name, lambda: ghoster.get_form_geometry(url, CREDENTIALS), check_geometry),
+        await _measure("fill", name, lambda: ghoster.fill_form(url, CREDENTIALS, components, dry_run=dry_run,
+                                                                 always_screenshot=screenshots), check_fill),
+    ]
+
+
+def report(results: typing.List[RunResult]):
+    """
+    Print a summary table of the results.
+    """
+    print(f"{'operation':<10} {'form':<18} {'ok':>5} {'median s':>9} {'max s':>7} {'peak MiB':>9} {'cpu s':>7}  last message")
+    groups = {} # type: typing.Dict[typing.Tuple[str, str], typing.List[RunResult]]
+    for result in results:
+        groups.setdefault((result.operation, result.form), []).append(result)
+    for (operation, form), runs in groups.items():
+        latencies = [r.latency for r in runs]
+        print(f"{operation:<10} {form:<18} {sum(r.ok for r in runs):>2}/{len(runs):<2} {statistics.median(latencies):>9.2f} "
+              f"{max(latencies):>7.2f} {max(r.peak_rss for r in runs) / 2 ** 20:>9.1f} "
+              f"{statistics.mean(r.cpu_time for r in runs):>7.2f}  {runs[-1].message}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark ghoster against fake Google Forms")
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs per form")
+    parser.add_argument("--forms", default=",".join(BENCH_FORMS), help="Comma separated list of forms to run")
+    parser.add_argument("--auth", action="store_true", help="Go through the fake Google/AW sign in flow")
+    parser.add_argument("--dry-run", action="store_true", help="Don't submit forms")
+    parser.add_argument("--no-screenshots", action="store_true", help="Only take fill screenshots when there are warnings")
+    parser.add_argument("--latency", type=float, default=0, help="Delay in seconds added to every page load")
+    args = parser.parse_args()
+
+    server = FakeFormsServer(latency=args.latency)
+    await server.start()
+    print(f"Fake forms server running at {server.base_url}")
+    results = []
+    try:
+        for _ in range(args.runs):
+            for name in args.forms.split(","):
+                results.extend(await bench_form(server, name.strip(), args.auth, args.dry_run, not args.no_screenshots))
+    finally:
+        await server.stop()
+    report(results)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
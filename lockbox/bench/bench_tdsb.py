@@ -0,0 +1,110 @@
+"""
+Benchmarks getting users' courses from TDSB Connects against the fake TDSB Connects server (see faketdsb.py).
+
+For every synthetic student, runs tdsb.get_async_periods() through lockbox's session cache (like the populate
+courses task does) and reports the throughput, the latency of each user, the errors, the number of requests the
+fake server got, and the state of the circuit breaker at the end. Each round after the first reuses the cached
+sessions, and passes the school calendars in if --calendars is given.
+
+Needs lockbox to be importable (no database or browser needed). From the lockbox directory:
+    python bench/bench_tdsb.py [--users 500] [--concurrency 20] [--rounds 2] [--calendars] [--latency SECONDS]
+                               [--jitter SECONDS] [--error-rate 0.05] [--timeout-rate 0.01]
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import statistics
+import time
+import typing
+
+import tdsbconnects
+from faketdsb import FakeTDSBServer, PASSWORD, generate_students
+from lockbox import tdsb
+
+
+class RoundResult(typing.NamedTuple):
+    elapsed: float
+    latencies: typing.List[float]
+    errors: typing.Counter[str]
+    requests: int
+
+
+async def bench_round(server: FakeTDSBServer, sessions: tdsb.SessionCache, concurrency: int,
+                      calendars: typing.Optional[typing.Dict[int, typing.Tuple[typing.Any, typing.List[str]]]]) -> RoundResult:
+    """
+    Get the courses of every student once.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = collections.Counter() # type: typing.Counter[str]
+
+    async def _run(username: str):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await sessions.run(username, PASSWORD, lambda session: tdsb.get_async_periods(
+                    session, logged_in=True, include_all_slots=True, calendars=calendars))
+                latencies.append(time.perf_counter() - start)
+            except Exception as e: # pylint: disable=broad-except
+                status = getattr(e, "status", None)
+                errors[f"{type(e).__name__}{f' {status}' if status else ''}"] += 1
+
+    requests = sum(server.stats.values())
+    start = time.perf_counter()
+    await asyncio.gather(*(_run(username) for username in server.students))
+    return RoundResult(time.perf_counter() - start, latencies, errors, sum(server.stats.values()) - requests)
+
+
+def report(round_num: int, result: RoundResult, users: int):
+    latencies = sorted(result.latencies) or [0.0]
+    p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+    print(f"round {round_num}: {len(result.latencies)}/{users} ok in {result.elapsed:.2f}s "
+          f"({users / result.elapsed:.1f} users/s), latency median {statistics.median(latencies):.3f}s "
+          f"p95 {p95:.3f}s max {latencies[-1]:.3f}s, {result.requests} requests")
+    for error, count in result.errors.most_common():
+        print(f"    {count} x {error}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark getting courses from a fake TDSB Connects")
+    parser.add_argument("--users", type=int, default=500, help="Number of synthetic students")
+    parser.add_argument("--schools", type=int, default=1, help="Number of schools to spread the students between")
+    parser.add_argument("--concurrency", type=int, default=20, help="Number of users to get courses for at once")
+    parser.add_argument("--rounds", type=int, default=2, help="Number of times to get every user's courses")
+    parser.add_argument("--calendars", action="store_true", help="Share school calendars between users after the first round")
+    parser.add_argument("--latency", type=float, default=0.05, help="Delay in seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0, help="Max random delay in seconds added on top of the latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with a 503")
+    parser.add_argument("--timeout-rate", type=float, default=0, help="Fraction of requests that are never answered")
+    args = parser.parse_args()
+
+    server = FakeTDSBServer(students=generate_students(args.users, args.schools), latency=args.latency, jitter=args.jitter,
+                            error_rate=args.error_rate, timeout_rate=args.timeout_rate)
+    await server.start()
+    tdsbconnects.TDSBConnects.API_URL = server.api_url
+    print(f"Fake TDSB Connects server running at {server.base_url}")
+    sessions = tdsb.SessionCache(max_size=args.users)
+    calendars = None
+    try:
+        for round_num in range(1, args.rounds + 1):
+            result = await bench_round(server, sessions, args.concurrency, calendars)
+            report(round_num, result, args.users)
+            if args.calendars and calendars is None:
+                # What the check day task would have stored (students are spread between schools in order)
+                async def _calendar(session: tdsbconnects.TDSBConnects):
+                    school = (await session.get_user_info()).schools[0]
+                    today = datetime.date.today()
+                    return school.code, (today, await tdsb.get_day_cycle_calendar(school, today))
+                calendars = dict([await sessions.run(username, PASSWORD, _calendar)
+                                  for username in list(server.students)[:args.schools]])
+    finally:
+        await sessions.close()
+        await server.stop()
+    print(f"Circuit breaker: {sessions.breaker.state}")
+    print(f"Server stats: {dict(server.stats)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+"""
+Checks that the hot queries of lockbox and fenetre are covered by the declared indexes.
+
+Creates the indexes declared on lockbox's documents (the documents in the shared database are declared the same way
+in fenetre/db.py) in a pair of empty temporary databases, explains each query in HOT_QUERIES, and fails if any of them
+would do a collection scan. Updates, deletes and counts are explained as finds with the same filter, since they're
+planned the same way. The temporary databases are dropped afterwards.
+
+Needs lockbox to be importable and a MongoDB server. From the lockbox directory:
+    python bench/check_indexes.py [--host localhost] [--port 27017]
+"""
+
+import argparse
+import asyncio
+import datetime
+import secrets
+import sys
+import typing
+
+import bson
+from motor.motor_asyncio import AsyncIOMotorClient
+from umongo.frameworks import MotorAsyncIOInstance
+from lockbox import documents
+from lockbox.documents import TaskType
+
+
+_ID = bson.ObjectId()
+_NOW = datetime.datetime.utcnow()
+_FORM_URL = "https://docs.google.com/forms/d/e/abc/viewform"
+
+# (description, document, filter, sort)
+HOT_QUERIES = [
+    ("scheduler: next task", documents.Task, {"is_running": False}, [("next_run_at", 1)]),
+    ("scheduler: interrupted tasks", documents.Task, {"is_running": True}, None),
+    ("user's fill form task (modify_user, delete_user)", documents.Task, {"kind": TaskType.FILL_FORM.value, "owner": _ID}, None),
+    ("task of a kind (check day, prefetch, update all courses)", documents.Task, {"kind": TaskType.CHECK_DAY.value}, None),
+    ("geometry's revalidate task (get_form_geometry)", documents.Task,
+     {"kind": TaskType.REVALIDATE_FORM_GEOMETRY.value, "argument": str(_ID)}, None),
+    ("today's fill form tasks (check_day update_many)", documents.Task,
+     {"kind": TaskType.FILL_FORM.value, "next_run_at": {"$gte": _NOW, "$lt": _NOW + datetime.timedelta(days=1)}}, None),
+    ("fill form tasks before a time (prefetch fill plans)", documents.Task,
+     {"kind": TaskType.FILL_FORM.value, "next_run_at": {"$lt": _NOW}}, None),
+    ("user by token", documents.User, {"token": "0" * 64}, None),
+    ("user by login", documents.User, {"login": "123456789"}, None),
+    ("user's errors, newest first (GET /user/errors)", documents.UserError,
+     {"owner": _ID, "$or": [{"time_logged": {"$lt": _NOW}}, {"time_logged": _NOW, "_id": {"$lt": _ID}}]},
+     [("time_logged", -1), ("_id", -1)]),
+    ("user's fill plan", documents.FillPlan, {"owner": _ID}, None),
+    ("user's fill history bucket (add_fill_history)", documents.FillHistory, {"owner": _ID, "month": _NOW}, None),
+    ("fill history buckets since a month (fill stats)", documents.FillHistory, {"month": {"$gte": _NOW}}, None),
+    ("cached form geometry", documents.CachedFormGeometry, {"url": _FORM_URL}, None),
+    ("course by code", documents.Course, {"course_code": "ENG3U1-01"}, None),
+    ("course by code ($in, populate_user_courses)", documents.Course, {"course_code": {"$in": ["ENG3U1-01", "MCR3U1-02"]}}, None),
+    ("courses with a form url (fenetre config options)", documents.Course, {"form_url": _FORM_URL}, None),
+    ("courses using a form config (fenetre form used_by)", documents.Course, {"form_config": _ID}, None),
+    ("user's tests of a course config (fenetre)", documents.FormFillingTest,
+     {"course_config": _ID, "requested_by": _ID}, [("time_executed", -1)]),
+    ("forms sharing a thumbnail (fenetre form delete)", documents.Form, {"representative_thumbnail": _ID}, None),
+    ("school calendar", documents.SchoolCalendar, {"school_code": 1}, None),
+]
+
+PRIVATE_DOCUMENTS = (documents.User, documents.UserError, documents.Task, documents.CachedFormGeometry, documents.FillPlan,
+                     documents.FillHistory, documents.CourseRefresh, documents.ScreenshotSweep)
+SHARED_DOCUMENTS = (documents.Form, documents.Course, documents.FormFillingTest, documents.SchoolCalendar)
+EMBEDDED_DOCUMENTS = (documents.LockboxFailure, documents.FillFormResult, documents.FormGeometryEntry, documents.FormField,
+                      documents.FillHistoryEntry)
+
+
+def _stages(plan: typing.Dict[str, typing.Any]) -> typing.Iterator[str]:
+    """
+    Get the names of all stages in a query plan.
+
+    With the slot-based engine (MongoDB 5.0+), the winning plan has the stages under queryPlan.
+    """
+    if "stage" in plan:
+        yield plan["stage"]
+    if "queryPlan" in plan:
+        yield from _stages(plan["queryPlan"])
+    if "inputStage" in plan:
+        yield from _stages(plan["inputStage"])
+    for stage in plan.get("inputStages", ()):
+        yield from _stages(stage)
+
+
+async def check(client: AsyncIOMotorClient) -> bool:
+    """
+    Create the indexes and explain every hot query. Returns whether all of them use an index.
+    """
+    prefix = f"indexcheck_{secrets.token_hex(4)}"
+    impls = {}
+    try:
+        for suffix, docs in (("lockbox", PRIVATE_DOCUMENTS), ("shared", SHARED_DOCUMENTS)):
+            instance = MotorAsyncIOInstance(client[f"{prefix}_{suffix}"])
+            for doc in EMBEDDED_DOCUMENTS:
+                instance.register(doc)
+            for doc in docs:
+                impls[doc] = instance.register(doc)
+                await impls[doc].ensure_indexes()
+                # Make sure the collection exists even without indexes, otherwise the plan is just EOF
+                if not await impls[doc].collection.index_information():
+                    await impls[doc].collection.database.create_collection(impls[doc].collection.name)
+        ok = True
+        for description, doc, query, sort in HOT_QUERIES:
+            cursor = impls[doc].collection.find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+            stages = list(_stages(plan))
+            # No stages means the plan is in a format this doesn't understand, so it can't be checked
+            failed = not stages or "COLLSCAN" in stages
+            ok = ok and not failed
+            print(f"{'FAIL' if failed else 'ok':<5} {description}: {' <- '.join(stages) or 'no stages found in plan'}")
+        return ok
+    finally:
+        await client.drop_database(f"{prefix}_lockbox")
+        await client.drop_database(f"{prefix}_shared")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Check that lockbox's and fenetre's hot queries use indexes")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=27017)
+    args = parser.parse_args()
+    ok = await check(AsyncIOMotorClient(args.host, args.port))
+    print("All hot queries use indexes" if ok else "Some hot queries do a collection scan")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,214 @@
+"""
+A local stand-in for Google Forms, used for testing and benchmarking ghoster without hitting Google.
+
+Serves the recorded form markup in fixtures/ and fakes the Google -> AW sign in flow.
+Form submissions and logins are recorded and can be inspected through the server object or over HTTP.
+
+URLs served:
+    - /forms/<name>/viewform:
+        The form in fixtures/<name>.html, no sign in required.
+        The special forms "alreadyresponded" and "formrestricted" redirect to their error pages like Google does.
+    - /authforms/<name>/viewform:
+        Same as above, but requires going through the fake Google and AW sign in pages first.
+    - /forms/<name>/formResponse, /authforms/<name>/formResponse:
+        Records a submission and shows the confirmation page.
+    - /_fake/submissions, /_fake/logins:
+        JSON lists of recorded submissions and logins.
+    - /_fake/reset (POST):
+        Clears recorded submissions and logins.
+
+The fake sign in pages are served under /accounts.google.com/ and /aw.tdsb.on.ca/ so that the URL checks
+done by ghoster work unchanged.
+
+Run standalone with:
+    python fakeforms.py [--host 127.0.0.1] [--port 8090] [--bad-password PASSWORD] [--latency SECONDS]
+"""
+
+import argparse
+import asyncio
+import datetime
+import html
+import pathlib
+import urllib.parse
+from aiohttp import web
+
+
+FIXTURES_DIR = pathlib.Path(__file__).parent / "fixtures"
+
+# Forms that redirect to an error page instead of showing the form
+REDIRECT_FORMS = ("alreadyresponded", "formrestricted")
+
+SESSION_COOKIE = "fake_session"
+
+
+class FakeFormsServer:
+    """
+    The fake Google Forms server.
+
+    If bad_password is set, signing into AW with that password will fail.
+    latency is a delay in seconds added to every page load.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, bad_password: str = None, latency: float = 0):
+        self.host = host
+        self.port = port
+        self.bad_password = bad_password
+        self.latency = latency
+        # Recorded submissions and logins, as dicts
+        self.submissions = []
+        self.logins = []
+        self._runner = None
+
+        self.app = web.Application(middlewares=[self._latency_middleware])
+        self.app.router.add_routes([
+            web.get("/forms/{name}/viewform", self._get_form),
+            web.get("/authforms/{name}/viewform", self._get_auth_form),
+            web.get(r"/{prefix:(auth)?forms}/{name}/{error:alreadyresponded|formrestricted}", self._get_form_error),
+            web.post(r"/{prefix:(auth)?forms}/{name}/formResponse", self._post_form_response),
+            web.get("/accounts.google.com/signin/v2/identifier", self._get_google_signin),
+            web.post("/accounts.google.com/signin/v2/identifier", self._post_google_signin),
+            web.get("/aw.tdsb.on.ca/login", self._get_aw_login),
+            web.post("/aw.tdsb.on.ca/login", self._post_aw_login),
+            web.get("/_fake/submissions", self._get_submissions),
+            web.get("/_fake/logins", self._get_logins),
+            web.post("/_fake/reset", self._post_reset),
+            web.static("/_fake/static", FIXTURES_DIR / "static"),
+        ])
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def form_url(self, name: str, auth: bool = False) -> str:
+        """
+        Get the URL of a form by fixture name.
+        """
+        return f"{self.base_url}/{'authforms' if auth else 'forms'}/{name}/viewform"
+
+    async def start(self):
+        """
+        Start serving.
+
+        If the port is 0, a free port is picked and stored in self.port.
+        """
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1] # pylint: disable=protected-access
+
+    async def stop(self):
+        """
+        Stop serving.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset(self):
+        """
+        Clear recorded submissions and logins.
+        """
+        self.submissions.clear()
+        self.logins.clear()
+
+    @web.middleware
+    async def _latency_middleware(self, request: web.Request, handler):
+        if self.latency and not request.path.startswith("/_fake/"):
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    @staticmethod
+    def _render(fixture: str, status: int = 200, **substitutions) -> web.Response:
+        """
+        Render a fixture, replacing %KEY% placeholders with the (escaped) substitutions.
+        """
+        try:
+            page = (FIXTURES_DIR / f"{fixture}.html").read_text()
+        except FileNotFoundError as e:
+            raise web.HTTPNotFound() from e
+        for key, value in substitutions.items():
+            page = page.replace(f"%{key.rstrip('_').upper()}%", html.escape(value or ""))
+        return web.Response(text=page, status=status, content_type="text/html")
+
+    async def _get_form(self, request: web.Request):
+        name = request.match_info["name"]
+        if name in REDIRECT_FORMS:
+            raise web.HTTPFound(name)
+        return self._render(name, email=request.cookies.get(SESSION_COOKIE, ""))
+
+    async def _get_auth_form(self, request: web.Request):
+        if SESSION_COOKIE not in request.cookies:
+            query = urllib.parse.urlencode({"continue": request.path_qs})
+            raise web.HTTPFound(f"/accounts.google.com/signin/v2/identifier?{query}")
+        return await self._get_form(request)
+
+    async def _get_form_error(self, request: web.Request):
+        return self._render(request.match_info["error"], email=request.cookies.get(SESSION_COOKIE, ""))
+
+    async def _post_form_response(self, request: web.Request):
+        name = request.match_info["name"]
+        data = await request.post()
+        fields = {}
+        for key, value in data.items():
+            fields.setdefault(key, []).append(value)
+        self.submissions.append({
+            "form": name,
+            "auth": request.match_info["prefix"] == "authforms",
+            "email": request.cookies.get(SESSION_COOKIE),
+            "time": datetime.datetime.utcnow().isoformat(),
+            "fields": fields,
+        })
+        return self._render("form-response", title=name)
+
+    async def _get_google_signin(self, request: web.Request):
+        return self._render("google-signin", continue_=request.query.get("continue", "/"))
+
+    async def _post_google_signin(self, request: web.Request):
+        data = await request.post()
+        query = urllib.parse.urlencode({"continue": data.get("continue", "/"), "email": data.get("identifier", "")})
+        raise web.HTTPFound(f"/aw.tdsb.on.ca/login?{query}")
+
+    async def _get_aw_login(self, request: web.Request):
+        return self._render("aw-login", continue_=request.query.get("continue", "/"), email=request.query.get("email", ""))
+
+    async def _post_aw_login(self, request: web.Request):
+        data = await request.post()
+        ok = not self.bad_password or data.get("Password") != self.bad_password
+        self.logins.append({
+            "email": data.get("email"),
+            "username": data.get("UserName"),
+            "success": ok,
+            "time": datetime.datetime.utcnow().isoformat(),
+        })
+        if not ok:
+            return self._render("aw-login", status=401, continue_=data.get("continue", "/"), email=data.get("email"),
+                                error="Invalid username or password")
+        response = web.HTTPFound(data.get("continue", "/"))
+        response.set_cookie(SESSION_COOKIE, data.get("email", ""), path="/")
+        raise response
+
+    async def _get_submissions(self, request: web.Request): # pylint: disable=unused-argument
+        return web.json_response(self.submissions)
+
+    async def _get_logins(self, request: web.Request): # pylint: disable=unused-argument
+        return web.json_response(self.logins)
+
+    async def _post_reset(self, request: web.Request): # pylint: disable=unused-argument
+        self.reset()
+        return web.Response(status=204)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve fake Google Forms for ghoster")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--bad-password", default=None, help="AW password that is rejected")
+    parser.add_argument("--latency", type=float, default=0, help="Delay in seconds added to every page load")
+    args = parser.parse_args()
+    server = FakeFormsServer(bad_password=args.bad_password, latency=args.latency)
+    web.run_app(server.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+A local stand-in for the TDSB Connects API, used for testing and benchmarking lockbox without real credentials.
+
+Serves login, user info, day cycle names and timetables for synthetic students, generated deterministically
+from a seed (or loaded from a JSON file in the same format as /_fake/students, to replay specific cases).
+Latency, timeouts and errors can be injected, and changed while the server is running.
+
+Every student's password is PASSWORD. Usernames are 9 digit student numbers starting at FIRST_STUDENT.
+Schools have codes starting at FIRST_SCHOOL, and share one day cycle calendar: weekdays from the start of the
+school year cycle through D1 to D4, except for the dates in holidays.
+
+Endpoints served (same as TDSB Connects):
+    - /token (POST):
+        Logs in (grant_type=password) or refreshes a token (grant_type=refresh_token). 401 if the credentials are wrong.
+    - /api/Account/GetUserInfo
+    - /api/TimeTable/GetDayNameDayCycle/<school>/<year>/<track>/<start DDMMYYYY>/<end DDMMYYYY>
+    - /api/TimeTable/GetTimeTable/Student/<school>/<DDMMYYYY>
+API endpoints give a 401 if the access token is missing, unknown or expired.
+
+Endpoints for inspecting and controlling the fake server:
+    - /_fake/stats:
+        JSON of request counts per endpoint, logins, and injected errors and timeouts.
+    - /_fake/students:
+        JSON list of all students.
+    - /_fake/config (GET/POST):
+        Get or change the latency, jitter, error_rate, error_status, timeout_rate and token_lifetime settings.
+    - /_fake/reset (POST):
+        Clears the stats and all issued tokens.
+
+To point lockbox at it, set LOCKBOX_TDSB_API_URL to its base URL (or set tdsbconnects.TDSBConnects.API_URL).
+
+Run standalone with:
+    python faketdsb.py [--host 127.0.0.1] [--port 8091] [--students 100] [--schools 1] [--latency SECONDS]
+                       [--error-rate 0.1] [--timeout-rate 0.01] [--students-file students.json]
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import random
+import secrets
+import time
+import typing
+from aiohttp import web
+
+
+PASSWORD = "password"
+FIRST_STUDENT = 300000000
+FIRST_SCHOOL = 9000
+
+CYCLE_LENGTH = 4
+
+COURSES = [
+    ("ENG3U", "English"), ("MCR3U", "Functions"), ("SPH3U", "Physics"), ("SCH3U", "Chemistry"),
+    ("SBI3U", "Biology"), ("CHW3M", "World History"), ("ICS3U", "Computer Science"), ("FSF3U", "Core French"),
+    ("AVI3M", "Visual Arts"), ("PPL3O", "Healthy Active Living"), ("TEJ3M", "Computer Engineering"), ("BAF3M", "Accounting"),
+]
+TEACHERS = ["Smith", "Tremblay", "Nguyen", "Patel", "Wong", "Martin", "Brown", "Singh", "Roy", "Lee"]
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Morgan", "Casey", "Riley", "Jamie", "Avery", "Quinn"]
+LAST_NAMES = ["Chen", "Garcia", "Ali", "Khan", "Wilson", "Li", "Kim", "Cohen", "Silva", "Murphy"]
+
+# Periods each cycle day has; periods ending in "a" are asynchronous
+PERIODS = (("1", "08:45:00", "11:15:00"), ("1a", "12:15:00", "14:45:00"))
+
+
+def school_year_start(today: datetime.date) -> datetime.date:
+    """
+    Get the first day of the school year a date is in.
+    """
+    return datetime.date(today.year if today.month >= 9 else today.year - 1, 9, 1)
+
+
+def generate_students(count: int, schools: int = 1, seed: int = 0) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Generate synthetic students, spread evenly between the schools.
+
+    Each student has one course per pair of cycle days, each with a sync and an async period.
+    """
+    students = []
+    for i in range(count):
+        rng = random.Random(seed * 1000003 + i)
+        courses = []
+        for code, name in rng.sample(COURSES, CYCLE_LENGTH // 2):
+            section = rng.randint(1, 4)
+            teacher = rng.choice(TEACHERS)
+            courses.append({
+                "code": f"{code}1-0{section}",
+                "name": name,
+                "teacher": f"{teacher}, {rng.choice(FIRST_NAMES)}",
+                "teacher_email": f"{teacher.lower()}{section}@tdsb.on.ca",
+                "room": str(rng.randint(100, 399)),
+            })
+        students.append({
+            "username": str(FIRST_STUDENT + i),
+            "first_name": rng.choice(FIRST_NAMES),
+            "last_name": rng.choice(LAST_NAMES),
+            "grade": rng.randint(9, 12),
+            "school": FIRST_SCHOOL + i % schools,
+            "courses": courses,
+        })
+    return students
+
+
+class FakeTDSBServer:
+    """
+    The fake TDSB Connects server.
+
+    latency is a delay in seconds added to every API request, plus a random amount up to jitter.
+    error_rate is the fraction of API requests answered with error_status instead.
+    timeout_rate is the fraction of API requests that never get an answer (until the client gives up).
+    token_lifetime is how long access tokens last in seconds.
+    holidays is a list of weekdays that aren't school days.
+    """
+
+    CONFIG_KEYS = ("latency", "jitter", "error_rate", "error_status", "timeout_rate", "token_lifetime")
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, students: typing.List[typing.Dict[str, typing.Any]] = None,
+                 latency: float = 0, jitter: float = 0, error_rate: float = 0, error_status: int = 503,
+                 timeout_rate: float = 0, token_lifetime: float = 3600, holidays: typing.Iterable[datetime.date] = (),
+                 seed: int = 0):
+        self.host = host
+        self.port = port
+        self.students = {student["username"]: student for student in (students if students is not None else generate_students(100))}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.timeout_rate = timeout_rate
+        self.token_lifetime = token_lifetime
+        self.holidays = set(holidays)
+        self.stats = collections.Counter() # type: typing.Counter[str]
+        # Access and refresh tokens to (username, expiry time)
+        self._tokens = {} # type: typing.Dict[str, typing.Tuple[str, float]]
+        self._refresh_tokens = {} # type: typing.Dict[str, str]
+        self._rng = random.Random(seed)
+        self._day_cycle_names = {} # type: typing.Dict[datetime.date, str]
+        self._runner = None
+
+        self.app = web.Application(middlewares=[self._inject_middleware])
+        self.app.router.add_routes([
+            web.post("/token", self._post_token),
+            web.get("/api/Account/GetUserInfo", self._get_user_info),
+            web.get("/api/TimeTable/GetDayNameDayCycle/{school}/{year}/{track}/{start}/{end}", self._get_day_cycle_names),
+            web.get("/api/TimeTable/GetTimeTable/Student/{school}/{date}", self._get_timetable),
+            web.get("/_fake/stats", self._get_stats),
+            web.get("/_fake/students", self._get_students),
+            web.get("/_fake/config", self._get_config),
+            web.post("/_fake/config", self._post_config),
+            web.post("/_fake/reset", self._post_reset),
+        ])
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def api_url(self) -> str:
+        """
+        The URL to use for tdsbconnects.TDSBConnects.API_URL.
+        """
+        return self.base_url + "/"
+
+    async def start(self):
+        """
+        Start serving.
+
+        If the port is 0, a free port is picked and stored in self.port.
+        """
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1] # pylint: disable=protected-access
+
+    async def stop(self):
+        """
+        Stop serving.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset(self):
+        """
+        Clear the stats and all issued tokens.
+        """
+        self.stats.clear()
+        self._tokens.clear()
+        self._refresh_tokens.clear()
+
+    def configure(self, **config):
+        """
+        Change the settings in CONFIG_KEYS.
+        """
+        for key, value in config.items():
+            if key not in self.CONFIG_KEYS:
+                raise ValueError(f"Unknown setting: {key}")
+            setattr(self, key, int(value) if key == "error_status" else float(value))
+
+    def day_cycle_name(self, date: datetime.date) -> str:
+        """
+        Get the day cycle name of a date, e.g. "D1", or "D" if it's not a school day.
+        """
+        if date not in self._day_cycle_names:
+            if date.weekday() >= 5 or date in self.holidays:
+                self._day_cycle_names[date] = "D"
+            else:
+                start = school_year_start(date)
+                dates = (start + datetime.timedelta(days=i) for i in range((date - start).days))
+                school_days = sum(1 for d in dates if d.weekday() < 5 and d not in self.holidays)
+                self._day_cycle_names[date] = f"D{school_days % CYCLE_LENGTH + 1}"
+        return self._day_cycle_names[date]
+
+    @staticmethod
+    def _parse_date(date: str) -> datetime.date:
+        try:
+            return datetime.datetime.strptime(date, "%d%m%Y").date()
+        except ValueError as e:
+            raise web.HTTPBadRequest() from e
+
+    def _issue_token(self, username: str) -> web.Response:
+        token = secrets.token_hex(16)
+        refresh_token = secrets.token_hex(16)
+        self._tokens[token] = (username, time.time() + self.token_lifetime)
+        self._refresh_tokens[refresh_token] = username
+        return web.json_response({"access_token": token, "refresh_token": refresh_token, "token_type": "bearer",
+                                  "expires_in": int(self.token_lifetime)})
+
+    def _authenticate(self, request: web.Request) -> typing.Dict[str, typing.Any]:
+        """
+        Get the student a request is made as.
+        """
+        auth = request.headers.get("Authorization", "")
+        username, expiry = self._tokens.get(auth[len("Bearer "):] if auth.startswith("Bearer ") else "", (None, 0))
+        if username is None or expiry < time.time():
+            self.stats["unauthorized"] += 1
+            raise web.HTTPUnauthorized()
+        return self.students[username]
+
+    @web.middleware
+    async def _inject_middleware(self, request: web.Request, handler):
+        if request.path.startswith("/_fake/"):
+            return await handler(request)
+        self.stats[request.match_info.route.resource.canonical if request.match_info.route.resource else "unknown"] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._rng.uniform(0, self.jitter))
+        roll = self._rng.random()
+        if roll < self.timeout_rate:
+            self.stats["timeouts"] += 1
+            # Hang until the client gives up
+            await asyncio.sleep(3600)
+        if roll < self.timeout_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"Message": "An error has occurred."}, status=self.error_status)
+        return await handler(request)
+
+    async def _post_token(self, request: web.Request):
+        data = await request.post()
+        if data.get("grant_type") == "refresh_token":
+            username = self._refresh_tokens.pop(data.get("refresh_token", ""), None)
+            if username is None:
+                return web.json_response({"error": "invalid_grant"}, status=401)
+            self.stats["refreshes"] += 1
+            return self._issue_token(username)
+        student = self.students.get(data.get("username", ""))
+        if student is None or data.get("password") != PASSWORD:
+            self.stats["failed_logins"] += 1
+            return web.json_response({"error": "invalid_grant", "error_description": "The user name or password is incorrect."}, status=401)
+        self.stats["logins"] += 1
+        return self._issue_token(student["username"])
+
+    async def _get_user_info(self, request: web.Request):
+        student = self._authenticate(request)
+        start = school_year_start(datetime.date.today())
+        return web.json_response({
+            "UserId": student["username"],
+            "UserName": f"{student['last_name']}, {student['first_name']}",
+            "FirstName": student["first_name"],
+            "LastName": student["last_name"],
+            "Email": f"{student['first_name'].lower()}.{student['last_name'].lower()}{student['username'][-3:]}@student.tdsb.on.ca",
+            "AWUserId": student["username"],
+            "Gender": None,
+            "Age": None,
+            "BirthDate": "2005-01-01T00:00:00",
+            "Picture": None,
+            "Thumbnail": None,
+            "PrincipalEmailsList": [],
+            "VicePrincipalEmailsList": [],
+            "SuperintendentEmailsList": [],
+            "Role": [3],
+            "SchoolList": [{
+                "SchoolName": f"Fake Collegiate Institute #{student['school']}",
+                "SchoolCode": student["school"],
+                "IsOnboard": True,
+                "SchoolSetting": {
+                    "Id": 1,
+                    "CurrentSession": f"{start.year}{start.year + 1}",
+                    "SchoolYearTrack": "Regular",
+                    "SessionStart": f"{start.isoformat()}T00:00:00",
+                    "SessionEnd": f"{start.year + 1}-06-30T00:00:00",
+                },
+            }],
+            "SchoolCodeList": [{
+                "SchoolCode": student["school"],
+                "StudentInfo": {
+                    "FirstName": student["first_name"],
+                    "LastName": student["last_name"],
+                    "CurrentGradeLevel": student["grade"],
+                },
+            }],
+        })
+
+    async def _get_day_cycle_names(self, request: web.Request):
+        self._authenticate(request)
+        start = self._parse_date(request.match_info["start"])
+        end = self._parse_date(request.match_info["end"])
+        # Stops at the end of the school year, like the real thing
+        end = min(end, datetime.date(school_year_start(start).year + 1, 6, 30))
+        names = []
+        for i in range((end - start).days + 1):
+            date = start + datetime.timedelta(days=i)
+            names.append(f"{date.strftime('%a')}({self.day_cycle_name(date)})")
+        return web.json_response(names)
+
+    async def _get_timetable(self, request: web.Request):
+        student = self._authenticate(request)
+        date = self._parse_date(request.match_info["date"])
+        school = int(request.match_info["school"])
+        day = self.day_cycle_name(date)
+        if school != student["school"] or day == "D":
+            return web.json_response({"CourseTable": []})
+        cycle_day = int(day[1:])
+        course = student["courses"][(cycle_day - 1) * len(student["courses"]) // CYCLE_LENGTH]
+        items = []
+        for period, start, end in PERIODS:
+            items.append({
+                "StudentNumber": student["username"],
+                "CourseKey": f"{course['code']}-{period}",
+                "StudentCourse": {
+                    "ClassCode": course["code"],
+                    "ClassName": course["name"],
+                    "Period": period,
+                    "Block": period,
+                    "TeacherName": course["teacher"],
+                    "TeacherEmail": course["teacher_email"],
+                    "RoomNo": course["room"],
+                    "SchoolCode": school,
+                    "Date": f"{date.isoformat()}T00:00:00",
+                    "CycleDay": cycle_day,
+                    "StartTime": f"{date.isoformat()}T{start}",
+                    "EndTime": f"{date.isoformat()}T{end}",
+                    "Semester": 1,
+                    "Term": 1,
+                    "Timeline": "Q1",
+                    "SchoolYearTrack": "Regular",
+                },
+            })
+        return web.json_response({"CourseTable": items})
+
+    async def _get_stats(self, request: web.Request): # pylint: disable=unused-argument
+        return web.json_response(dict(self.stats))
+
+    async def _get_students(self, request: web.Request): # pylint: disable=unused-argument
+        return web.json_response(list(self.students.values()))
+
+    async def _get_config(self, request: web.Request): # pylint: disable=unused-argument
+        return web.json_response({key: getattr(self, key) for key in self.CONFIG_KEYS})
+
+    async def _post_config(self, request: web.Request):
+        try:
+            self.configure(**await request.json())
+        except (ValueError, TypeError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+        return await self._get_config(request)
+
+    async def _post_reset(self, request: web.Request): # pylint: disable=unused-argument
+        self.reset()
+        return web.Response(status=204)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake TDSB Connects API for lockbox")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--students", type=int, default=100, help="Number of synthetic students")
+    parser.add_argument("--schools", type=int, default=1, help="Number of schools to spread the students between")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for generating students and injecting errors")
+    parser.add_argument("--students-file", default=None, help="JSON file of students (as served by /_fake/students) to use instead")
+    parser.add_argument("--latency", type=float, default=0, help="Delay in seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0, help="Max random delay in seconds added on top of the latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of injected errors")
+    parser.add_argument("--timeout-rate", type=float, default=0, help="Fraction of requests that are never answered")
+    parser.add_argument("--token-lifetime", type=float, default=3600, help="Lifetime of access tokens in seconds")
+    args = parser.parse_args()
+    if args.students_file:
+        with open(args.students_file, "r") as f:
+            students = json.load(f)
+    else:
+        students = generate_students(args.students, args.schools, args.seed)
+    server = FakeTDSBServer(students=students, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            error_status=args.error_status, timeout_rate=args.timeout_rate,
+                            token_lifetime=args.token_lifetime, seed=args.seed)
+    web.run_app(server.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+// Minimal stand-in for the Google Forms viewer scripts.
+// Only implements the behaviour ghoster relies on: dropdown popups and submitting.
+
+function fakeSubmit() {
+    document.getElementById("mG61Hd").submit();
+}
+
+function fakeNext() {
+    // Multi-page forms aren't supported by ghoster; just go nowhere
+}
+
+function fakeCloseSelects() {
+    for (const popup of document.querySelectorAll(".exportSelectPopup")) {
+        popup.innerHTML = "";
+        popup.style.display = "none";
+    }
+}
+
+function fakeOpenSelect(opener) {
+    const root = opener.closest(".freebirdFormviewerComponentsQuestionSelectRoot");
+    const popup = root.querySelector(".exportSelectPopup");
+    const input = root.querySelector("input[type=hidden]");
+    const options = ["Choose"].concat(JSON.parse(opener.dataset.options));
+    fakeCloseSelects();
+    options.forEach((label, i) => {
+        const option = document.createElement("div");
+        option.className = "quantumWizMenuPaperselectOption freebirdThemedSelectOptionDarkerDisabled exportOption";
+        option.setAttribute("role", "option");
+        option.textContent = label;
+        option.addEventListener("click", () => {
+            input.value = i === 0 ? "" : label;
+            opener.querySelector(".quantumWizMenuPaperselectContent").textContent = label;
+        });
+        popup.appendChild(option);
+    });
+    popup.style.display = "block";
+}
+
+document.addEventListener("keydown", (e) => {
+    if (e.key === "Escape") {
+        fakeCloseSelects();
+    }
+});
@@ -24,6 +24,11 @@ The following environment variables MAY be set to customize lockbox's behaviour:
         Times are in the local timezone. A random time will be chosen from the
         range for each run of the task. E.g. "04:00:00-05:00:00" sets the task
         to run sometime between 4am and 5am each day. Defaults to 4am-4am.
+    - LOCKBOX_CHECK_DAY_PARALLEL_LOGINS:
+        The number of users the Check Day task tries to log in as at once.
+        Users whose credentials worked most recently are tried first, and the
+        remaining attempts are cancelled once one of them gets the day.
+        Defaults to 3.
     - LOCKBOX_FILL_FORM_RUN_TIME:
         The time range in which the Fill Form tasks are to be run each day.
         Same format as LOCKBOX_CHECK_DAY_RUN_TIME. Defaults to 7am-9am.
@@ -37,18 +42,167 @@ The following environment variables MAY be set to customize lockbox's behaviour:
         globally. Lockbox will still fill in the forms and take a screenshot to
         be reported back, but the form will not actually be submitted. Defaults
         to true (submit is enabled).
+    - LOCKBOX_PREFETCH_FILL_PLANS_CONCURRENCY:
+        On school days, the Check Day task starts a task that prepares a fill
+        plan (course, field values and warnings) for every user whose form is
+        filled later that day, so Fill Form doesn't need TDSB Connects. This
+        sets the number of users prepared at once. Defaults to 5.
+    - LOCKBOX_FILL_FORM_SCREENSHOTS:
+        Which successful Fill Form runs keep screenshots of the filled in form
+        and the confirmation page. Either "always", "warnings" (only runs with
+        warnings), or a percentage of runs to sample, e.g. "10%". Runs with
+        warnings and possible failures always keep their screenshots, and test
+        fills always take them. Defaults to "always".
     - LOCKBOX_UPDATE_COURSES_BATCH_SIZE:
-        The batch size (number of update operations to run at once) for
+        The starting batch size (number of users updated per batch) for
         updating all users' courses (typically run during a quad switch). Since
-        the number of users can be large, users are divided into batches of
-        this size, which are then run in sequence with the specified interval
-        (see LOCKBOX_UPDATE_COURSES_INTERVAL). Defaults to 3.
+        the number of users can be large, users are divided into batches, which
+        are run in sequence with the specified interval (see
+        LOCKBOX_UPDATE_COURSES_INTERVAL). Users in a batch are updated as many
+        at a time as the TDSB Connects task and connection limits allow. After each batch, the batch size is
+        increased by 1 if it went well, or halved if TDSB Connects had errors
+        or was slow (see LOCKBOX_UPDATE_COURSES_TARGET_LATENCY). Defaults to 3.
+    - LOCKBOX_UPDATE_COURSES_MAX_BATCH_SIZE:
+        The largest the batch size for updating all users' courses can grow
+        to. Defaults to 30.
     - LOCKBOX_UPDATE_COURSES_INTERVAL:
         The interval in seconds (amount of time to wait between batches) for
-        updating all users' courses (typically run during a quad switch). See
-        above for details. Note that this is the interval between the *start*
-        of two batches, not between the end of one batch and the start of the
-        next. Defaults to 60.
+        updating all users' courses. Note that this is the interval between
+        the *start* of two batches, not between the end of one batch and the
+        start of the next. Defaults to 60. This is a float.
+    - LOCKBOX_UPDATE_COURSES_TARGET_LATENCY:
+        If updating one user's courses takes longer than this many seconds on
+        average in a batch, the batch size is halved. Defaults to 15. This is a
+        float.
+    - LOCKBOX_TDSB_SESSION_CONCURRENCY:
+        The maximum number of requests made to TDSB Connects at once for one
+        user, e.g. when getting the timetables for each day in the cycle.
+        Defaults to 4.
+    - LOCKBOX_TDSB_SESSION_CACHE_SIZE:
+        The maximum number of logged in TDSB Connects sessions kept for reuse
+        between tasks. Sessions are kept until their token expires, and the
+        least recently used ones are closed once there are more than this.
+        Defaults to 100.
+    - LOCKBOX_TDSB_CONNECTION_LIMIT:
+        The maximum number of connections open to TDSB Connects (or any other
+        host) at once, shared between all sessions. Defaults to enough for
+        every task that uses TDSB Connects (7 at once) to make
+        LOCKBOX_TDSB_SESSION_CONCURRENCY requests at once, i.e. 28.
+    - LOCKBOX_HTTP_CONNECTION_LIMIT:
+        The maximum number of connections lockbox has open at once for all
+        outgoing HTTP requests (except the ones made by Firefox). Connections
+        are kept alive and reused between requests and tasks. Defaults to 100.
+    - LOCKBOX_HTTP_KEEPALIVE_TIMEOUT:
+        How long in seconds idle connections are kept open for reuse. Defaults
+        to 60. This is a float.
+    - LOCKBOX_TDSB_API_URL:
+        The base URL of the TDSB Connects API. Only meant for pointing lockbox
+        at a fake TDSB Connects server for testing (see bench/faketdsb.py).
+        Defaults to the real one.
+    - LOCKBOX_TDSB_REQUEST_TIMEOUT:
+        Timeout in seconds for each request to TDSB Connects. Defaults to 30.
+        This is a float.
+    - LOCKBOX_TDSB_BREAKER_MIN_CALLS, LOCKBOX_TDSB_BREAKER_ERROR_RATE,
+      LOCKBOX_TDSB_BREAKER_OPEN_TIME:
+        Settings for the TDSB Connects circuit breaker. Once at least
+        MIN_CALLS operations were made in the last minute and ERROR_RATE (a
+        fraction) of them failed because of TDSB Connects (timeouts, connection
+        errors and 5xx responses), TDSB Connects is considered to be down for
+        OPEN_TIME seconds. During that time, form filling uses stored data
+        right away and course population is deferred. After that, one trial
+        operation is let through to check whether it's back up. The Check Day
+        task always tries and reports the result. Default to 5, 0.5 and 300.
+    - LOCKBOX_FORM_GEOMETRY_REVALIDATE_INTERVAL:
+        The number of seconds a cached form geometry is trusted before it is
+        revalidated by fetching the form page and comparing its structural
+        fingerprint. This is done in the background; the cached geometry is
+        returned until it's found to be outdated. Defaults to 3600 (1 hour).
+        This is a float.
+    - LOCKBOX_FORM_GEOMETRY_MAX_AGE:
+        The maximum age in seconds of a cached form geometry for forms that
+        cannot be fingerprinted without a browser (e.g. forms that require
+        sign in). After this the geometry is extracted again. Defaults to 86400
+        (1 day). This is a float.
+    - LOCKBOX_CONFIG_CACHE_CHECK_INTERVAL:
+        Courses and form configs used for filling forms are cached, and
+        dropped when fenetre (or lockbox) changes any of them. This is how
+        often in seconds lockbox checks for changes, i.e. how long a change can
+        take to be used. Test fills always check first. Defaults to 5. This is
+        a float.
+    - LOCKBOX_USER_ERROR_LIMIT:
+        The number of errors (e.g. form filling failures) kept for each user.
+        Older errors are deleted when new ones are added. Defaults to 100.
+    - LOCKBOX_TEST_RESULT_TTL:
+        The number of seconds the results of a test fill are kept after the
+        test is started. MongoDB removes them afterwards. Defaults to 21600 (6
+        hours). This is a float.
+    - LOCKBOX_SCREENSHOT_SWEEP_INTERVAL:
+        How often in seconds the screenshots (GridFS files) that no document
+        refers to anymore are deleted, e.g. the ones of expired test results
+        or ones leaked by a crash. Defaults to 3600 (1 hour). This is a float.
+    - LOCKBOX_SCREENSHOT_SWEEP_GRACE:
+        The minimum age in seconds of a screenshot before it can be deleted by
+        the sweep, so ones that were just uploaded aren't deleted before
+        they're stored. Defaults to 3600 (1 hour). This is a float.
+    - LOCKBOX_FIREFOX_MAX_CONCURRENT:
+        The maximum number of Firefox instances (form filling, testing and
+        geometry tasks) that can run at once. The actual limit is lowered
+        based on the currently available memory (see below). Defaults to 3.
+    - LOCKBOX_FIREFOX_MEMORY_ESTIMATE:
+        The expected memory usage of one Firefox instance in MiB. A new
+        instance is only started if this much memory is available (unless no
+        other instance is running). Defaults to 300.
+    - LOCKBOX_FIREFOX_MEMORY_LIMIT:
+        A hard memory limit in MiB for each Firefox instance. Uses a cgroup if
+        LOCKBOX_FIREFOX_CGROUP is set, otherwise the data segment rlimit. A
+        browser going over this will crash, failing only its own task. Unset
+        (no limit) by default.
+    - LOCKBOX_FIREFOX_CPU_QUOTA:
+        The fraction of one CPU each Firefox instance may use, e.g. 0.5. Only
+        applies if LOCKBOX_FIREFOX_CGROUP is set. Unset by default.
+    - LOCKBOX_FIREFOX_NICE:
+        The niceness to run Firefox with when cgroups are not used. Unset by
+        default.
+    - LOCKBOX_FIREFOX_CGROUP:
+        Path to a delegated cgroup v2 directory lockbox is allowed to create
+        child cgroups in (with the memory and cpu controllers enabled). Each
+        Firefox instance gets its own child cgroup. Unset by default.
+    - LOCKBOX_FORM_PROFILES_FILE:
+        Path to a JSON file with extra selector profiles for matching Google
+        Forms markup, in the same format as formprofiles.BUILTIN_PROFILES.
+        These are tried before the built-in profiles, so a change in Google's
+        markup can be handled without updating lockbox. Unset by default.
+
+The following environment variables MAY be set to configure the MongoDB connection. Fenetre reads the same
+ones, so they can be set once for both services:
+    - NFFU_MONGO_URI:
+        A MongoDB connection string, e.g. to connect to a replica set. Options
+        in it (e.g. "?replicaSet=rs0&maxPoolSize=50") are used as well, unless
+        the same option is set with one of the variables below. Defaults to
+        the "db" host on port 27017.
+    - NFFU_MONGO_MAX_POOL_SIZE, NFFU_MONGO_MIN_POOL_SIZE:
+        The max and min number of connections kept open to each server. Raise
+        the min to keep connections ready for the burst of form filling in the
+        morning. Default to 100 and 0.
+    - NFFU_MONGO_SERVER_SELECTION_TIMEOUT, NFFU_MONGO_CONNECT_TIMEOUT,
+      NFFU_MONGO_SOCKET_TIMEOUT:
+        Timeouts in seconds for finding a server to use, connecting, and
+        waiting for a response. Default to 30, 20 and no timeout. These are
+        floats.
+    - NFFU_MONGO_COMPRESSORS:
+        A comma separated list of wire protocol compressors to use in order of
+        preference, e.g. "zstd,snappy,zlib". zstd needs the zstandard package
+        and snappy needs the python-snappy package installed. Unset (no
+        compression) by default.
+    - NFFU_MONGO_WRITE_CONCERN:
+        The write concern of ordinary writes, either "majority" or a number of
+        nodes. Defaults to the server's default.
+    - NFFU_MONGO_CREDENTIALS_WRITE_CONCERN:
+        The write concern of writes of user credentials (and all of fenetre's
+        user data). Defaults to "majority".
+    - NFFU_MONGO_METRICS_WRITE_CONCERN:
+        The write concern of writes of stats that can be lost (the fill
+        history). Defaults to 0 (unacknowledged).
 """
 
 
@@ -61,7 +215,7 @@ def setup_loggers(level: int):
     formatter = logging.Formatter("%(asctime)s - %(levelname)s: %(name)s: %(message)s")
     handler.setFormatter(formatter)
 
-    for name in ["scheduler", "task", "server", "db", "ghoster"]:
+    for name in ["scheduler", "task", "server", "db", "ghoster", "formdef", "tdsb"]:
         logger = logging.getLogger(name)
         logger.setLevel(level)
         logger.addHandler(handler)
@@ -0,0 +1,161 @@
+"""
+An in-process cache of the Course and Form documents in the shared database.
+
+Every form fill needs the user's course and its form config, which are shared by many users and only change when
+they're edited in fenetre (or when lockbox adds slots or a teacher name to a course). Whatever changes them increments
+a version counter in the shared database (see bump_version()), and the cache drops everything once it sees a new
+version. The counter is checked at most every CHECK_INTERVAL seconds, so a change can take that long to be seen,
+unless refresh() is called.
+
+Change streams would make the polling unnecessary, but they need a replica set, and the default deployment is a
+single server.
+"""
+
+import asyncio
+import bson
+import os
+import time
+import typing
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+
+# How often the version counter is checked (in seconds)
+CHECK_INTERVAL = 5.0
+# Collection in the shared database with the version counter, and the counter's id
+# Fenetre writes the same counter (see bump_config_version() in fenetre/db.py); keep the two in sync
+VERSION_COLLECTION = "config_versions"
+VERSION_ID = "course_config"
+
+if os.environ.get("LOCKBOX_CONFIG_CACHE_CHECK_INTERVAL"):
+    CHECK_INTERVAL = float(os.environ["LOCKBOX_CONFIG_CACHE_CHECK_INTERVAL"])
+
+
+async def bump_version(versions: AsyncIOMotorCollection) -> None:
+    """
+    Increment the version counter, so every cache drops the documents it has.
+    """
+    await versions.update_one({"_id": VERSION_ID}, {"$inc": {"version": 1}}, upsert=True)
+
+
+class ConfigCache:
+    """
+    Caches Course documents (by id and course code) and Form documents (by id).
+
+    Only documents that were found are cached. The cached documents are shared by all callers, so they must not be
+    modified; load them from the database to change them (and call invalidate() afterwards).
+    """
+
+    def __init__(self, course_impl, form_impl, versions: AsyncIOMotorCollection):
+        self._course_impl = course_impl
+        self._form_impl = form_impl
+        self._versions = versions
+        self._courses = {} # type: typing.Dict[bson.ObjectId, typing.Any]
+        self._course_ids = {} # type: typing.Dict[str, bson.ObjectId]
+        self._forms = {} # type: typing.Dict[bson.ObjectId, typing.Any]
+        self._version = None # type: typing.Optional[int]
+        self._checked_at = None # type: typing.Optional[float]
+        # Incremented on every clear, so documents loaded before a clear aren't stored after it
+        self._generation = 0
+        # Held while checking the version, so concurrent lookups only check once
+        # Created on first use, since it needs the event loop
+        self._check_lock = None # type: typing.Optional[asyncio.Lock]
+
+    def clear(self) -> None:
+        """
+        Drop all cached documents.
+        """
+        self._courses.clear()
+        self._course_ids.clear()
+        self._forms.clear()
+        self._generation += 1
+
+    async def refresh(self) -> None:
+        """
+        Check the version counter now, e.g. before a test fill, which should use the config that was just saved.
+        """
+        await self._check_version(force=True)
+
+    async def invalidate(self) -> None:
+        """
+        Drop all cached documents, here and in every other lockbox, after changing a course or form.
+        """
+        await bump_version(self._versions)
+        self.clear()
+
+    async def _check_version(self, force: bool = False) -> None:
+        if not force and self._checked_at is not None and time.monotonic() - self._checked_at < CHECK_INTERVAL:
+            return
+        if self._check_lock is None:
+            self._check_lock = asyncio.Lock()
+        async with self._check_lock:
+            # Someone else might've checked while we were waiting
+            if not force and self._checked_at is not None and time.monotonic() - self._checked_at < CHECK_INTERVAL:
+                return
+            doc = await self._versions.find_one({"_id": VERSION_ID})
+            version = doc["version"] if doc is not None else 0
+            if version != self._version:
+                self.clear()
+                self._version = version
+            self._checked_at = time.monotonic()
+
+    def _store_course(self, course) -> None:
+        self._courses[course.pk] = course
+        self._course_ids[course.course_code] = course.pk
+
+    async def get_course(self, course_id: bson.ObjectId):
+        """
+        Get a Course document by id, or None if it doesn't exist.
+        """
+        await self._check_version()
+        if course_id in self._courses:
+            return self._courses[course_id]
+        generation = self._generation
+        course = await self._course_impl.find_one({"_id": course_id})
+        if course is not None and generation == self._generation:
+            self._store_course(course)
+        return course
+
+    async def get_courses(self, course_ids: typing.Iterable[bson.ObjectId]) -> typing.Dict[bson.ObjectId, typing.Any]:
+        """
+        Get several Course documents by id, loading all of the ones that aren't cached at once.
+
+        Returns a dict of the ones that exist by id.
+        """
+        await self._check_version()
+        course_ids = list(course_ids)
+        courses = {course_id: self._courses[course_id] for course_id in course_ids if course_id in self._courses}
+        missing = [course_id for course_id in course_ids if course_id not in courses]
+        if missing:
+            generation = self._generation
+            async for course in self._course_impl.find({"_id": {"$in": missing}}):
+                courses[course.pk] = course
+                if generation == self._generation:
+                    self._store_course(course)
+        return courses
+
+    async def get_course_by_code(self, course_code: str):
+        """
+        Get a Course document by course code, or None if it doesn't exist.
+        """
+        await self._check_version()
+        course_id = self._course_ids.get(course_code)
+        if course_id is not None and course_id in self._courses:
+            return self._courses[course_id]
+        generation = self._generation
+        course = await self._course_impl.find_one({"course_code": course_code})
+        if course is not None and generation == self._generation:
+            self._store_course(course)
+        return course
+
+    async def get_form(self, form_id: bson.ObjectId):
+        """
+        Get a Form document by id, or None if it doesn't exist.
+        """
+        await self._check_version()
+        if form_id in self._forms:
+            return self._forms[form_id]
+        generation = self._generation
+        form = await self._form_impl.find_one({"_id": form_id})
+        if form is not None and generation == self._generation:
+            self._forms[form_id] = form
+        return form
@@ -9,21 +9,51 @@ import datetime
 import gridfs
 import logging
 import os
+import pymongo
 import secrets
 import typing
 from cryptography.fernet import Fernet, InvalidToken
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
 from tdsbconnects import TDSBConnects, TimetableItem
 from umongo import ValidationError
 from umongo.frameworks import MotorAsyncIOInstance
+from . import configcache
 from . import documents
+from . import formdef
+from . import mongo
+from . import outbound
 from . import scheduler
 from . import tasks
+from . import tdsb
 
 
 logger = logging.getLogger("db")
 
 
+# Projection expression for whether a user has both a login and password, like checking them against None
+_CREDENTIALS_SET = {"$and": [{"$ne": [{"$ifNull": [f"${field}", None]}, None]} for field in ("login", "password")]}
+# Fields of a user returned by LockboxDB.get_user()
+_USER_INFO_PROJECTION = {
+    "login": 1, "active": 1, "courses": 1, "email": 1, "last_fill_form_result": 1, "grade": 1, "first_name": 1, "last_name": 1,
+    "credentials_set": _CREDENTIALS_SET,
+}
+
+
+def _serialize(value: typing.Any) -> typing.Any:
+    """
+    Serialize a raw value from the database into JSON types, the same way umongo's dump() would.
+    """
+    if isinstance(value, dict):
+        return {k: _serialize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_serialize(v) for v in value]
+    if isinstance(value, bson.ObjectId):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
 class LockboxDBError(Exception):
     """
     Raised to indicate an error when performing a lockbox db operation.
@@ -72,19 +102,24 @@ class LockboxDB:
         else:
             self.school_code = None
 
-        self.client = AsyncIOMotorClient(host, port)
+        self.client = mongo.create_client(host, port)
         self._private_db = self.client["lockbox"]
         self._shared_db = self.client["shared"]
         self._private_instance = MotorAsyncIOInstance(self._private_db)
         self._shared_instance = MotorAsyncIOInstance(self._shared_db)
         self._shared_gridfs = AsyncIOMotorGridFSBucket(self._shared_db)
 
-        self.LockboxFailureImpl = self._private_instance.register(documents.LockboxFailure)
         self.FillFormResultImpl = self._private_instance.register(documents.FillFormResult)
         self.UserImpl = self._private_instance.register(documents.User)
+        self.UserErrorImpl = self._private_instance.register(documents.UserError)
+        self.FillHistoryEntryImpl = self._private_instance.register(documents.FillHistoryEntry)
+        self.FillHistoryImpl = self._private_instance.register(documents.FillHistory)
         self.FormGeometryEntryImpl = self._private_instance.register(documents.FormGeometryEntry)
         self.CachedFormGeometryImpl = self._private_instance.register(documents.CachedFormGeometry)
         self.TaskImpl = self._private_instance.register(documents.Task)
+        self.FillPlanImpl = self._private_instance.register(documents.FillPlan)
+        self.CourseRefreshImpl = self._private_instance.register(documents.CourseRefresh)
+        self.ScreenshotSweepImpl = self._private_instance.register(documents.ScreenshotSweep)
 
         self.FormFieldImpl = self._shared_instance.register(documents.FormField)
         self.FormImpl = self._shared_instance.register(documents.Form)
@@ -92,6 +127,17 @@ class LockboxDB:
         self.FormFillingTestImpl = self._shared_instance.register(documents.FormFillingTest)
         self.LockboxFailureImplShared = self._shared_instance.register(documents.LockboxFailure)
         self.FillFormResultImplShared = self._shared_instance.register(documents.FillFormResult)
+        self.SchoolCalendarImpl = self._shared_instance.register(documents.SchoolCalendar)
+
+        # Courses and forms used for filling forms, invalidated when they're changed (here or in fenetre)
+        self.config_cache = configcache.ConfigCache(self.CourseImpl, self.FormImpl,
+                                                    self._shared_db[configcache.VERSION_COLLECTION])
+
+        # Connection pool for all outgoing HTTP requests
+        # The per host limit is for TDSB Connects, which gets by far the most requests
+        self.http = outbound.ConnectionPool(limit_per_host=tdsb.CONNECTION_LIMIT)
+        # Logged in TDSB Connects sessions, shared by all tasks
+        self.tdsb_sessions = tdsb.SessionCache(self.http)
 
         self._scheduler = scheduler.Scheduler(self)
         tasks.set_task_handlers(self._scheduler)
@@ -105,15 +151,61 @@ class LockboxDB:
         Initialize the databases and task scheduler.
         """
         await self.UserImpl.ensure_indexes()
+        await self.UserErrorImpl.ensure_indexes()
+        await self._migrate_user_errors()
+        await self.TaskImpl.ensure_indexes()
         await self.CourseImpl.ensure_indexes()
-        await self.CachedFormGeometryImpl.collection.drop()
+        # Courses are no longer queried by slot (find_course_in_slot() goes through the config cache)
+        if "known_slots_1" in await self.CourseImpl.collection.index_information():
+            await self.CourseImpl.collection.drop_index("known_slots_1")
+        await self.FormImpl.ensure_indexes()
+        await self.FormFillingTestImpl.ensure_indexes()
         await self.CachedFormGeometryImpl.ensure_indexes()
+        await self.SchoolCalendarImpl.ensure_indexes()
+        await self.FillPlanImpl.ensure_indexes()
+        await self.FillHistoryImpl.ensure_indexes()
         await self._scheduler.start()
+        if await self.TaskImpl.find_one({"kind": documents.TaskType.SWEEP_SCREENSHOTS.value}) is None:
+            await self._scheduler.create_task(kind=documents.TaskType.SWEEP_SCREENSHOTS)
 
         # Re-schedule the check day task if current day is not checked
         if self.current_day is None:
             await self._reschedule_check_day()
 
+    async def _migrate_user_errors(self) -> None:
+        """
+        Move errors stored in user documents (from before they had their own collection) to the UserError collection.
+
+        The errors keep their ids, so if this is interrupted, running it again doesn't copy them twice.
+        """
+        async for user in self.UserImpl.collection.find({"errors": {"$exists": True}}, {"errors": 1}):
+            errors = user["errors"][-tasks.USER_ERROR_LIMIT:]
+            # Errors should always have ids, but store any missing ones first so they're the same next time
+            if any("_id" not in error for error in errors):
+                for error in errors:
+                    error.setdefault("_id", bson.ObjectId())
+                await self.UserImpl.collection.update_one({"_id": user["_id"]}, {"$set": {"errors": errors}})
+            if errors:
+                await self.UserErrorImpl.collection.bulk_write([pymongo.UpdateOne({"_id": error["_id"]}, {"$setOnInsert": {
+                    "owner": user["_id"],
+                    "time_logged": error["time_logged"],
+                    "kind": error["kind"],
+                    "message": error.get("message", ""),
+                }}, upsert=True) for error in errors], ordered=False)
+            await self.UserImpl.collection.update_one({"_id": user["_id"]}, {"$unset": {"errors": ""}})
+            logger.info(f"Moved {len(errors)} errors of user {user['_id']} to their own collection")
+
+    async def _find_user(self, token: str, projection: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        """
+        Find a user by token as a raw dict with only the fields in the projection (and _id), without loading a document.
+
+        Use this for reading; load a document if the user is modified.
+        """
+        user = await self.UserImpl.collection.find_one({"token": token}, projection)
+        if user is None:
+            raise LockboxDBError("Bad token", LockboxDBError.BAD_TOKEN)
+        return user
+
     def private_db(self) -> AsyncIOMotorDatabase:
         """
         Get a reference to the private database.
@@ -150,6 +242,36 @@ class LockboxDB:
             await check_task.commit()
             self._scheduler.update()
 
+    def tdsb_task_slots(self, kind: documents.TaskType, wanted: int) -> typing.ContextManager[int]:
+        """
+        Take up to wanted more free slots of the scheduler's TDSB Connects group for a running task of a kind, e.g.
+        to refresh several users at once. Used as a context manager that gives the number taken.
+        """
+        return self._scheduler.extra_slots(kind, "tdsb_connects", wanted)
+
+    async def schedule_fill_plan_prefetch(self) -> None:
+        """
+        Schedule the prefetch fill plans task to run now, unless it's already scheduled.
+        """
+        if await self.TaskImpl.find_one({"kind": documents.TaskType.PREFETCH_FILL_PLANS.value}) is None:
+            await self._scheduler.create_task(kind=documents.TaskType.PREFETCH_FILL_PLANS)
+
+    async def get_school_calendars(self) -> typing.Dict[int, typing.Tuple[datetime.date, typing.List[str]]]:
+        """
+        Get the stored day cycle calendars of all schools, in the format taken by tdsb.get_async_periods().
+        """
+        return {calendar.school_code: (calendar.start.date(), calendar.days) async for calendar in self.SchoolCalendarImpl.find()}
+
+    async def update_school_calendar(self, school_code: int, start: datetime.date, days: typing.List[str]) -> None:
+        """
+        Store the day cycle calendar of a school, replacing the old one.
+        """
+        await self.SchoolCalendarImpl.collection.update_one({"school_code": school_code}, {"$set": {
+            "start": datetime.datetime.combine(start, datetime.time()),
+            "days": days,
+            "time_fetched": datetime.datetime.utcnow(),
+        }}, upsert=True)
+
     async def populate_user_courses(self, user, courses: typing.List[TimetableItem], clear_previous: bool = True) -> None:
         """
         Populate a user's courses, creating new Course documents if new courses are encountered.
@@ -157,31 +279,90 @@ class LockboxDB:
         If clear_previous is True, all previous courses will be cleared.
         However, the Course documents in the shared database will not be touched, since they might
         also be referred to by other users.
+
+        All Course documents are upserted in a single bulk write, so concurrent calls can't create the same
+        course twice, and the user is written at most once.
         """
-        if clear_previous:
-            user.courses = []
-        else:
-            user.courses = user.courses or []
-        # Populate courses collection
+        # Group slots and teacher names by course, keeping the order of the timetable
+        slots = {} # type: typing.Dict[str, typing.List[str]]
+        teachers = {} # type: typing.Dict[str, str]
         for course in courses:
-            db_course = await self.CourseImpl.find_one({"course_code": course.course_code})
-            if db_course is None:
-                db_course = self.CourseImpl(course_code=course.course_code, teacher_name=course.course_teacher_name)
-                # Without this, known_slots for different courses will all point to the same instance of list
-                db_course.known_slots = []
-            else:
-                # Make sure the teacher name is set
-                if not db_course.teacher_name:
-                    db_course.teacher_name = course.course_teacher_name
-            # Fill in known slots
+            slots.setdefault(course.course_code, [])
             slot_str = f"{course.course_cycle_day}-{course.course_period}"
-            if slot_str not in db_course.known_slots:
-                db_course.known_slots.append(slot_str)
-            await db_course.commit()
-            if db_course.pk not in user.courses:
-                user.courses.append(db_course.pk)
+            if slot_str not in slots[course.course_code]:
+                slots[course.course_code].append(slot_str)
+            if course.course_teacher_name and not teachers.get(course.course_code):
+                teachers[course.course_code] = course.course_teacher_name
+        if slots:
+            requests = []
+            for code, course_slots in slots.items():
+                # Defaults for new courses
+                defaults = self.CourseImpl(course_code=code, teacher_name=teachers.get(code, "")).to_mongo()
+                defaults.pop("known_slots", None)
+                requests.append(pymongo.UpdateOne({"course_code": code}, {
+                    "$setOnInsert": defaults,
+                    "$addToSet": {"known_slots": {"$each": course_slots}},
+                }, upsert=True))
+                # Make sure the teacher name is set
+                if teachers.get(code):
+                    requests.append(pymongo.UpdateOne({"course_code": code, "teacher_name": {"$in": ["", None]}},
+                                                      {"$set": {"teacher_name": teachers[code]}}))
+            try:
+                result = await self.CourseImpl.collection.bulk_write(requests, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                # Two upserts of a new course at once can conflict on the unique index; the retry finds it
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", ())):
+                    raise
+                result = await self.CourseImpl.collection.bulk_write(requests, ordered=False)
+            # New courses aren't cached yet, but new slots and teacher names have to replace the cached ones
+            if result.modified_count:
+                await self.config_cache.invalidate()
+            ids = {doc["course_code"]: doc["_id"] async for doc in self.CourseImpl.collection.find(
+                {"course_code": {"$in": list(slots)}}, projection={"course_code": True})}
+        else:
+            ids = {}
+        previous = list(user.courses or [])
+        new_courses = [] if clear_previous else list(previous)
+        for code in slots:
+            if code in ids and ids[code] not in new_courses:
+                new_courses.append(ids[code])
+        # Nothing to write if only adding courses the user already has (e.g. when filling a form)
+        if new_courses == previous and user.courses is not None and not user.is_modified():
+            return
+        user.courses = new_courses
         await user.commit()
 
+    async def _commit_credentials(self, user) -> None:
+        """
+        Commit an existing user whose credentials changed, with the credentials write concern.
+
+        Does the same as user.commit(), except umongo always uses the database's write concern.
+        """
+        if not user.is_modified():
+            return
+        user.required_validate()
+        try:
+            await self.UserImpl.collection.with_options(write_concern=mongo.CREDENTIALS_WRITE_CONCERN).update_one(
+                {"_id": user.pk}, user.to_mongo(update=True))
+        except pymongo.errors.DuplicateKeyError as e:
+            raise LockboxDBError("Invalid field: login is already used by another user", LockboxDBError.INVALID_FIELD) from e
+        user.clear_modified()
+
+    async def find_course_in_slot(self, user, slot: str):
+        """
+        Find which of a user's courses runs in a slot (f"{day}-{period}", see Course.known_slots), using stored data.
+
+        Returns the Course document, or None if none of them do. If several do, the first one in the user's
+        list of courses is returned.
+        """
+        if not user.courses:
+            return None
+        courses = await self.config_cache.get_courses(user.courses)
+        for course_id in user.courses:
+            if course_id in courses and slot in (courses[course_id].known_slots or ()):
+                return courses[course_id]
+        return None
+
     async def create_user(self) -> str:
         """
         Create a new user.
@@ -203,6 +384,7 @@ class LockboxDB:
         user = await self.UserImpl.find_one({"token": token})
         if user is None:
             raise LockboxDBError("Bad token", LockboxDBError.BAD_TOKEN)
+        previous_login = user.login
         try:
             if login is not None:
                 user.login = login
@@ -221,39 +403,43 @@ class LockboxDB:
             if user.login is not None and user.password is not None and (login is not None or password is not None):
                 logger.info(f"Verifying credentials for login {user.login}")
                 try:
-                    async with TDSBConnects() as session:
-                        await session.login(login, password)
+                    # Don't keep a session around for the previous login
+                    if previous_login is not None and previous_login != user.login:
+                        await self.tdsb_sessions.invalidate(previous_login)
+
+                    async def _verify(session: TDSBConnects):
                         info = await session.get_user_info()
                         schools = info.schools
                         if self.school_code is None:
                             if len(schools) != 1:
                                 logger.info(f"Login {user.login} has an invalid number of schools.")
                                 raise LockboxDBError(f"TDSB Connects reported {len(schools)} schools; nffu can only handle 1 school", LockboxDBError.OTHER)
-                            school = schools[0]
-                        else:
-                            for s in schools:
-                                if s.code == self.school_code:
-                                    school = s
-                                    break
-                            else:
-                                logger.info(f"Login {user.login} is not in the configured school")
-                                raise LockboxDBError(f"You do not appear to be in the school nffu was set up for (#{self.school_code}); nffu can only handle 1 school", LockboxDBError.OTHER)
-                        user.email = info.email
-                        # Try to get user grade, first name, and last name
-                        try:
-                            user.grade = int(info._data["SchoolCodeList"][0]["StudentInfo"]["CurrentGradeLevel"])
-                            # CurrentGradeLevel increments once per *calendar* year
-                            # So the value is off-by-one during the first half of the school year
-                            # School year is in the form XXXXYYYY, e.g. 20202021
-                            if not school.school_year.endswith(str(datetime.datetime.now().year)):
-                                user.grade += 1
-                        except (ValueError, KeyError, IndexError):
-                            pass
-                        try:
-                            user.first_name = info._data["SchoolCodeList"][0]["StudentInfo"]["FirstName"]
-                            user.last_name = info._data["SchoolCodeList"][0]["StudentInfo"]["LastName"]
-                        except (ValidationError, KeyError, IndexError):
-                            pass
+                            return info, schools[0]
+                        for s in schools:
+                            if s.code == self.school_code:
+                                return info, s
+                        logger.info(f"Login {user.login} is not in the configured school")
+                        raise LockboxDBError(f"You do not appear to be in the school nffu was set up for (#{self.school_code}); nffu can only handle 1 school", LockboxDBError.OTHER)
+
+                    info, school = await self.tdsb_sessions.run(user.login, self.fernet.decrypt(user.password).decode("utf-8"), _verify)
+                    user.email = info.email
+                    # Try to get user grade, first name, and last name
+                    try:
+                        user.grade = int(info._data["SchoolCodeList"][0]["StudentInfo"]["CurrentGradeLevel"])
+                        # CurrentGradeLevel increments once per *calendar* year
+                        # So the value is off-by-one during the first half of the school year
+                        # School year is in the form XXXXYYYY, e.g. 20202021
+                        if not school.school_year.endswith(str(datetime.datetime.now().year)):
+                            user.grade += 1
+                    except (ValueError, KeyError, IndexError):
+                        pass
+                    try:
+                        user.first_name = info._data["SchoolCodeList"][0]["StudentInfo"]["FirstName"]
+                        user.last_name = info._data["SchoolCodeList"][0]["StudentInfo"]["LastName"]
+                    except (ValidationError, KeyError, IndexError):
+                        pass
+                except tdsb.CircuitOpenError as e:
+                    raise LockboxDBError("TDSB Connects seems to be down right now; please try again later", LockboxDBError.OTHER) from e
                 except aiohttp.ClientResponseError as e:
                     logger.info(f"TDSB login error for login {user.login}")
                     # Invalid credentials, clean up and raise
@@ -261,7 +447,7 @@ class LockboxDB:
                         raise LockboxDBError("Incorrect TDSB credentials", LockboxDBError.INVALID_FIELD) from e
                     raise LockboxDBError(f"HTTP error while logging into TDSB Connects: {str(e)}") from e
                 # Now we know credentials are valid
-                await user.commit()
+                await self._commit_credentials(user)
                 logger.info(f"Credentials good for login {user.login}")
                 await self._scheduler.create_task(kind=documents.TaskType.POPULATE_COURSES, owner=user)
             else:
@@ -293,12 +479,87 @@ class LockboxDB:
 
     async def get_user(self, token: str) -> typing.Dict[str, typing.Any]:
         """
-        Get user data as a formatted dict.
+        Get user data as a formatted dict, in the format returned by GET /user.
+
+        Only the newest page of the user's errors is included, see get_user_errors().
         """
-        user = await self.UserImpl.find_one({"token": token})
-        if user is None:
-            raise LockboxDBError("Bad token", LockboxDBError.BAD_TOKEN)
-        return user.dump()
+        user = await self._find_user(token, _USER_INFO_PROJECTION)
+        user_id = user.pop("_id")
+        # Defaults (users created before these fields existed don't have them)
+        user.setdefault("active", True)
+        for field in ("last_fill_form_result", "grade", "first_name", "last_name"):
+            user.setdefault(field, None)
+        data = _serialize(user)
+        data["errors"] = await self._find_user_errors(user_id)
+        return data
+
+    async def get_user_courses(self, token: str) -> typing.Dict[str, typing.Any]:
+        """
+        Get whether a user's credentials are set and their course IDs (None if unset or pending).
+        """
+        user = await self._find_user(token, {"_id": 0, "courses": 1, "credentials_set": _CREDENTIALS_SET})
+        return _serialize({"credentials_set": user["credentials_set"], "courses": user.get("courses")})
+
+    async def _find_user_errors(self, user_id: bson.ObjectId, limit: typing.Optional[int] = None,
+                                before: typing.Optional[typing.Tuple[datetime.datetime, typing.Optional[bson.ObjectId]]] = None) -> typing.List[dict]:
+        """
+        Get a page of a user's errors, newest first, serialized like LockboxFailures.
+
+        before is the (time_logged, _id) of the last error of the previous page; only errors after it are returned.
+        Errors logged at the same time are ordered by id, so none are skipped between pages.
+        """
+        query = {"owner": user_id} # type: typing.Dict[str, typing.Any]
+        if before is not None:
+            before_time, before_id = before
+            if before_id is None:
+                query["time_logged"] = {"$lt": before_time}
+            else:
+                query["$or"] = [{"time_logged": {"$lt": before_time}}, {"time_logged": before_time, "_id": {"$lt": before_id}}]
+        cursor = self.UserErrorImpl.collection.find(query, {"owner": 0}).sort(
+            [("time_logged", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+        return [{
+            "_id": str(error["_id"]),
+            "time_logged": error["time_logged"].isoformat(),
+            "kind": error["kind"],
+            "message": error.get("message", ""),
+        } async for error in cursor.limit(limit or tasks.USER_ERRORS_PAGE_SIZE)]
+
+    async def get_user_errors(self, token: str, limit: typing.Optional[int] = None,
+                              before: typing.Optional[str] = None) -> typing.Dict[str, typing.Any]:
+        """
+        Get a page of a user's errors, newest first.
+
+        before is the value of next from the previous page (an ISO datetime string and error id joined by "_"); only
+        errors after that page are returned. A plain ISO datetime string returns the errors logged before it.
+        The returned dict has the errors, and the value of before for the next page (None if this is the last one).
+        """
+        user = await self._find_user(token, {"_id": 1})
+        if limit is not None and limit <= 0:
+            raise LockboxDBError("Invalid field: limit must be positive", LockboxDBError.INVALID_FIELD)
+        before_cursor = None
+        if before is not None:
+            before_time, _, before_id = before.partition("_")
+            try:
+                before_cursor = (datetime.datetime.fromisoformat(before_time), bson.ObjectId(before_id) if before_id else None)
+            except (ValueError, bson.errors.InvalidId) as e:
+                raise LockboxDBError(f"Invalid field: before: {e}", LockboxDBError.INVALID_FIELD) from e
+        limit = min(limit or tasks.USER_ERRORS_PAGE_SIZE, tasks.USER_ERROR_LIMIT)
+        errors = await self._find_user_errors(user["_id"], limit, before_cursor)
+        return {
+            "errors": errors,
+            "next": f"{errors[-1]['time_logged']}_{errors[-1]['_id']}" if len(errors) == limit else None,
+        }
+
+    async def add_user_error(self, user_id: bson.ObjectId, kind: documents.LockboxFailureType, message: str) -> None:
+        """
+        Add an error to a user's errors, deleting the oldest ones past USER_ERROR_LIMIT.
+        """
+        now = datetime.datetime.utcnow()
+        await self.UserErrorImpl.collection.insert_one({"owner": user_id, "time_logged": now, "kind": kind.value, "message": message})
+        # Find the oldest error to keep
+        async for oldest in self.UserErrorImpl.collection.find({"owner": user_id}, {"time_logged": 1}).sort(
+                "time_logged", pymongo.DESCENDING).skip(tasks.USER_ERROR_LIMIT - 1).limit(1):
+            await self.UserErrorImpl.collection.delete_many({"owner": user_id, "time_logged": {"$lt": oldest["time_logged"]}})
 
     async def delete_user(self, token: str) -> None:
         """
@@ -325,22 +586,70 @@ class LockboxDB:
             logger.info(f"Deleting fill form task for user {user.pk}")
             await task.remove()
             self._scheduler.update()
+        await self.FillPlanImpl.collection.delete_many({"owner": user.pk})
+        await self.UserErrorImpl.collection.delete_many({"owner": user.pk})
+        await self.FillHistoryImpl.collection.delete_many({"owner": user.pk})
         await user.remove()
 
     async def delete_user_error(self, token: str, eid: str) -> None:
         """
         Delete an error by id for a user.
         """
+        user = await self._find_user(token, {"_id": 1})
         try:
-            result = await self.UserImpl.collection.update_one({"token": token},
-                {"$pull": {"errors": {"_id": bson.ObjectId(eid)}}})
+            result = await self.UserErrorImpl.collection.delete_one({"_id": bson.ObjectId(eid), "owner": user["_id"]})
         except bson.errors.InvalidId as e:
             raise LockboxDBError("Bad error id") from e
-        if result.matched_count == 0:
-            raise LockboxDBError("Bad token", LockboxDBError.BAD_TOKEN)
-        if result.modified_count == 0:
+        if result.deleted_count == 0:
             raise LockboxDBError("Bad error id")
 
+    async def add_fill_history(self, user_id: bson.ObjectId, result, form_id: typing.Optional[bson.ObjectId] = None) -> None:
+        """
+        Record a fill form result (a FillFormResult document) in a user's fill history.
+
+        If form_id isn't given, the form config is looked up from the result's course.
+        """
+        if form_id is None and result.course is not None:
+            course = await self.config_cache.get_course(result.course)
+            form_id = course.form_config.pk if course is not None and course.form_config is not None else None
+        time_logged = result.time_logged
+        # Losing one of these is fine, so don't wait for it
+        await self.FillHistoryImpl.collection.with_options(write_concern=mongo.METRICS_WRITE_CONCERN).update_one({
+            "owner": user_id,
+            "month": datetime.datetime(time_logged.year, time_logged.month, 1),
+        }, {
+            "$push": {"fills": {"time_logged": time_logged, "result": result.result, "course": result.course, "form": form_id}},
+            "$inc": {"count": 1},
+        }, upsert=True)
+
+    async def get_fill_stats(self, days: int, by: str) -> typing.List[dict]:
+        """
+        Get the number of fill form results of each type per day (UTC) for the last few days, by course or form.
+
+        by is either "course" or "form".
+        Returns a list of dicts with the date, the course or form id, and the count of each result type, sorted by date.
+        """
+        if by not in ("course", "form"):
+            raise LockboxDBError("Invalid field: by must be course or form", LockboxDBError.INVALID_FIELD)
+        if days <= 0:
+            raise LockboxDBError("Invalid field: days must be positive", LockboxDBError.INVALID_FIELD)
+        start = datetime.datetime.combine(datetime.datetime.utcnow().date() - datetime.timedelta(days=days - 1), datetime.time())
+        pipeline = [
+            {"$match": {"month": {"$gte": datetime.datetime(start.year, start.month, 1)}}},
+            {"$unwind": "$fills"},
+            {"$match": {"fills.time_logged": {"$gte": start}}},
+            {"$group": {
+                "_id": {"date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$fills.time_logged"}}, by: f"$fills.{by}"},
+                **{kind.value: {"$sum": {"$cond": [{"$eq": ["$fills.result", kind.value]}, 1, 0]}} for kind in documents.FillFormResultType},
+            }},
+            {"$sort": {"_id.date": 1}},
+        ]
+        stats = []
+        async for group in self.FillHistoryImpl.collection.aggregate(pipeline):
+            key = group.pop("_id")
+            stats.append({"date": key["date"], by: str(key[by]) if key.get(by) is not None else None, **group})
+        return stats
+
     async def update_user_courses(self, token: str) -> None:
         """
         Refresh the detected courses for a user.
@@ -358,47 +667,128 @@ class LockboxDB:
             raise LockboxDBError("Internal server error: Cannot decrypt password", LockboxDBError.INTERNAL_ERROR) from e
         await self._scheduler.create_task(kind=documents.TaskType.POPULATE_COURSES, owner=user)
 
+    async def schedule_populate_courses(self, user, run_at: typing.Optional[datetime.datetime] = None,
+                                        argument: typing.Optional[str] = None) -> None:
+        """
+        Schedule a populate courses task for a user.
+        """
+        await self._scheduler.create_task(documents.TaskType.POPULATE_COURSES, run_at, user, argument)
+
     async def update_all_courses(self) -> None:
         """
         Refresh the detected courses for ALL users.
+
+        This starts the update all courses task, which refreshes users in batches sized based on how well
+        TDSB Connects is keeping up. Courses are only rebuilt for users whose timetables changed.
         """
-        batch_size = 3
-        if os.environ.get("LOCKBOX_UPDATE_COURSES_BATCH_SIZE"):
-            try:
-                b = int(os.environ["LOCKBOX_UPDATE_COURSES_BATCH_SIZE"])
-                if b < 1:
-                    raise ValueError("Batch size cannot be less than 1")
-                batch_size = b
-            except ValueError as e:
-                logger.error(f"Update all courses: Invalid batch size specified by env var (defaulted to {batch_size}): {e}")
-        interval = 60
-        if os.environ.get("LOCKBOX_UPDATE_COURSES_INTERVAL"):
-            try:
-                i = int(os.environ["LOCKBOX_UPDATE_COURSES_INTERVAL"])
-                if i < 0:
-                    raise ValueError("Interval cannot be less than 0")
-                interval = i
-            except ValueError as e:
-                logger.error(f"Update all courses: Invalid interval specified by env var (defaulted to {interval}s): {e}")
-        run_at = datetime.datetime.utcnow()
-        batch = 0
-        async for user in self.UserImpl.find({"login": {"$ne": None}, "password": {"$ne": None}}):
-            await self._scheduler.create_task(documents.TaskType.POPULATE_COURSES, run_at, user)
-            batch += 1
-            if batch >= batch_size:
-                batch = 0
-                run_at += datetime.timedelta(seconds=interval)
+        if await self.TaskImpl.find_one({"kind": documents.TaskType.UPDATE_ALL_COURSES.value}) is not None:
+            raise LockboxDBError("Already updating all courses", LockboxDBError.STATE_CONFLICT)
+        total = await self.UserImpl.collection.count_documents({"login": {"$ne": None}, "password": {"$ne": None}})
+        await self.CourseRefreshImpl.collection.delete_many({})
+        refresh = self.CourseRefreshImpl(time_started=datetime.datetime.utcnow(), total=total,
+                                         batch_size=float(min(tasks.UPDATE_COURSES_BATCH_SIZE, tasks.UPDATE_COURSES_MAX_BATCH_SIZE)))
+        await refresh.commit()
+        await self._scheduler.create_task(documents.TaskType.UPDATE_ALL_COURSES)
+
+    async def get_update_all_courses_progress(self) -> typing.Optional[dict]:
+        """
+        Get the serialized progress of the last refresh of all users' courses, or None if there wasn't one.
+
+        The ETA is estimated from the current batch size and interval (or the time a batch takes, if that's longer).
+        """
+        refresh = await self.CourseRefreshImpl.find_one()
+        if refresh is None:
+            return None
+        data = refresh.dump()
+        for key in ("id", "last_user", "latency"):
+            data.pop(key, None)
+        data["batch_size"] = int(refresh.batch_size)
+        data["eta"] = None
+        if refresh.time_finished is None:
+            remaining = max(refresh.total - refresh.done - refresh.failed, 0)
+            batches = -(-remaining // int(refresh.batch_size))
+            # Users in a batch are refreshed up to UPDATE_COURSES_CONCURRENCY at a time
+            rounds = -(-int(refresh.batch_size) // tasks.UPDATE_COURSES_CONCURRENCY)
+            batch_time = max(tasks.UPDATE_COURSES_INTERVAL, (refresh.latency or 0) * rounds)
+            data["eta"] = (datetime.datetime.utcnow() + datetime.timedelta(seconds=batches * batch_time)).isoformat()
+        return data
+
+    async def get_screenshot_sweep_progress(self) -> typing.Optional[dict]:
+        """
+        Get the serialized progress of the last run of the sweep screenshots task, or None if it never ran.
+        """
+        sweep = await self.ScreenshotSweepImpl.find_one()
+        if sweep is None:
+            return None
+        data = sweep.dump()
+        data.pop("id", None)
+        return data
+
+    def _form_geometry_revalidation_due(self, geom) -> bool:
+        """
+        Check whether a cached form geometry should be revalidated, i.e. it wasn't in the last
+        FORM_GEOMETRY_REVALIDATE_INTERVAL. Pending and failed results are never revalidated.
+        """
+        if geom.geometry is None or geom.response_status is not None:
+            return False
+        return geom.time_validated is None or \
+            datetime.datetime.utcnow() - geom.time_validated >= datetime.timedelta(seconds=tasks.FORM_GEOMETRY_REVALIDATE_INTERVAL)
+
+    def _form_geometry_expired(self, geom) -> bool:
+        """
+        Check whether a cached form geometry that can't be fingerprinted is older than FORM_GEOMETRY_MAX_AGE.
+        """
+        return geom.time_fetched is None or \
+            datetime.datetime.utcnow() - geom.time_fetched >= datetime.timedelta(seconds=tasks.FORM_GEOMETRY_MAX_AGE)
+
+    async def revalidate_form_geometry(self, geom_id: bson.ObjectId) -> None:
+        """
+        Check whether a cached form geometry is still up to date, and remove it if it isn't.
+
+        Compares the form's structural fingerprint to the stored one, which only needs a plain HTTP request.
+        If the form can no longer be fingerprinted, the geometry is removed after FORM_GEOMETRY_MAX_AGE instead.
+        Run by the revalidate form geometry task, so requests for the geometry don't wait for the form to be fetched.
+        """
+        geom = await self.CachedFormGeometryImpl.find_one({"_id": geom_id})
+        if geom is None or geom.fingerprint is None or not self._form_geometry_revalidation_due(geom):
+            return
+        try:
+            fingerprint = await formdef.get_form_fingerprint(geom.url, self.http.session)
+        except aiohttp.ClientError as e:
+            # Keep using the cached result, it'll be revalidated after the next request
+            logger.warning(f"Failed to revalidate form geometry for {geom.url}: {e}")
+            return
+        if fingerprint is None:
+            if self._form_geometry_expired(geom):
+                logger.info(f"Form geometry for {geom.url} can't be fingerprinted anymore and is outdated")
+                await geom.remove()
+            return
+        if fingerprint != geom.fingerprint:
+            logger.info(f"Form fingerprint changed for {geom.url}")
+            await geom.remove()
+            return
+        geom.time_validated = datetime.datetime.utcnow()
+        await geom.commit()
 
     async def get_form_geometry(self, token: str, url: str, grab_screenshot: bool) -> dict:
         """
         Get the form geometry for a given form URL.
         """
-        user = await self.UserImpl.find_one({"token": token})
-        if user is None:
-            raise LockboxDBError("Bad token", LockboxDBError.BAD_TOKEN)
-        if user.login is None or user.password is None:
+        user = await self._find_user(token, {"credentials_set": _CREDENTIALS_SET})
+        if not user["credentials_set"]:
             raise LockboxDBError("Cannot sign into form: Missing credentials", LockboxDBError.STATE_CONFLICT)
         geom = await self.CachedFormGeometryImpl.find_one({"url": url})
+        # Make sure a cached result is still up to date
+        if geom is not None and self._form_geometry_revalidation_due(geom):
+            if geom.fingerprint is None:
+                # The form can't be checked without a browser, so fall back to age
+                if self._form_geometry_expired(geom):
+                    logger.info(f"Form geometry for {url} is outdated")
+                    await geom.remove()
+                    geom = None
+            # Keep returning the cached result until the task finds it's outdated
+            elif await self.TaskImpl.find_one({"kind": documents.TaskType.REVALIDATE_FORM_GEOMETRY.value, "argument": str(geom.pk)}) is None:
+                await self._scheduler.create_task(documents.TaskType.REVALIDATE_FORM_GEOMETRY, argument=str(geom.pk))
         # Check if screenshot requirement is satisfied
         if geom is not None and grab_screenshot:
             screenshot_valid = False
@@ -418,14 +808,13 @@ class LockboxDB:
                 await geom.remove()
             # Re-make the geometry
             try:
-                geom = self.CachedFormGeometryImpl(url=url, requested_by=token, geometry=None, grab_screenshot=grab_screenshot)
+                # Expires unless it succeeds
+                geom = self.CachedFormGeometryImpl(url=url, requested_by=token, geometry=None, grab_screenshot=grab_screenshot,
+                    expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=tasks.FORM_GEOMETRY_PENDING_TTL))
             except ValidationError as e:
                 raise LockboxDBError(f"Invalid field: {e}", LockboxDBError.INVALID_FIELD) from e
             await geom.commit()
-            # Create tasks to get form geometry and clean up
-            await self._scheduler.create_task(documents.TaskType.GET_FORM_GEOMETRY, owner=user, argument=str(geom.pk))
-            await self._scheduler.create_task(documents.TaskType.REMOVE_OLD_FORM_GEOMETRY,
-                datetime.datetime.utcnow() + datetime.timedelta(minutes=15), owner=user, argument=str(geom.pk))
+            await self._scheduler.create_task(documents.TaskType.GET_FORM_GEOMETRY, owner=user["_id"], argument=str(geom.pk))
             return {"geometry": None, "auth_required": None, "screenshot_id": None}
         # Result pending
         if geom.geometry is None and geom.response_status is None:
@@ -455,8 +844,8 @@ class LockboxDB:
         Start filling in a test form
         """
 
-        user = await self.UserImpl.find_one({"token": token})
-        if user is None:
-            raise LockboxDBError("Bad token", LockboxDBError.BAD_TOKEN)
-        await self._scheduler.create_task(kind=documents.TaskType.TEST_FILL_FORM, owner=user, argument=oid)
-        await self._scheduler.create_task(run_at=datetime.datetime.utcnow() + datetime.timedelta(hours=6), kind=documents.TaskType.REMOVE_OLD_TEST_RESULTS, argument=oid)
+        user = await self._find_user(token, {"_id": 1})
+        # The result is removed by MongoDB after a while
+        await self.FormFillingTestImpl.collection.update_one({"_id": bson.ObjectId(oid)}, {"$set": {
+            "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=tasks.TEST_RESULT_TTL)}})
+        await self._scheduler.create_task(kind=documents.TaskType.TEST_FILL_FORM, owner=user["_id"], argument=oid)
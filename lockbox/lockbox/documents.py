@@ -5,6 +5,7 @@ umongo document definitions for the private and shared databases for lockbox.
 import bson
 import enum
 from marshmallow import fields as ma_fields
+from pymongo import ASCENDING, IndexModel
 from umongo import Document, EmbeddedDocument, fields, validate
 
 class BinaryField(fields.BaseField, ma_fields.Field):
@@ -102,11 +103,69 @@ class User(Document): # pylint: disable=abstract-method
     email = fields.EmailField(required=False, allow_none=True)
 
     active = fields.BoolField(default=True)
-    errors = fields.ListField(fields.EmbeddedField(LockboxFailure), default=[])
     last_fill_form_result = fields.EmbeddedField(FillFormResult, default=None, allow_none=True)
     grade = fields.IntField(required=False, allow_none=True, default=None)
     first_name = fields.StrField(required=False, allow_none=True, default=None, validate=lambda s: s is None or len(s))
     last_name = fields.StrField(required=False, allow_none=True, default=None, validate=lambda s: s is None or len(s))
+    # Fingerprint of the user's full timetable (see tdsb.timetable_fingerprint()) when courses were last populated
+    # Used to skip rebuilding courses when nothing changed
+    timetable_hash = fields.StrField(required=False, allow_none=True, default=None)
+    # Last time the check day task succeeded using this user's credentials
+    # Users that worked recently are tried first
+    check_day_succeeded_at = fields.DateTimeField(required=False, allow_none=True, default=None)
+
+
+class FillHistoryEntry(EmbeddedDocument): # pylint: disable=abstract-method
+    """
+    One fill form result in a user's fill history.
+    """
+
+    time_logged = fields.DateTimeField(required=True)
+    result = fields.StrField(required=True, validate=validate.OneOf([x.value for x in FillFormResultType]))
+    # The course and form config filled in (null if it failed before they were known)
+    course = fields.ObjectIdField(required=False, allow_none=True, default=None)
+    form = fields.ObjectIdField(required=False, allow_none=True, default=None)
+
+
+class FillHistory(Document): # pylint: disable=abstract-method
+    """
+    The fill form results of a user in one month (a bucket).
+
+    Results are pushed onto the bucket as they happen, so recording one is a single write,
+    and the success rate over time is found without scanning logs (see LockboxDB.get_fill_stats()).
+    """
+
+    owner = fields.ObjectIdField(required=True)
+    # Midnight on the first of the month (UTC)
+    month = fields.DateTimeField(required=True)
+    fills = fields.ListField(fields.EmbeddedField(FillHistoryEntry), default=[])
+    count = fields.IntField(default=0)
+
+    class Meta:
+        indexes = [
+            IndexModel([("owner", ASCENDING), ("month", ASCENDING)], unique=True),
+            # Buckets in a time range, for stats
+            "month",
+        ]
+
+
+class UserError(Document): # pylint: disable=abstract-method
+    """
+    A lockbox failure reported to a user, e.g. by the fill form task.
+
+    Kept in their own collection instead of on the user, so the user document stays small and new errors can be
+    inserted without rewriting it. Only the newest USER_ERROR_LIMIT errors (see tasks.py) are kept for each user.
+    Serialized in the same format as LockboxFailure.
+    """
+
+    owner = fields.ObjectIdField(required=True)
+    time_logged = fields.DateTimeField(required=True)
+    kind = fields.StrField(required=True, validate=validate.OneOf([x.value for x in LockboxFailureType]))
+    message = fields.StrField(required=False, default="")
+
+    class Meta:
+        # A user's errors, newest first (by id for errors logged at the same time)
+        indexes = [["owner", "-time_logged", "-_id"]]
 
 
 class TaskType(enum.Enum):
@@ -118,9 +177,15 @@ class TaskType(enum.Enum):
     CHECK_DAY = "check-day"
     POPULATE_COURSES = "populate-courses"
     TEST_FILL_FORM = "test-fill-form"
+    # No longer scheduled (test results and form geometry expire through TTL indexes)
+    # kept so that tasks left over in the database still run
     REMOVE_OLD_TEST_RESULTS = "remove-old-test-result"
     GET_FORM_GEOMETRY = "get-form-geometry"
     REMOVE_OLD_FORM_GEOMETRY = "remove-old-form-geometry"
+    PREFETCH_FILL_PLANS = "prefetch-fill-plans"
+    UPDATE_ALL_COURSES = "update-all-courses"
+    SWEEP_SCREENSHOTS = "sweep-screenshots"
+    REVALIDATE_FORM_GEOMETRY = "revalidate-form-geometry"
 
 
 class Task(Document): # pylint: disable=abstract-method
@@ -137,6 +202,16 @@ class Task(Document): # pylint: disable=abstract-method
     retry_count = fields.IntField(default=0)
     argument = fields.StrField(default="")
 
+    class Meta:
+        indexes = [
+            # The scheduler's next task to run
+            ["is_running", "next_run_at"],
+            # Tasks of a kind (e.g. a user's fill form task)
+            ["kind", "owner"],
+            # Tasks of a kind running in a time range (e.g. today's fill form tasks)
+            ["kind", "next_run_at"],
+        ]
+
 
 class FormFieldType(enum.Enum):
     """
@@ -196,6 +271,10 @@ class Form(Document): # pylint: disable=abstract-method
     # is this form the default?
     is_default = fields.BoolField(default=False)
 
+    class Meta:
+        # Finding forms sharing a thumbnail (before deleting it)
+        indexes = ["representative_thumbnail"]
+
 
 class Course(Document): # pylint: disable=abstract-method
     """
@@ -229,6 +308,13 @@ class Course(Document): # pylint: disable=abstract-method
     # Teacher name
     teacher_name = fields.StrField(default="")
 
+    class Meta:
+        indexes = [
+            # Courses using a form or form config
+            "form_url",
+            "form_config",
+        ]
+
 
 class FormGeometryEntry(EmbeddedDocument): # pylint: disable=abstract-method
     """
@@ -253,10 +339,106 @@ class CachedFormGeometry(Document): # pylint: disable=abstract-method
     auth_required = fields.BoolField(required=False, allow_none=True)
     screenshot_file_id = fields.ObjectIdField(required=False, allow_none=True)
     grab_screenshot = fields.BoolField(default=False)
+    # Structural fingerprint of the form, as computed by formdef
+    # null if the form cannot be fingerprinted without a browser (e.g. it needs sign in)
+    fingerprint = fields.StrField(required=False, allow_none=True, default=None)
+    # Time the geometry was extracted, and the last time it was confirmed to be up to date
+    time_fetched = fields.DateTimeField(required=False, allow_none=True, default=None)
+    time_validated = fields.DateTimeField(required=False, allow_none=True, default=None)
 
     response_status = fields.IntField(required=False)
     error = fields.StrField(required=False)
 
+    # Pending and failed results are removed by MongoDB at this time
+    # null for successful results, which are kept as a cache
+    expires_at = fields.DateTimeField(required=False, allow_none=True, default=None)
+
+    class Meta:
+        indexes = [IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)]
+
+
+class FillPlan(Document): # pylint: disable=abstract-method
+    """
+    Everything needed to fill in a user's form for a day, prepared ahead of time by the prefetch fill plans task.
+
+    Used by the fill form task instead of getting the info from TDSB Connects and working out the field values.
+    """
+
+    owner = fields.ReferenceField(User, required=True, unique=True)
+    # Date the plan is for (at midnight, local time)
+    date = fields.DateTimeField(required=True)
+    # Course to fill the form for, null if there's nothing to fill that day
+    course = fields.ObjectIdField(required=False, allow_none=True, default=None)
+    # Hash of the inputs used to compute the field values (form config and user overrides)
+    # The plan is stale if this no longer matches
+    inputs_hash = fields.StrField(required=False, allow_none=True, default=None)
+    # Dicts of {index, title, kind, value, critical} for each field to fill
+    components = fields.ListField(fields.DictField(), default=[])
+    # Dicts of {kind, message} for each warning found while preparing the plan, reported when the form is filled
+    # kind is a LockboxFailureType value
+    warnings = fields.ListField(fields.DictField(), default=[])
+    time_created = fields.DateTimeField(required=True)
+
+
+class CourseRefresh(Document): # pylint: disable=abstract-method
+    """
+    Progress of refreshing all users' courses, used by the update all courses task.
+
+    There is only ever one of these; starting a new refresh replaces it.
+    """
+
+    time_started = fields.DateTimeField(required=True)
+    # Null while the refresh is in progress
+    time_finished = fields.DateTimeField(required=False, allow_none=True, default=None)
+    # Users are refreshed in order of id; this is the id of the last user refreshed
+    last_user = fields.ObjectIdField(required=False, allow_none=True, default=None)
+    # Number of users to refresh in total, and refreshed so far (not counting the failed ones)
+    total = fields.IntField(required=True)
+    done = fields.IntField(default=0)
+    # Number of users whose courses changed, and who couldn't be refreshed (these are retried separately)
+    changed = fields.IntField(default=0)
+    failed = fields.IntField(default=0)
+    # Current number of users refreshed per batch (a float so it can be halved)
+    batch_size = fields.FloatField(required=True)
+    # Moving average of the time taken to refresh one user, in seconds
+    latency = fields.FloatField(required=False, allow_none=True, default=None)
+
+
+class ScreenshotSweep(Document): # pylint: disable=abstract-method
+    """
+    Progress of the last run of the sweep screenshots task, which deletes the GridFS files no document refers to.
+
+    There is only ever one of these; each run replaces it.
+    """
+
+    time_started = fields.DateTimeField(required=True)
+    # Null while the sweep is in progress
+    time_finished = fields.DateTimeField(required=False, allow_none=True, default=None)
+    # Number of files referred to by documents (null while they're being found)
+    referenced = fields.IntField(required=False, allow_none=True, default=None)
+    # Number of files old enough to be deleted checked so far, and how many of them were deleted
+    scanned = fields.IntField(default=0)
+    deleted = fields.IntField(default=0)
+    bytes_freed = fields.IntField(default=0)
+    # Number of chunks deleted that didn't belong to a file
+    orphaned_chunks = fields.IntField(default=0)
+
+
+class SchoolCalendar(Document): # pylint: disable=abstract-method
+    """
+    The day cycle calendar of a school.
+
+    Since it's the same for every student in the school, it's shared and refreshed daily by the check day task.
+    """
+
+    school_code = fields.IntField(required=True, unique=True)
+    # Date of the first entry in days (at midnight)
+    start = fields.DateTimeField(required=True)
+    # Day cycle names for each day from start, as returned by TDSB Connects ("D<N>" for school days, "D" otherwise)
+    days = fields.ListField(fields.StrField(), default=[])
+    time_fetched = fields.DateTimeField(required=True)
+
+
 class FormFillingTest(Document): # pylint: disable=abstract-method
     """
     Represents finished/inprogress tests of form filling
@@ -277,3 +459,13 @@ class FormFillingTest(Document): # pylint: disable=abstract-method
     # results
     errors = fields.ListField(fields.EmbeddedField(LockboxFailure), default=[])
     fill_result = fields.EmbeddedField(FillFormResult, default=None, allow_none=True)
+
+    # Removed by MongoDB at this time, set when the test is started
+    expires_at = fields.DateTimeField(required=False, allow_none=True, default=None)
+
+    class Meta:
+        indexes = [
+            # A user's tests of a course config, newest first
+            ["course_config", "requested_by", "-time_executed"],
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        ]
@@ -0,0 +1,86 @@
+"""
+Lightweight (browser-free) access to Google Forms form definitions.
+
+Google Forms embeds the structure of a form in the page as a JS variable (FB_PUBLIC_LOAD_DATA_).
+This is used to cheaply check whether a form has changed without having to spin up a browser.
+"""
+
+import aiohttp
+import hashlib
+import json
+import logging
+import re
+import typing
+
+
+logger = logging.getLogger("formdef")
+
+
+_LOAD_DATA_RE = re.compile(r"var\s+FB_PUBLIC_LOAD_DATA_\s*=\s*(.*?);\s*</script>", re.DOTALL)
+
+
+def extract_form_items(page: str) -> typing.Optional[typing.List[list]]:
+    """
+    Extract the raw list of form items from the HTML of a Google Forms page.
+
+    Returns None if the page does not contain a form definition (e.g. it is a login page).
+    """
+    match = _LOAD_DATA_RE.search(page)
+    if match is None:
+        return None
+    try:
+        data = json.loads(match.group(1))
+        items = data[1][1]
+    except (ValueError, IndexError, TypeError):
+        return None
+    return items if isinstance(items, list) else None
+
+
+def compute_fingerprint(items: typing.List[list]) -> str:
+    """
+    Compute a structural fingerprint of a list of raw form items.
+
+    Only the parts of the form that affect filling are included, i.e. the order, titles and kinds of items
+    and the labels of their options. Things like descriptions or the form title are ignored.
+    """
+    structure = []
+    for item in items:
+        try:
+            title, kind = item[1], item[3]
+            answers = item[4] if len(item) > 4 and isinstance(item[4], list) else []
+            options = [[opt[0] for opt in (answer[1] or ())] if len(answer) > 1 and isinstance(answer[1], list) else []
+                       for answer in answers]
+        except (IndexError, TypeError):
+            # Unknown item format; hash it as is so that changes are still detected
+            title, kind, options = None, None, item
+        structure.append([title, kind, options])
+    return hashlib.sha256(json.dumps(structure, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+async def get_form_fingerprint(url: str, session: aiohttp.ClientSession = None) -> typing.Optional[str]:
+    """
+    Fetch a form with a plain HTTP request and compute its structural fingerprint.
+
+    If session is provided, it will be used for the request. Otherwise, a new session will be created.
+
+    Returns None if the fingerprint cannot be determined without a browser (e.g. the form requires sign in).
+    Raises an aiohttp.ClientError if the request fails.
+    """
+    provided = session is not None
+    if not provided:
+        session = aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar())
+    try:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            resp.raise_for_status()
+            # Forms that need sign in redirect to the google login page
+            if "accounts.google.com" in str(resp.url):
+                return None
+            page = await resp.text()
+    finally:
+        if not provided:
+            await session.close()
+    items = extract_form_items(page)
+    if items is None:
+        logger.info(f"No form definition found for {url}")
+        return None
+    return compute_fingerprint(items)
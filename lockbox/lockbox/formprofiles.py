@@ -0,0 +1,205 @@
+"""
+Selector profiles for matching Google Forms markup.
+
+A profile holds the CSS selectors ghoster needs for one version of the Google Forms markup.
+Profiles are plain data, so when Google changes its markup only a profile needs to be added or updated.
+Each profile is compiled once into one script per operation, so matching a page is always a single
+round trip to the browser instead of one lookup per selector.
+
+Extra profiles can be loaded from a JSON file containing a list of profiles in the same format as
+BUILTIN_PROFILES, set with LOCKBOX_FORM_PROFILES_FILE. These are tried before the built-in ones.
+"""
+
+import json
+import logging
+import os
+import typing
+from .documents import FormFieldType
+
+
+logger = logging.getLogger("ghoster")
+
+
+BUILTIN_PROFILES = [
+    {
+        "name": "freebird",
+        "version": 1,
+        # Only present once the form is completely loaded; also used to detect the profile
+        "submit": ".freebirdFormviewerViewNavigationSubmitButton",
+        # Items on the page (includes headings)
+        "item": ".freebirdFormviewerViewItemList .freebirdFormviewerViewNumberedItemContainer",
+        # Present in an item only if it's a question
+        "question": ".freebirdFormviewerComponentsQuestionBaseRoot",
+        "title": ".freebirdFormviewerComponentsQuestionBaseTitle",
+        "email": ".freebirdFormviewerViewHeaderEmailAddress",
+        # Rules for detecting the kind of a question, tried in order
+        # A rule matches if the item contains root, and root contains require (if given)
+        "kinds": [
+            {"kind": "text", "root": ".freebirdFormviewerComponentsQuestionTextRoot", "require": ".quantumWizTextinputPaperinputInput"},
+            {"kind": "long-text", "root": ".freebirdFormviewerComponentsQuestionTextRoot", "require": ".quantumWizTextinputPapertextareaInput"},
+            {"kind": "multiple-choice", "root": ".freebirdFormviewerComponentsQuestionRadioRoot", "require": ".freebirdFormviewerViewItemsRadiogroupRadioGroup"},
+            {"kind": "date", "root": ".freebirdFormviewerComponentsQuestionDateInputsContainer"},
+            {"kind": "checkbox", "root": ".freebirdFormviewerComponentsQuestionCheckboxRoot"},
+            {"kind": "dropdown", "root": ".freebirdFormviewerComponentsQuestionSelectRoot"},
+        ],
+        # Elements in an item to interact with when filling it in, by kind
+        # text and long-text: the input; date: the month, day and year inputs (told apart by their min/max);
+        # multiple-choice and checkbox: one per option; dropdown: the element that opens the popup
+        "targets": {
+            "text": "input.quantumWizTextinputPaperinputInput",
+            "long-text": "textarea.quantumWizTextinputPapertextareaInput",
+            "date": "input.quantumWizTextinputPaperinputInput",
+            "multiple-choice": ".docssharedWizToggleLabeledLabelWrapper",
+            "checkbox": ".quantumWizTogglePapercheckboxInnerBox",
+            "dropdown": ".quantumWizMenuPaperselectDropDown",
+        },
+        # Options in an opened dropdown popup (in the item), including the "Choose" placeholder
+        "dropdown_option": ".exportSelectPopup .quantumWizMenuPaperselectOption",
+    },
+]
+
+_REQUIRED_KEYS = ("name", "version", "submit", "item", "question", "title", "email", "kinds", "targets", "dropdown_option")
+
+
+_DETECT_SCRIPT = """
+const profiles = %s;
+for (const [name, submit] of profiles) {
+    if (document.querySelector(submit)) {
+        return name;
+    }
+}
+return null;
+"""
+
+_SCAN_SCRIPT = """
+const profile = %s;
+return Array.from(document.querySelectorAll(profile.item), (item) => {
+    const title = item.querySelector(profile.title);
+    let kind = null;
+    if (item.querySelector(profile.question)) {
+        for (const rule of profile.kinds) {
+            const root = item.querySelector(rule.root);
+            if (root && (!rule.require || root.querySelector(rule.require))) {
+                kind = rule.kind;
+                break;
+            }
+        }
+    }
+    return [title ? title.innerText.trim() : null, kind];
+});
+"""
+
+_TARGETS_SCRIPT = """
+const profile = %s;
+const [index, kind] = arguments;
+const item = document.querySelectorAll(profile.item)[index];
+if (!item || !profile.targets[kind]) {
+    return null;
+}
+const targets = Array.from(item.querySelectorAll(profile.targets[kind]));
+if (kind === "date") {
+    const month = targets.find((e) => e.getAttribute("max") === "12");
+    const day = targets.find((e) => e.getAttribute("max") === "31");
+    const year = targets.find((e) => parseInt(e.getAttribute("min")) >= 1000);
+    return month && day && year ? [month, day, year] : [];
+}
+return targets;
+"""
+
+_DROPDOWN_OPTIONS_SCRIPT = """
+const profile = %s;
+const item = document.querySelectorAll(profile.item)[arguments[0]];
+return item ? Array.from(item.querySelectorAll(profile.dropdown_option)) : [];
+"""
+
+_REDACT_EMAIL_SCRIPT = """
+const profile = %s;
+const email = document.querySelector(profile.email);
+if (!email) {
+    return false;
+}
+email.innerText = "<redacted>";
+return true;
+"""
+
+
+class FormProfile:
+    """
+    A compiled selector profile.
+
+    Each script is run with browser.execute_script():
+        - scan_script: No arguments. Returns [title, kind] for each item on the page, where title is null if
+          the item has no title and kind is a FormFieldType value, or null if the item isn't a known question.
+        - targets_script: Arguments are (item index, FormFieldType value). Returns the elements to interact with
+          (see BUILTIN_PROFILES), an empty list if they're missing, or null if the item doesn't exist.
+        - dropdown_options_script: Argument is the item index. Returns the options of the opened dropdown popup.
+        - redact_email_script: No arguments. Redacts the email shown on the page and returns whether it was found.
+    """
+
+    __slots__ = ("name", "version", "submit", "scan_script", "targets_script", "dropdown_options_script", "redact_email_script")
+
+    def __init__(self, data: typing.Dict[str, typing.Any]):
+        self.name = data["name"]
+        self.version = data["version"]
+        self.submit = data["submit"]
+        encoded = json.dumps(data)
+        self.scan_script = _SCAN_SCRIPT % encoded
+        self.targets_script = _TARGETS_SCRIPT % encoded
+        self.dropdown_options_script = _DROPDOWN_OPTIONS_SCRIPT % encoded
+        self.redact_email_script = _REDACT_EMAIL_SCRIPT % encoded
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
+
+def _validate(data: typing.Any) -> None:
+    """
+    Check that a profile has everything needed. Raises ValueError if not.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Profile is not an object")
+    for key in _REQUIRED_KEYS:
+        if key not in data:
+            raise ValueError(f"Profile missing key '{key}'")
+    for rule in data["kinds"]:
+        FormFieldType(rule["kind"])
+    for kind in data["targets"]:
+        FormFieldType(kind)
+
+
+def _load_profiles() -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Load the profiles from LOCKBOX_FORM_PROFILES_FILE (if set) followed by the built-in ones.
+
+    Invalid profiles are logged and skipped.
+    """
+    profiles = []
+    path = os.environ.get("LOCKBOX_FORM_PROFILES_FILE")
+    if path:
+        try:
+            with open(path, "r") as f:
+                extra = json.load(f)
+            if not isinstance(extra, list):
+                raise ValueError("File must contain a list of profiles")
+            profiles.extend(extra)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot load form profiles from {path}: {e}")
+    profiles.extend(BUILTIN_PROFILES)
+    valid = []
+    for data in profiles:
+        try:
+            _validate(data)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Ignoring invalid form profile {data.get('name') if isinstance(data, dict) else data!r}: {e}")
+            continue
+        valid.append(data)
+    return valid
+
+
+PROFILES = {} # type: typing.Dict[str, FormProfile]
+for _data in _load_profiles():
+    # Profiles from the file override built-in ones with the same name
+    if _data["name"] not in PROFILES:
+        PROFILES[_data["name"]] = FormProfile(_data)
+# Profiles are checked in order; the first one whose submit button is on the page is used
+DETECT_SCRIPT = _DETECT_SCRIPT % json.dumps([[profile.name, profile.submit] for profile in PROFILES.values()])
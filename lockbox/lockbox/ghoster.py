@@ -10,26 +10,214 @@ from selenium.webdriver.firefox.options import Options
 from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.keys import Keys
-from typing import Any, List, Tuple
+from typing import List, Optional, Tuple
 
+from . import formprofiles
 from .documents import FormFieldType
 import collections
+import contextlib
 import datetime
 import enum
 import logging
+import os
+import resource
+import time
 
 logger = logging.getLogger("ghoster")
 
+# Resource budgeting, see the package docs for details
+FIREFOX_MAX_CONCURRENT = 3
+FIREFOX_MEMORY_ESTIMATE = 300 * 1024 * 1024 # bytes
+FIREFOX_MEMORY_LIMIT = None # bytes
+FIREFOX_CPU_QUOTA = None # fraction of a cpu
+FIREFOX_NICE = None
+FIREFOX_CGROUP = None
+
+if os.environ.get("LOCKBOX_FIREFOX_MAX_CONCURRENT"):
+    FIREFOX_MAX_CONCURRENT = max(1, int(os.environ["LOCKBOX_FIREFOX_MAX_CONCURRENT"]))
+if os.environ.get("LOCKBOX_FIREFOX_MEMORY_ESTIMATE"):
+    FIREFOX_MEMORY_ESTIMATE = int(os.environ["LOCKBOX_FIREFOX_MEMORY_ESTIMATE"]) * 1024 * 1024
+if os.environ.get("LOCKBOX_FIREFOX_MEMORY_LIMIT"):
+    FIREFOX_MEMORY_LIMIT = int(os.environ["LOCKBOX_FIREFOX_MEMORY_LIMIT"]) * 1024 * 1024
+if os.environ.get("LOCKBOX_FIREFOX_CPU_QUOTA"):
+    FIREFOX_CPU_QUOTA = float(os.environ["LOCKBOX_FIREFOX_CPU_QUOTA"])
+if os.environ.get("LOCKBOX_FIREFOX_NICE"):
+    FIREFOX_NICE = int(os.environ["LOCKBOX_FIREFOX_NICE"])
+if os.environ.get("LOCKBOX_FIREFOX_CGROUP"):
+    FIREFOX_CGROUP = os.environ["LOCKBOX_FIREFOX_CGROUP"]
+
+# Preferences to keep the memory usage of each browser down
+FIREFOX_PREFS = {
+    # One content process is enough for one tab
+    "dom.ipc.processCount": 1,
+    "dom.ipc.processCount.webIsolated": 1,
+    "fission.autostart": False,
+    # Smaller caches, no disk cache
+    "browser.cache.disk.enable": False,
+    "browser.cache.memory.capacity": 8 * 1024, # KiB
+    "image.mem.surfacecache.max_size_kb": 16 * 1024,
+    # No session history (only the current page) or session restore
+    "browser.sessionhistory.max_entries": 1,
+    "browser.sessionhistory.max_total_viewers": 0,
+    "browser.sessionstore.max_tabs_undo": 0,
+    "browser.sessionstore.resume_from_crash": False,
+    # No speculative network work
+    "network.prefetch-next": False,
+    "network.dns.disablePrefetch": True,
+    "network.http.speculative-parallel-limit": 0,
+    # No background services
+    "browser.safebrowsing.malware.enabled": False,
+    "browser.safebrowsing.phishing.enabled": False,
+    "datareporting.healthreport.uploadEnabled": False,
+    "toolkit.telemetry.enabled": False,
+    "extensions.pocket.enabled": False,
+}
+
 # Helper structs
 GhosterCredentials = collections.namedtuple("GhosterCredentials", "email tdsb_user tdsb_pass")
 
+def _read_int(path: str) -> Optional[int]:
+    """
+    Read an integer from a (sysfs) file, returning None if it doesn't exist or isn't a number (e.g. "max").
+    """
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def _available_memory() -> Optional[int]:
+    """
+    Get the amount of memory available in bytes, taking the container's cgroup limit into account.
+
+    Returns None if it cannot be determined.
+    """
+    available = []
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available.append(int(line.split()[1]) * 1024)
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    # cgroup v2, then v1 (which reports a huge number when unlimited)
+    for limit_file, usage_file in (("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                   ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")):
+        limit = _read_int(limit_file)
+        usage = _read_int(usage_file)
+        if limit is not None and usage is not None:
+            available.append(max(limit - usage, 0))
+            break
+    return min(available) if available else None
+
+def max_concurrent_browsers(running: int) -> int:
+    """
+    Get the number of browsers that are allowed to run at once, given the number that are already running.
+
+    This is based on the currently available memory and FIREFOX_MEMORY_ESTIMATE, capped at FIREFOX_MAX_CONCURRENT.
+    At least one browser is always allowed.
+    """
+    available = _available_memory()
+    if available is None:
+        return FIREFOX_MAX_CONCURRENT
+    return max(1, min(FIREFOX_MAX_CONCURRENT, running + available // FIREFOX_MEMORY_ESTIMATE))
+
+def _browser_pids(browser: webdriver.Firefox) -> List[int]:
+    """
+    Get the pids of geckodriver and all its descendants (Firefox and its content processes).
+    """
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name can contain spaces, so split after it
+                parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    pids = [browser.service.process.pid]
+    i = 0
+    while i < len(pids):
+        pids.extend(child for child, parent in parents.items() if parent == pids[i])
+        i += 1
+    return pids
+
+def _limit_browser(browser: webdriver.Firefox) -> Optional[str]:
+    """
+    Apply the configured per-session resource limits to a browser.
+
+    If FIREFOX_CGROUP is set and usable, a cgroup is created for this session and its path is returned.
+    Otherwise, memory is limited with rlimits and CPU with niceness, and None is returned.
+    Processes started by the browser later inherit the limits.
+    """
+    if FIREFOX_MEMORY_LIMIT is None and FIREFOX_CPU_QUOTA is None and FIREFOX_NICE is None:
+        return None
+    try:
+        pids = _browser_pids(browser)
+    except OSError as e:
+        logger.warning(f"Cannot find browser processes to limit: {e}")
+        return None
+    if FIREFOX_CGROUP is not None and (FIREFOX_MEMORY_LIMIT is not None or FIREFOX_CPU_QUOTA is not None):
+        path = os.path.join(FIREFOX_CGROUP, f"firefox-{pids[0]}")
+        try:
+            os.mkdir(path)
+            if FIREFOX_MEMORY_LIMIT is not None:
+                with open(os.path.join(path, "memory.max"), "w") as f:
+                    f.write(str(FIREFOX_MEMORY_LIMIT))
+            if FIREFOX_CPU_QUOTA is not None:
+                with open(os.path.join(path, "cpu.max"), "w") as f:
+                    f.write(f"{int(FIREFOX_CPU_QUOTA * 100000)} 100000")
+            for pid in pids:
+                with open(os.path.join(path, "cgroup.procs"), "w") as f:
+                    f.write(str(pid))
+            return path
+        except OSError as e:
+            logger.warning(f"Cannot use cgroup {path} for browser, falling back to rlimits: {e}")
+            _remove_cgroup(path)
+    for pid in pids:
+        try:
+            if FIREFOX_MEMORY_LIMIT is not None:
+                resource.prlimit(pid, resource.RLIMIT_DATA, (FIREFOX_MEMORY_LIMIT, FIREFOX_MEMORY_LIMIT))
+            if FIREFOX_NICE is not None:
+                os.setpriority(os.PRIO_PROCESS, pid, FIREFOX_NICE)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot limit browser process {pid}: {e}")
+    return None
+
+def _remove_cgroup(path: str):
+    """
+    Remove a per-session cgroup, waiting a bit for the browser processes in it to exit.
+    """
+    for _ in range(20):
+        try:
+            os.rmdir(path)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(0.1)
+    logger.warning(f"Failed to remove browser cgroup {path}")
+
 # Various helper functions for doing common tasks
+@contextlib.contextmanager
 def _create_browser():
     options = Options()
     options.binary = "/opt/firefox/firefox"
     options.headless = True
-
-    return webdriver.Firefox(options=options, service_log_path="/dev/null")
+    for name, value in FIREFOX_PREFS.items():
+        options.set_preference(name, value)
+
+    browser = webdriver.Firefox(options=options, service_log_path="/dev/null")
+    cgroup = None
+    try:
+        cgroup = _limit_browser(browser)
+        yield browser
+    finally:
+        browser.quit()
+        if cgroup is not None:
+            _remove_cgroup(cgroup)
 
 def _do_google_auth_flow(browser: webdriver.Firefox, credentials: GhosterCredentials):
     """
@@ -65,59 +253,25 @@ def _do_google_auth_flow(browser: webdriver.Firefox, credentials: GhosterCredent
     #print("clicking login in aw")
 
 
-def _guess_input_type(browser: webdriver.Firefox, element: webdriver.firefox.webelement.FirefoxWebElement): # pylint: disable=unused-argument
+def _wait_for_form(browser: webdriver.Firefox, timeout: float = 10) -> formprofiles.FormProfile:
     """
-    Try to figure out what kind of input this is.
+    Wait for the form to be completely loaded and detect which selector profile matches it.
 
-    Returns None for unknown/ignored elements, otherwise a member of FormFieldType
+    Raises a TimeoutException if no profile matches in time.
     """
+    name = WebDriverWait(browser, timeout).until(lambda b: b.execute_script(formprofiles.DETECT_SCRIPT))
+    profile = formprofiles.PROFILES[name]
+    logger.debug(f"Form matched selector profile {profile}")
+    return profile
 
-    # If this isn't a question, bail immediately
-    if not len(element.find_elements_by_class_name("freebirdFormviewerComponentsQuestionBaseRoot")):
-        return None
-
-    # Check for text question
-    roots = element.find_elements_by_class_name("freebirdFormviewerComponentsQuestionTextRoot")
-    if roots:
-        text_root = roots[0]
-        # Check for short answer
-        if text_root.find_elements_by_class_name("quantumWizTextinputPaperinputInput"):
-            return FormFieldType.TEXT
-        elif text_root.find_elements_by_class_name("quantumWizTextinputPapertextareaInput"):
-            return FormFieldType.LONG_TEXT
-        else:
-            return None # unknown text-subtype
-
-    # Check for radio root
-    roots = element.find_elements_by_class_name("freebirdFormviewerComponentsQuestionRadioRoot")
-    if roots:
-        if roots[0].find_elements_by_class_name("freebirdFormviewerViewItemsRadiogroupRadioGroup"):
-            return FormFieldType.MULTIPLE_CHOICE
-        else:
-            return None
-
-    # Check for date input
-    if element.find_elements_by_class_name("freebirdFormviewerComponentsQuestionDateInputsContainer"):
-        return FormFieldType.DATE
-
-    # Check for textbook input
-    if element.find_elements_by_class_name("freebirdFormviewerComponentsQuestionCheckboxRoot"):
-        return FormFieldType.CHECKBOX
-
-    # Check for dropdowns
-    if element.find_elements_by_class_name("freebirdFormviewerComponentsQuestionSelectRoot"):
-        return FormFieldType.DROPDOWN
-
-    # Otherwise explicitly return None
-    return None
-
-def _get_input_header(browser: webdriver.Firefox, element: webdriver.firefox.webelement.FirefoxWebElement): # pylint: disable=unused-argument
-    """
-    Get the header text
+def _scan_form(browser: webdriver.Firefox, profile: formprofiles.FormProfile) -> List[Tuple[Optional[str], Optional[FormFieldType]]]:
     """
+    Get the header text and input type of every item on the page.
 
-    header_element = element.find_element_by_class_name("freebirdFormviewerComponentsQuestionBaseTitle")
-    return header_element.text
+    The type is None for unknown/ignored items (e.g. headings), and the header text is None if it's missing.
+    """
+    return [(title, FormFieldType(kind) if kind is not None else None)
+            for title, kind in browser.execute_script(profile.scan_script)]
 
 class GhosterError(Exception):
     """
@@ -141,22 +295,28 @@ class GhosterPossibleFail(GhosterError):
     (e.g. timed out waiting for page change after pressing submit)
 
     This error's args will be:
-        (error message, screenshot of failing page for manual review)
+        (error message, base64 encoded PNG screenshot of failing page for manual review)
     """
 
-def _fill_in_field(browser: webdriver.Firefox, element: webdriver.firefox.webelement.FirefoxWebElement, with_value, kind: FormFieldType):
+def _fill_in_field(browser: webdriver.Firefox, profile: formprofiles.FormProfile, index: int, with_value, kind: FormFieldType):
     """
     Fill in a field
     """
 
     waiter = WebDriverWait(browser, 4, poll_frequency=0.25)
 
-    if kind in [FormFieldType.TEXT, FormFieldType.LONG_TEXT]:
-        text_field = element.find_element_by_css_selector("input.quantumWizTextinputPaperinputInput" if kind == FormFieldType.TEXT else "textarea.quantumWizTextinputPapertextareaInput")
+    targets = browser.execute_script(profile.targets_script, index, kind.value)
+    if targets is None:
+        raise NotImplementedError()
+    if not targets:
+        raise NoSuchElementException()
 
+    if kind in [FormFieldType.TEXT, FormFieldType.LONG_TEXT]:
         if not isinstance(with_value, str):
             raise TypeError()
 
+        text_field = targets[0]
+
         # wait for the element to be interactable
         waiter.until(EC.visibility_of(text_field))
 
@@ -166,11 +326,7 @@ def _fill_in_field(browser: webdriver.Firefox, element: webdriver.firefox.webele
         if not isinstance(with_value, datetime.date):
             raise TypeError()
 
-        components = element.find_elements_by_css_selector("input.quantumWizTextinputPaperinputInput")
-
-        month = [x for x in components if x.get_attribute("max") == '12'][0]
-        day   = [x for x in components if x.get_attribute("max") == '31'][0]
-        year  = [x for x in components if int(x.get_attribute("min")) >= 1000][0]
+        month, day, year = targets
 
         for i in [month, day, year]:
             waiter.until(EC.visibility_of(i))
@@ -183,24 +339,16 @@ def _fill_in_field(browser: webdriver.Firefox, element: webdriver.firefox.webele
         if not isinstance(with_value, int):
             raise TypeError()
 
-        if kind == FormFieldType.MULTIPLE_CHOICE:
-            options = element.find_elements_by_class_name("docssharedWizToggleLabeledLabelWrapper")
-            waiter.until(EC.visibility_of(options[with_value]))
-            options[with_value].click()
-
-        elif kind == FormFieldType.CHECKBOX:
-            options = element.find_elements_by_class_name("quantumWizTogglePapercheckboxInnerBox")
-            waiter.until(EC.visibility_of(options[with_value]))
-            options[with_value].click()
+        if kind in [FormFieldType.MULTIPLE_CHOICE, FormFieldType.CHECKBOX]:
+            waiter.until(EC.visibility_of(targets[with_value]))
+            targets[with_value].click()
 
         elif kind == FormFieldType.DROPDOWN:
-            opener = element.find_element_by_class_name("quantumWizMenuPaperselectDropDown")
+            opener = targets[0]
             waiter.until(EC.visibility_of(opener))
             opener.click()
 
-            popup = element.find_element_by_class_name("exportSelectPopup")
-            waiter.until(EC.presence_of_element_located((By.CSS_SELECTOR, "div.exportSelectPopup .quantumWizMenuPaperselectOption")))
-            options = popup.find_elements_by_class_name("exportOption")
+            options = waiter.until(lambda b: b.execute_script(profile.dropdown_options_script, index))
             options[with_value + 1].click()  # + 1 for the "Choose" label
 
             # use actions to send an escape to close it
@@ -211,7 +359,7 @@ def _fill_in_field(browser: webdriver.Firefox, element: webdriver.firefox.webele
 
             # delay until the thing _no longer_ visible
             try:
-                waiter.until_not(EC.presence_of_element_located((By.CSS_SELECTOR, "div.exportSelectPopup .quantumWizMenuPaperselectOption")))
+                waiter.until_not(lambda b: b.execute_script(profile.dropdown_options_script, index))
             except TimeoutException:
                 # ignore timeouts
                 pass
@@ -236,7 +384,7 @@ class GhosterWarning:
 
 
 def fill_form(form_url: str, credentials: GhosterCredentials, components: List[Tuple[int, str, FormFieldType, object, bool]],
-              dry_run=False) -> Tuple[Any, Any, List[GhosterWarning]]:
+              dry_run=False, always_screenshot=True) -> Tuple[Optional[str], Optional[str], List[GhosterWarning]]:
     """
     Fill in a form. Expects the URL, credentials and a description of what to fill in.
 
@@ -245,8 +393,10 @@ def fill_form(form_url: str, credentials: GhosterCredentials, components: List[T
     ]
 
     Returns two screenshots on success, the first being a picture of the form filled in and the second being a picture of the success screen.
+    Screenshots are of the viewport and are returned as base64 encoded PNGs, so decoding them can be done after the browser is gone.
 
     If dry_run is set to True, the form will not actually be submitted and both screenshots will be identical.
+    If always_screenshot is set to False, screenshots are only taken if there were warnings; otherwise both are None.
     """
 
     with _create_browser() as browser:
@@ -265,7 +415,7 @@ def fill_form(form_url: str, credentials: GhosterCredentials, components: List[T
 
         try:
             # ensure page is completely loaded
-            WebDriverWait(browser, 10).until(EC.presence_of_element_located((By.CLASS_NAME, "freebirdFormviewerViewNavigationSubmitButton"))) # if this times out the page is too complex
+            profile = _wait_for_form(browser) # if this times out the page is too complex
         except TimeoutException as e:
             if "alreadyresponded" in browser.current_url:
                 raise GhosterInvalidForm("Form already responded to") from e
@@ -274,19 +424,20 @@ def fill_form(form_url: str, credentials: GhosterCredentials, components: List[T
             else:
                 raise GhosterInvalidForm("Form doesn't have a submit button; may be multi-page?") from e
 
-        # get all elements on the page
-        sub_elems = browser.find_elements_by_css_selector(".freebirdFormviewerViewItemList .freebirdFormviewerViewNumberedItemContainer")
+        # get the headers of all items on the page
+        items = _scan_form(browser, profile)
 
         for (index, expected_title, kind, value, critical) in components:
             try:
-                if index >= len(sub_elems):
+                if index >= len(items):
                     raise GhosterInvalidForm("Requested component (" + expected_title + ") is out of range")
 
-                if expected_title not in _get_input_header(browser, sub_elems[index]):
+                header = items[index][0]
+                if header is None or expected_title not in header:
                     raise GhosterInvalidForm("Requested component (" + expected_title + ") is not present at index (" + str(index) + ")")
 
                 try:
-                    _fill_in_field(browser, sub_elems[index], value, kind)
+                    _fill_in_field(browser, profile, index, value, kind)
                 except NoSuchElementException as e:
                     raise GhosterInvalidForm("Requested component (" + expected_title + ") is of the wrong type (missing element)") from e
                 except TimeoutException as e:
@@ -307,23 +458,24 @@ def fill_form(form_url: str, credentials: GhosterCredentials, components: List[T
                     logger.warning(f"Ignoring error {e.args[0]} from noncritical field")
 
 
+        take_screenshots = always_screenshot or bool(warnings)
         # record screenshot of filled in page
-        shot_pre = browser.find_element_by_tag_name("html").screenshot_as_png
+        shot_pre = browser.get_screenshot_as_base64() if take_screenshots else None
 
         if dry_run:
             # if we're doing a dry run, just return the screenshots
             return shot_pre, shot_pre, warnings
 
         # locate submit button
-        submit_button = browser.find_element_by_class_name("freebirdFormviewerViewNavigationSubmitButton")
+        submit_button = browser.find_element_by_css_selector(profile.submit)
         submit_button.click()
 
         try:
             WebDriverWait(browser, 10).until(EC.url_contains("formResponse"))
         except TimeoutException as e:
-            raise GhosterPossibleFail("Timed out waiting for response page", browser.find_element_by_tag_name("html").screenshot_as_png) from e
+            raise GhosterPossibleFail("Timed out waiting for response page", browser.get_screenshot_as_base64()) from e
 
-        shot_post = browser.find_element_by_tag_name("html").screenshot_as_png
+        shot_post = browser.get_screenshot_as_base64() if take_screenshots else None
 
         return shot_pre, shot_post, warnings
 
@@ -367,7 +519,7 @@ def get_form_geometry(form_url: str, credentials: GhosterCredentials):
 
         try:
             # ensure page is completely loaded
-            WebDriverWait(browser, 10).until(EC.presence_of_element_located((By.CLASS_NAME, "freebirdFormviewerViewNavigationSubmitButton"))) # if this times out the page is too complex
+            profile = _wait_for_form(browser) # if this times out the page is too complex
         except TimeoutException as e:
             if "alreadyresponded" in browser.current_url:
                 raise GhosterInvalidForm("Form not setup for multiple responses") from e
@@ -377,23 +529,16 @@ def get_form_geometry(form_url: str, credentials: GhosterCredentials):
                 raise GhosterInvalidForm("Form doesn't have a submit button; may be multi-page?") from e
 
         # get all components on the page
-        sub_elems = browser.find_elements_by_css_selector(".freebirdFormviewerViewItemList .freebirdFormviewerViewNumberedItemContainer")
-
         fields = []
 
-        for j, elem in enumerate(sub_elems):
-            f_type = _guess_input_type(browser, elem)
+        for j, (header, f_type) in enumerate(_scan_form(browser, profile)):
             if f_type is not None:
-                try:
-                    fields.append((j, _get_input_header(browser, elem), f_type))
-                except NoSuchElementException as e:
-                    raise GhosterInvalidForm(f"Form field {j} missing header") from e
+                if header is None:
+                    raise GhosterInvalidForm(f"Form field {j} missing header")
+                fields.append((j, header, f_type))
 
         # try to redact email before grabbing screenshot.
-        try:
-            email_tag = browser.find_element_by_class_name("freebirdFormviewerViewHeaderEmailAddress")
-            browser.execute_script("arguments[0].innerText = '<redacted>'", email_tag)
-        except NoSuchElementException:
+        if not browser.execute_script(profile.redact_email_script):
             logger.warning("Possible privacy breach: couldn't find an email to redact.")
 
         shot = browser.find_element_by_tag_name("html").screenshot_as_png
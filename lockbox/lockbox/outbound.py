@@ -0,0 +1,85 @@
+"""
+The connection pool shared by all outgoing HTTP requests made by lockbox (TDSB Connects, Google Forms, etc).
+
+Sharing one connector means that connections are kept alive and reused between requests and tasks (so most requests
+don't pay for a TCP connection and TLS handshake), DNS lookups are cached, and the number of connections open at once
+is limited for all of lockbox. The firefox instances used by ghoster make their own connections.
+"""
+
+import aiohttp
+import os
+import ssl
+import typing
+
+
+# Max number of connections open at once
+CONNECTION_LIMIT = 100
+# How long idle connections are kept open for reuse, and DNS lookups are cached (in seconds)
+KEEPALIVE_TIMEOUT = 60.0
+DNS_CACHE_TTL = 300
+
+if os.environ.get("LOCKBOX_HTTP_CONNECTION_LIMIT"):
+    CONNECTION_LIMIT = int(os.environ["LOCKBOX_HTTP_CONNECTION_LIMIT"])
+if os.environ.get("LOCKBOX_HTTP_KEEPALIVE_TIMEOUT"):
+    KEEPALIVE_TIMEOUT = float(os.environ["LOCKBOX_HTTP_KEEPALIVE_TIMEOUT"])
+
+
+class ConnectionPool:
+    """
+    Holds the connector shared by all outgoing HTTP requests.
+
+    limit_per_host is the max number of connections open to each host at once (None for no limit besides the
+    overall CONNECTION_LIMIT).
+
+    Sessions made with new_session() (e.g. for TDSB Connects, which needs its own headers) share the connector,
+    and so does the cookieless session for everything else.
+    Everything is created on first use, since aiohttp needs a running event loop.
+    """
+
+    def __init__(self, limit_per_host: typing.Optional[int] = None):
+        self.limit_per_host = limit_per_host
+        self._connector = None # type: typing.Optional[aiohttp.TCPConnector]
+        self._session = None # type: typing.Optional[aiohttp.ClientSession]
+        # One SSL context for all connections, so the CA certificates are only loaded once
+        self._ssl_context = ssl.create_default_context()
+
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        """
+        The shared connector.
+        """
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, limit_per_host=self.limit_per_host or 0,
+                                                   keepalive_timeout=KEEPALIVE_TIMEOUT, use_dns_cache=True,
+                                                   ttl_dns_cache=DNS_CACHE_TTL, ssl=self._ssl_context)
+        return self._connector
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        A shared session without cookies, for one-off requests (e.g. fetching a form).
+
+        Don't close it; it's closed with the pool.
+        """
+        if self._session is None or self._session.closed or self._session.connector is not self.connector:
+            self._session = self.new_session(cookie_jar=aiohttp.DummyCookieJar())
+        return self._session
+
+    def new_session(self, **kwargs) -> aiohttp.ClientSession:
+        """
+        Create a new session using the shared connector. The arguments are passed to aiohttp.ClientSession.
+
+        The session should still be closed when it's no longer needed, but this won't close the connector.
+        """
+        return aiohttp.ClientSession(connector=self.connector, connector_owner=False, **kwargs)
+
+    async def close(self):
+        """
+        Close the shared session and connector.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
@@ -7,12 +7,15 @@ The scheduler runs a main loop and spawns asyncio tasks as necessary.
 """
 
 import asyncio
+import contextlib
 import datetime
 import logging
 import typing
 import pymongo
 import traceback
 from . import db # pylint: disable=unused-import # For type hinting
+from . import ghoster
+from . import tdsb
 from .documents import TaskType
 
 
@@ -39,14 +42,17 @@ class TaskTypeGroup:
     One task may be in multiple of these.
     """
 
-    __slots__ = ("name", "limit", "count")
+    __slots__ = ("name", "limit", "count", "limit_func")
 
     GROUPS_MAP = {} # type: typing.Dict[TaskType, typing.List["TaskTypeGroup"]]
 
-    def __init__(self, name: str, types: typing.Tuple[TaskType], limit: int):
+    def __init__(self, name: str, types: typing.Tuple[TaskType], limit: int,
+                 limit_func: typing.Optional[typing.Callable[[int], int]] = None):
         self.name = name
         self.limit = limit
         self.count = 0
+        # If provided, called with the current count to get a dynamic limit
+        self.limit_func = limit_func
         for ttype in types:
             try:
                 self.GROUPS_MAP[ttype].append(self)
@@ -57,6 +63,14 @@ class TaskTypeGroup:
     def get_groups(cls, kind: TaskType) -> typing.Iterable["TaskTypeGroup"]:
         return cls.GROUPS_MAP.get(kind, ())
 
+    def get_limit(self) -> int:
+        """
+        Get the current limit of this group.
+        """
+        if self.limit_func is not None:
+            return self.limit_func(self.count)
+        return self.limit
+
 
 class Scheduler:
     """
@@ -73,10 +87,31 @@ class Scheduler:
         self._update_event = asyncio.Event()
 
         # Initialize groups
-        TaskTypeGroup("firefox", (TaskType.FILL_FORM, TaskType.TEST_FILL_FORM, TaskType.GET_FORM_GEOMETRY), 3)
-        TaskTypeGroup("tdsb_connects", (TaskType.FILL_FORM, TaskType.CHECK_DAY, TaskType.POPULATE_COURSES, TaskType.TEST_FILL_FORM), 7)
+        TaskTypeGroup("firefox", (TaskType.FILL_FORM, TaskType.TEST_FILL_FORM, TaskType.GET_FORM_GEOMETRY),
+                      ghoster.FIREFOX_MAX_CONCURRENT, ghoster.max_concurrent_browsers)
+        TaskTypeGroup("tdsb_connects", (TaskType.FILL_FORM, TaskType.CHECK_DAY, TaskType.POPULATE_COURSES, TaskType.TEST_FILL_FORM,
+                                          TaskType.PREFETCH_FILL_PLANS, TaskType.UPDATE_ALL_COURSES), tdsb.TASK_CONCURRENCY)
         TaskTypeGroup("global", tuple(iter(TaskType)), 10)
 
+    @contextlib.contextmanager
+    def extra_slots(self, kind: TaskType, group_name: str, wanted: int) -> typing.Iterator[int]:
+        """
+        Take up to wanted more slots of a group for a running task of a kind that does several things at once,
+        so the scheduler doesn't start other tasks in them meanwhile.
+
+        Only free slots are taken. Yields the number taken (possibly 0), which are given back on exit.
+        """
+        group = next(group for group in TaskTypeGroup.get_groups(kind) if group.name == group_name)
+        taken = max(min(wanted, group.get_limit() - group.count), 0)
+        group.count += taken
+        try:
+            yield taken
+        finally:
+            group.count -= taken
+            # Tasks that were pushed back might be able to run now
+            if taken:
+                self.update()
+
     def update(self):
         """
         Tell the scheduler that a new task has been created.
@@ -181,9 +216,10 @@ class Scheduler:
                     # If wait_for() timed out then we've waited the right amount of time to schedule the task
                     # Check rate limiting counters first
                     for group in TaskTypeGroup.get_groups(TaskType(task.kind)):
-                        if group.count >= group.limit:
+                        limit = group.get_limit()
+                        if group.count >= limit:
                             task.next_run_at += datetime.timedelta(seconds=30)
-                            logger.warning(f"Task {self._format_task(task)} pushed back 30s because the rate limit for group {group.name} was reached ({group.limit})")
+                            logger.warning(f"Task {self._format_task(task)} pushed back 30s because the rate limit for group {group.name} was reached ({limit})")
                             await task.commit()
                             break
                     # If didn't break, then all groups' requirements were met
@@ -81,11 +81,15 @@ class LockboxServer:
             web.patch("/user", self._patch_user),
             web.get("/user", self._get_user),
             web.delete("/user", self._delete_user),
+            web.get("/user/errors", self._get_user_errors),
             web.delete(r"/user/error/{id:[a-f0-9]+}", self._delete_user_error),
             web.get("/user/courses", self._get_user_courses),
             web.post("/user/courses/update", self._post_user_courses_update),
             web.post("/form_geometry", self._post_form_geometry),
             web.post("/update_all_courses", self._post_update_all_courses),
+            web.get("/update_all_courses", self._get_update_all_courses),
+            web.get("/screenshot_sweep", self._get_screenshot_sweep),
+            web.get("/fill_stats", self._get_fill_stats),
             web.get("/debug/tasks", self._get_debug_tasks),
             web.post("/debug/tasks/update", self._post_debug_tasks_update),
             web.post("/test_form", self._post_test_form)
@@ -98,8 +102,16 @@ class LockboxServer:
         Perform async initialization for the app.
         """
         await self.db.init()
+        self.app.on_cleanup.append(self._cleanup)
         return self.app
 
+    async def _cleanup(self, app: web.Application): # pylint: disable=unused-argument
+        """
+        Close outgoing connections on shutdown.
+        """
+        await self.db.tdsb_sessions.close()
+        await self.db.http.close()
+
     def run(self):
         """
         Run the sever.
@@ -168,7 +180,7 @@ class LockboxServer:
         {
             "login": "...", // Optional, TDSB login (student number) (missing if unconfigured)
             "active": true, // Whether form-filling is active for this user
-            "errors": [     // An array of LockboxFailures listing the errors
+            "errors": [     // An array of LockboxFailures listing the newest errors (see GET /user/errors for the rest)
                 {
                     "_id": "...", // The object ID
                     "time_logged": "1970-01-01T00:00:00.00Z", // ISO datetime string of the time this error was logged (UTC)
@@ -197,13 +209,7 @@ class LockboxServer:
         Possible error response codes:
         - 401: Invalid token
         """
-        data = await self.db.get_user(token)
-        # Modify data
-        data["credentials_set"] = "password" in data and "login" in data
-        data.pop("id", None)
-        data.pop("password", None)
-        data.pop("token", None)
-        return web.json_response(data, status=200)
+        return web.json_response(await self.db.get_user(token), status=200)
 
     @_handle_db_errors
     @_extract_token
@@ -226,6 +232,41 @@ class LockboxServer:
         await self.db.delete_user(token)
         return web.Response(status=204)
 
+    @_handle_db_errors
+    @_extract_token
+    async def _get_user_errors(self, request: web.Request, token: str):
+        """
+        Handle a GET to /user/errors.
+
+        The request should use bearer auth with a token given on user creation.
+
+        Optional query parameters:
+        - limit: The max number of errors to return
+        - before: "next" from the last page; only errors after that page are returned
+                  (a plain ISO datetime string returns the errors logged before it)
+
+        Returns the following JSON on success:
+        {
+            "errors": [     // An array of LockboxFailures, newest first (same format as GET /user)
+            ],
+            "next": "1970-01-01T00:00:00_...", // The value of before for the next page, or null if this is the last page
+        }
+
+        Returns the following JSON on failure:
+        {
+            "error": "...", // Reason for error, e.g. "Bad token", etc.
+        }
+
+        Possible error response codes:
+        - 400: Invalid limit or before
+        - 401: Invalid token
+        """
+        try:
+            limit = int(request.query["limit"]) if "limit" in request.query else None
+        except ValueError:
+            return web.json_response({"error": "Invalid field: limit must be an integer"}, status=400)
+        return web.json_response(await self.db.get_user_errors(token, limit, request.query.get("before")), status=200)
+
     @_handle_db_errors
     @_extract_token
     async def _delete_user_error(self, request: web.Request, token: str):
@@ -273,9 +314,9 @@ class LockboxServer:
         Possible error response codes:
         - 401: Invalid token
         """
-        data = await self.db.get_user(token)
+        data = await self.db.get_user_courses(token)
         # No credentials
-        if not ("password" in data and "login" in data):
+        if not data["credentials_set"]:
             logger.info("User credentials not present")
             return web.json_response({"courses": None, "pending": False})
         # Credentials present, but courses are not
@@ -412,11 +453,91 @@ class LockboxServer:
             "error": "...", // Reason for error, e.g. "Bad token", etc.
         }
 
-        204 on success.
+        204 on success, 409 if all courses are already being updated.
         """
         await self.db.update_all_courses()
         return web.Response(status=204)
 
+    @_handle_db_errors
+    async def _get_update_all_courses(self, request: web.Request): # pylint: disable=unused-argument
+        """
+        Handle a GET to /update_all_courses.
+
+        Returns the following JSON on success:
+        {
+            "time_started": "1970-01-01T00:00:00", // ISO datetime string of when the last update was started (UTC)
+            "time_finished": null, // ISO datetime string of when it finished (UTC), null if still running
+            "total": 1500, // Number of users to update
+            "done": 120, // Number of users updated so far, not counting the failed ones
+            "changed": 4, // Number of users whose courses changed
+            "failed": 0, // Number of users that couldn't be updated (they're retried separately)
+            "batch_size": 12, // Current number of users updated per batch (adjusted based on TDSB Connects' response times)
+            "eta": "1970-01-01T00:00:00", // ISO datetime string of the estimated finish time (UTC), null if finished
+        }
+
+        404 if all courses were never updated.
+        """
+        progress = await self.db.get_update_all_courses_progress()
+        if progress is None:
+            return web.json_response({"error": "No update in progress"}, status=404)
+        return web.json_response(progress, status=200)
+
+    @_handle_db_errors
+    async def _get_screenshot_sweep(self, request: web.Request): # pylint: disable=unused-argument
+        """
+        Handle a GET to /screenshot_sweep.
+
+        Returns the following JSON on success:
+        {
+            "time_started": "1970-01-01T00:00:00", // ISO datetime string of when the last sweep was started (UTC)
+            "time_finished": null, // ISO datetime string of when it finished (UTC), null if still running
+            "referenced": 1200, // Number of files referred to by documents, null if they're still being found
+            "scanned": 500, // Number of files old enough to be deleted checked so far
+            "deleted": 3, // Number of those files deleted because nothing refers to them
+            "bytes_freed": 123456, // Total size of the deleted files
+            "orphaned_chunks": 0, // Number of chunks deleted that didn't belong to a file
+        }
+
+        404 if the screenshots were never swept.
+        """
+        progress = await self.db.get_screenshot_sweep_progress()
+        if progress is None:
+            return web.json_response({"error": "No sweep in progress"}, status=404)
+        return web.json_response(progress, status=200)
+
+    @_handle_db_errors
+    async def _get_fill_stats(self, request: web.Request):
+        """
+        Handle a GET to /fill_stats.
+
+        Optional query parameters:
+        - days: The number of days to get stats for, including today (UTC). Defaults to 30.
+        - by: Either "course" or "form", what to group the results of each day by. Defaults to "course".
+
+        Returns the following JSON on success:
+        {
+            "stats": [ // One entry per day and course/form that had fills, sorted by date
+                {
+                    "date": "1970-01-01", // The day (UTC)
+                    "course": "...", // The course ID (or "form": form config ID), null for fills that failed before it was known
+                    "success": 10, // Number of fills with each result, see documents.FillFormResultType
+                    "failure": 1,
+                    "possible-failure": 0,
+                    "submit-disabled": 0,
+                }
+            ]
+        }
+
+        Possible error response codes:
+        - 400: Invalid days or by
+        """
+        try:
+            days = int(request.query.get("days", 30))
+        except ValueError:
+            return web.json_response({"error": "Invalid field: days must be an integer"}, status=400)
+        stats = await self.db.get_fill_stats(days, request.query.get("by", "course"))
+        return web.json_response({"stats": stats}, status=200)
+
     @_handle_db_errors
     async def _get_debug_tasks(self, request: web.Request): # pylint: disable=unused-argument
         """
@@ -4,12 +4,16 @@ Task function definitions for the scheduler.
 
 import aiohttp
 import asyncio
+import base64
 import bson
 import datetime
 import gridfs
+import hashlib
+import json
 import logging
 import os
 import random
+import time
 import umongo
 import tdsbconnects
 import traceback
@@ -19,6 +23,7 @@ from dateutil import tz
 from umongo.exceptions import DeleteError
 from . import db as db_ # pylint: disable=unused-import
 from . import fieldexpr
+from . import formdef
 from . import ghoster
 from . import scheduler
 from . import tdsb
@@ -32,9 +37,40 @@ LOCAL_TZ = tz.gettz()
 # Vars in local time, defaults are below
 CHECK_DAY_RUN_TIME = (datetime.time(hour=4, minute=0), datetime.time(hour=4, minute=0))
 FILL_FORM_RUN_TIME = (datetime.time(hour=7, minute=0), datetime.time(hour=9, minute=0))
+# Number of users to try logging in as at once when checking the day
+CHECK_DAY_PARALLEL_LOGINS = 3
 FILL_FORM_RETRY_LIMIT = 3
 FILL_FORM_RETRY_IN = 30 * 60 # half an hour
 FILL_FORM_SUBMIT_ENABLED = True
+# Percentage of successful fills to keep screenshots for; fills with warnings or failures always get them
+FILL_FORM_SCREENSHOT_RATE = 100.0
+# Argument for populate courses tasks to only rebuild courses if the timetable changed
+POPULATE_COURSES_IF_CHANGED = "if-changed"
+# Starting and max number of users to refresh at once when updating all courses, and how often to start a batch
+UPDATE_COURSES_BATCH_SIZE = 3
+UPDATE_COURSES_MAX_BATCH_SIZE = 30
+UPDATE_COURSES_INTERVAL = 60.0
+# Batches are made smaller when refreshing a user takes longer than this (in seconds) on average
+UPDATE_COURSES_TARGET_LATENCY = 15.0
+# Max number of users in a batch refreshed at once, as many as the TDSB Connects connections can serve without waiting
+# Each user past the first takes another free slot of the scheduler's tdsb_connects group for the batch, so the task
+# gets fewer when other tasks are using TDSB Connects, and together they stay within the group's limit
+UPDATE_COURSES_CONCURRENCY = max(min(tdsb.TASK_CONCURRENCY, tdsb.CONNECTION_LIMIT // tdsb.SESSION_CONCURRENCY), 1)
+# Max number of users to prepare fill plans for at once
+PREFETCH_FILL_PLANS_CONCURRENCY = 5
+FORM_GEOMETRY_REVALIDATE_INTERVAL = 60 * 60 # an hour
+FORM_GEOMETRY_MAX_AGE = 24 * 60 * 60 # a day
+# How long pending or failed form geometry results and test fill results are kept before MongoDB removes them
+FORM_GEOMETRY_PENDING_TTL = 15 * 60 # 15 minutes
+TEST_RESULT_TTL = 6 * 60 * 60 # 6 hours
+# Number of errors kept for each user (older ones are deleted), and the number returned at once
+USER_ERROR_LIMIT = 100
+USER_ERRORS_PAGE_SIZE = 20
+# How often screenshots no document refers to are deleted, and how old they have to be
+SCREENSHOT_SWEEP_INTERVAL = 60 * 60 # an hour
+SCREENSHOT_SWEEP_GRACE = 60 * 60 # an hour
+# Number of GridFS files checked and deleted at once when sweeping screenshots
+SCREENSHOT_SWEEP_BATCH_SIZE = 500
 
 
 if os.environ.get("LOCKBOX_CHECK_DAY_RUN_TIME"):
@@ -47,12 +83,44 @@ if os.environ.get("LOCKBOX_FILL_FORM_RUN_TIME"):
     tstart = datetime.datetime.strptime(tstart.strip(), "%H:%M:%S").time()
     tend = datetime.datetime.strptime(tend.strip(), "%H:%M:%S").time()
     FILL_FORM_RUN_TIME = (tstart, tend)
+if os.environ.get("LOCKBOX_CHECK_DAY_PARALLEL_LOGINS"):
+    CHECK_DAY_PARALLEL_LOGINS = max(int(os.environ["LOCKBOX_CHECK_DAY_PARALLEL_LOGINS"]), 1)
 if os.environ.get("LOCKBOX_FILL_FORM_RETRY_LIMIT"):
     FILL_FORM_RETRY_LIMIT = int(os.environ["LOCKBOX_FILL_FORM_RETRY_LIMIT"])
 if os.environ.get("LOCKBOX_FILL_FORM_RETRY_IN"):
     FILL_FORM_RETRY_IN = float(os.environ["LOCKBOX_FILL_FORM_RETRY_IN"])
 if os.environ.get("LOCKBOX_FILL_FORM_SUBMIT_ENABLED"):
     FILL_FORM_SUBMIT_ENABLED = int(os.environ.get("LOCKBOX_FILL_FORM_SUBMIT_ENABLED")) == 1
+if os.environ.get("LOCKBOX_FILL_FORM_SCREENSHOTS"):
+    _screenshots = os.environ["LOCKBOX_FILL_FORM_SCREENSHOTS"].strip().lower()
+    if _screenshots == "always":
+        FILL_FORM_SCREENSHOT_RATE = 100.0
+    elif _screenshots == "warnings":
+        FILL_FORM_SCREENSHOT_RATE = 0.0
+    else:
+        FILL_FORM_SCREENSHOT_RATE = float(_screenshots.rstrip("%"))
+if os.environ.get("LOCKBOX_PREFETCH_FILL_PLANS_CONCURRENCY"):
+    PREFETCH_FILL_PLANS_CONCURRENCY = max(int(os.environ["LOCKBOX_PREFETCH_FILL_PLANS_CONCURRENCY"]), 1)
+if os.environ.get("LOCKBOX_UPDATE_COURSES_BATCH_SIZE"):
+    UPDATE_COURSES_BATCH_SIZE = max(int(os.environ["LOCKBOX_UPDATE_COURSES_BATCH_SIZE"]), 1)
+if os.environ.get("LOCKBOX_UPDATE_COURSES_MAX_BATCH_SIZE"):
+    UPDATE_COURSES_MAX_BATCH_SIZE = max(int(os.environ["LOCKBOX_UPDATE_COURSES_MAX_BATCH_SIZE"]), 1)
+if os.environ.get("LOCKBOX_UPDATE_COURSES_INTERVAL"):
+    UPDATE_COURSES_INTERVAL = max(float(os.environ["LOCKBOX_UPDATE_COURSES_INTERVAL"]), 0.0)
+if os.environ.get("LOCKBOX_UPDATE_COURSES_TARGET_LATENCY"):
+    UPDATE_COURSES_TARGET_LATENCY = float(os.environ["LOCKBOX_UPDATE_COURSES_TARGET_LATENCY"])
+if os.environ.get("LOCKBOX_FORM_GEOMETRY_REVALIDATE_INTERVAL"):
+    FORM_GEOMETRY_REVALIDATE_INTERVAL = float(os.environ["LOCKBOX_FORM_GEOMETRY_REVALIDATE_INTERVAL"])
+if os.environ.get("LOCKBOX_FORM_GEOMETRY_MAX_AGE"):
+    FORM_GEOMETRY_MAX_AGE = float(os.environ["LOCKBOX_FORM_GEOMETRY_MAX_AGE"])
+if os.environ.get("LOCKBOX_USER_ERROR_LIMIT"):
+    USER_ERROR_LIMIT = max(int(os.environ["LOCKBOX_USER_ERROR_LIMIT"]), 1)
+if os.environ.get("LOCKBOX_TEST_RESULT_TTL"):
+    TEST_RESULT_TTL = float(os.environ["LOCKBOX_TEST_RESULT_TTL"])
+if os.environ.get("LOCKBOX_SCREENSHOT_SWEEP_INTERVAL"):
+    SCREENSHOT_SWEEP_INTERVAL = float(os.environ["LOCKBOX_SCREENSHOT_SWEEP_INTERVAL"])
+if os.environ.get("LOCKBOX_SCREENSHOT_SWEEP_GRACE"):
+    SCREENSHOT_SWEEP_GRACE = float(os.environ["LOCKBOX_SCREENSHOT_SWEEP_GRACE"])
 
 
 class LockboxTaskFailure(Exception):
@@ -84,59 +152,102 @@ def next_run_time(time_range: typing.Tuple[datetime.time, datetime.time]) -> dat
         + datetime.timedelta(seconds=offset)).astimezone(datetime.timezone.utc)
 
 
+async def _probe_day(db: "db_.LockboxDB", user) -> typing.Optional[str]:
+    """
+    Try to get the current day cycle name using a user's credentials, for the check day task.
+
+    Returns None if it can't be found with this user.
+    Also records whether the credentials worked, so that users that worked recently are tried first next time.
+    """
+    try:
+        password = db.fernet.decrypt(user.password).decode("utf-8")
+    except InvalidToken:
+        logger.critical(f"User {user.pk}'s password cannot be decrypted")
+        return None
+
+    async def _get_day(session: tdsbconnects.TDSBConnects) -> typing.Optional[str]:
+        # Attempt to grab day
+        # First find the right school
+        schools = (await session.get_user_info()).schools
+        if db.school_code is not None:
+            for s in schools:
+                if s.code == db.school_code:
+                    school = s
+                    break
+            else:
+                logger.warning(f"User {user.pk} is not in the correct school")
+                # Skip if not in the correct school
+                return None
+        else:
+            if len(schools) != 1:
+                logger.warning(f"User {user.pk} is in {len(schools)} schools")
+                return None
+            school = schools[0]
+        # Refresh the school's calendar while we're at it, so that other tasks don't have to
+        today = datetime.date.today()
+        days = await tdsb.get_day_cycle_calendar(school, today)
+        if not days:
+            return None
+        await db.update_school_calendar(school.code, today, days)
+        return days[0]
+
+    # Attempt login
+    try:
+        # Always try, even if TDSB Connects seems to be down; this also reports whether it's back up
+        day = await db.tdsb_sessions.run(user.login, password, _get_day, force=True)
+    except aiohttp.ClientError as e:
+        if not (isinstance(e, aiohttp.ClientResponseError) and e.code == 401): # pylint: disable=no-member
+            logger.warning(f"Check day: Non-auth error when trying to login as {user.login}: {e}")
+            # Not the user's fault
+            return None
+        day = None
+    await db.UserImpl.collection.update_one({"_id": user.pk}, {"$set": {
+        "check_day_succeeded_at": datetime.datetime.utcnow() if day is not None else None}})
+    return day
+
+
 async def check_day(db: "db_.LockboxDB", owner, retries: int, argument: str) -> typing.Optional[datetime.datetime]: # pylint: disable=unused-argument
     """
     Checks if the current day is a school day.
     If not, postpones the run time of all tasks with type FILL_FORM by 1 day.
+    Also refreshes the stored day cycle calendar of the school.
 
     This task should run daily before any forms are filled.
+    On school days, it also starts the prefetch fill plans task.
     """
     logger.info("Check day: Starting")
     # Next run may not be exactly 1 day from now because of retries and other delays
     next_run = next_run_time(CHECK_DAY_RUN_TIME)
     day = None
     # Try to get a set of valid credentials
-    async for user in db.UserImpl.find():
-        # Only use complete credentials for active users
-        if not user.active or user.login is None or user.password is None:
-            continue
-        try:
-            password = db.fernet.decrypt(user.password).decode("utf-8")
-        except InvalidToken:
-            logger.critical(f"User {user.pk}'s password cannot be decrypted")
-            continue
-        # Attempt login
-        session = tdsbconnects.TDSBConnects()
-        try:
-            await session.login(user.login, password)
-            # Attempt to grab day
-            # First find the right school
-            schools = (await session.get_user_info()).schools
-            if db.school_code is not None:
-                for s in schools:
-                    if s.code == db.school_code:
-                        school = s
-                        break
-                else:
-                    logger.warning(f"User {user.pk} is not in the correct school")
-                    # Skip if not in the correct school
-                    continue
-            else:
-                if len(schools) != 1:
-                    logger.warning(f"User {user.pk} is in {len(schools)} schools")
-                    continue
-                school = schools[0]
-            days = await school.day_cycle_names(datetime.datetime.today(), datetime.datetime.today())
-            if not days:
-                continue
-            day = days[0]
-            break
-        except aiohttp.ClientError as e:
-            if not (isinstance(e, aiohttp.ClientResponseError) and e.code == 401): # pylint: disable=no-member
-                logger.warning(f"Check day: Non-auth error when trying to login as {user.login}: {e}")
-            continue
-        finally:
-            await session.close()
+    # Only use complete credentials for active users, starting with the ones that worked most recently
+    # (null sorts last in descending order)
+    users = db.UserImpl.find({"active": {"$ne": False}, "login": {"$ne": None}, "password": {"$ne": None}},
+                             sort=[("check_day_succeeded_at", -1)]).__aiter__()
+    # Try several users at once, so a few bad credentials or slow responses don't hold up the check
+    probes = {} # type: typing.Dict[asyncio.Future, typing.Any]
+    exhausted = False
+    try:
+        while day is None:
+            while not exhausted and len(probes) < CHECK_DAY_PARALLEL_LOGINS:
+                try:
+                    user = await users.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                probes[asyncio.ensure_future(_probe_day(db, user))] = user
+            if not probes:
+                break
+            done, _ = await asyncio.wait(probes, return_when=asyncio.FIRST_COMPLETED)
+            for probe in done:
+                user = probes.pop(probe)
+                if day is None and probe.result() is not None:
+                    day = probe.result()
+                    logger.info(f"Check day: Got day using login {user.login}")
+    finally:
+        # Stop the rest once one of them has the day
+        for probe in probes:
+            probe.cancel()
     # Cannot find valid set of credentials or TDSB Connects is down?
     if day is None:
         logger.warning("Check day: No valid credentials or TDSB Connects down")
@@ -152,6 +263,8 @@ async def check_day(db: "db_.LockboxDB", owner, retries: int, argument: str) ->
     if len(day) >= 2:
         db.current_day = int(day[1:])
         logger.info(f"Check day: Current school day is a Day {db.current_day}")
+        # Get everything ready for the fill form tasks
+        await db.schedule_fill_plan_prefetch()
     else:
         logger.info("Check day: No school today.")
         # No school today
@@ -176,29 +289,30 @@ async def _get_tdsb_user_info(db: "db_.LockboxDB", user, password: str, warn_cb:
     warn_cb is an async callback used for reporting warnings.
     Raises a LockboxTaskFailure on failure.
     """
+    async def _get_info(session: tdsbconnects.TDSBConnects):
+        info = await session.get_user_info()
+        if db.school_code is not None:
+            for s in info.schools:
+                if s.code == db.school_code:
+                    school = s
+                    break
+            else:
+                logger.error(f"{log_prefix}: User {user.pk} is not in the right school")
+                raise LockboxTaskFailure(LockboxFailureType.BAD_USER_INFO, f"You don't seem to be in the school nffu was set up for (#{db.school_code}).")
+        else:
+            schools = info.schools
+            if len(schools) != 1:
+                logger.error(f"{log_prefix}: User {user.pk} has an invalid number of schools: {', '.join(f'{s.name} (#{s.code})' for s in schools)}")
+                raise LockboxTaskFailure(LockboxFailureType.BAD_USER_INFO, f"TDSB reported that you're in {len(schools)} schools. NFFU only works if you have exactly 1 school.")
+            school = schools[0]
+        # Get only async courses today
+        timetable = [item for item in (await school.timetable(datetime.date.today()) or ())
+                     if item.course_period.endswith("a")]
+        return info, school, timetable
+
     # Ideal case: Use fresh data from TDSB Connects
     try:
-        async with tdsbconnects.TDSBConnects() as session:
-            await session.login(user.login, password)
-            info = await session.get_user_info()
-            if db.school_code is not None:
-                for s in info.schools:
-                    if s.code == db.school_code:
-                        school = s
-                        break
-                else:
-                    logger.error(f"{log_prefix}: User {user.pk} is not in the right school")
-                    raise LockboxTaskFailure(LockboxFailureType.BAD_USER_INFO, f"You don't seem to be in the school nffu was set up for (#{db.school_code}).")
-            else:
-                schools = info.schools
-                if len(schools) != 1:
-                    logger.error(f"{log_prefix}: User {user.pk} has an invalid number of schools: {', '.join(f'{s.name} (#{s.code})' for s in schools)}")
-                    raise LockboxTaskFailure(LockboxFailureType.BAD_USER_INFO, f"TDSB reported that you're in {len(schools)} schools. NFFU only works if you have exactly 1 school.")
-                school = schools[0]
-            # Get only async courses today
-            timetable = [item for item in (await school.timetable(datetime.date.today()) or ())
-                         if item.course_period.endswith("a")]
-            return info, school, timetable
+        return await db.tdsb_sessions.run(user.login, password, _get_info)
     except aiohttp.ClientError as e:
         raise LockboxTaskFailure(LockboxFailureType.TDSB_CONNECTS, f"{e.__class__.__name__}: {e}") from e
 
@@ -289,21 +403,25 @@ async def _get_fieldexpr_context(db: "db_.LockboxDB", user, course, info: typing
         }
 
 
-async def _do_fill_form(db: "db_.LockboxDB", user, course, password: str, fe_context: typing.Dict[str, typing.Any],
-                        dry_run: bool, test: bool, warn_cb: typing.Callable[[LockboxFailureType, str], typing.Awaitable],
-                        log_prefix: str = "Do fill form") -> typing.Any: # Returns db.FillFormResultImpl or db.FillFormResultImplShared
+def _form_config_id(course) -> typing.Optional[bson.ObjectId]:
     """
-    Actually fill a form.
+    Get the id of a course's form config, or None if it has none.
+    """
+    return course.form_config.pk if course.form_config is not None else None
+
+
+async def _format_fields(db: "db_.LockboxDB", course, fe_context: typing.Dict[str, typing.Any],
+                         log_prefix: str = "Format fields") -> typing.List[typing.Tuple[int, str, FormFieldType, typing.Any, bool]]:
+    """
+    Work out the values to fill in for each field of a course's form, in the format taken by ghoster.fill_form().
 
-    If test is true, the shared impl will be used and the confirm screenshot will not be taken.
-    warn_cb is an async callback used for reporting warnings.
     Raises a LockboxTaskFailure on failure.
     """
-    ResultImpl = db.FillFormResultImplShared if test else db.FillFormResultImpl
-    ghoster_credentials = ghoster.GhosterCredentials(user.email, user.login, password)
-    # Format fields
     fields = []
-    form = await course.form_config.fetch()
+    form = await db.config_cache.get_form(course.form_config.pk)
+    if form is None:
+        logger.error(f"{log_prefix}: Form config {course.form_config.pk} of course {course.course_code} does not exist")
+        raise LockboxTaskFailure(LockboxFailureType.INTERNAL, "Internal error: Form config of the course not found", True)
     for field in form.sub_fields:
         try:
             value = fieldexpr.interpret(field.target_value, fe_context)
@@ -314,15 +432,37 @@ async def _do_fill_form(db: "db_.LockboxDB", user, course, password: str, fe_con
         title = field.expected_label_segment or ""
         kind = FormFieldType(field.kind)
         fields.append((field.index_on_page, title, kind, value, field.critical))
+    return fields
+
+
+async def _do_fill_form(db: "db_.LockboxDB", user, course, password: str, fe_context: typing.Optional[typing.Dict[str, typing.Any]],
+                        dry_run: bool, test: bool, warn_cb: typing.Callable[[LockboxFailureType, str], typing.Awaitable],
+                        log_prefix: str = "Do fill form",
+                        fields: typing.Optional[typing.List[typing.Tuple[int, str, FormFieldType, typing.Any, bool]]] = None) -> typing.Any: # Returns db.FillFormResultImpl or db.FillFormResultImplShared
+    """
+    Actually fill a form.
+
+    If test is true, the shared impl will be used and the confirm screenshot will not be taken.
+    Otherwise, screenshots are taken according to FILL_FORM_SCREENSHOT_RATE.
+    warn_cb is an async callback used for reporting warnings.
+    If fields (as returned by _format_fields()) is given, they're used instead of working them out from fe_context.
+    Raises a LockboxTaskFailure on failure.
+    """
+    ResultImpl = db.FillFormResultImplShared if test else db.FillFormResultImpl
+    ghoster_credentials = ghoster.GhosterCredentials(user.email, user.login, password)
+    if fields is None:
+        fields = await _format_fields(db, course, fe_context, log_prefix)
+    # Test fills are always looked at, so they always get screenshots
+    always_screenshot = test or random.uniform(0, 100) < FILL_FORM_SCREENSHOT_RATE
     logger.info(f"{log_prefix}: Form filling started for course {course.course_code} for user {user.pk}")
     try:
         result = await asyncio.get_event_loop().run_in_executor(None, lambda: ghoster.fill_form(course.form_url,
-            ghoster_credentials, fields, dry_run=dry_run))
+            ghoster_credentials, fields, dry_run=dry_run, always_screenshot=always_screenshot))
     except ghoster.GhosterPossibleFail as e:
         message, screenshot = e.args # pylint: disable=unbalanced-tuple-unpacking
         logger.warning(f"{log_prefix}: Possible failure for user {user.pk}: {message}\n{traceback.format_exc()}")
         # Upload screenshot and report error
-        screenshot_id = await db.shared_gridfs().upload_from_stream("confirmation.png", screenshot)
+        screenshot_id = await db.shared_gridfs().upload_from_stream("confirmation.png", base64.b64decode(screenshot))
         await warn_cb(LockboxFailureType.FORM_FILLING, f"Possible form filling failure (Not retrying): {message}")
         return ResultImpl(result=FillFormResultType.POSSIBLE_FAILURE.value,
             time_logged=datetime.datetime.utcnow(), confirmation_screenshot_id=screenshot_id, course=course.pk)
@@ -341,13 +481,181 @@ async def _do_fill_form(db: "db_.LockboxDB", user, course, password: str, fe_con
     for warn in warnings:
         # This should've already been logged by ghoster
         await warn_cb(LockboxFailureType.FORM_FILLING, f"Warning: {warn.kind.value}: {warn.message}")
-    fid = await db.shared_gridfs().upload_from_stream("form.png", fss)
     fill_result = ResultImpl(result=FillFormResultType.SUCCESS.value if FILL_FORM_SUBMIT_ENABLED else FillFormResultType.SUBMIT_DISABLED.value,
-        course=course.pk, time_logged=datetime.datetime.utcnow(), form_screenshot_id=fid)
-    fill_result.confirmation_screenshot_id = await db.shared_gridfs().upload_from_stream("confirmation.png", css) if not test else fid
+        course=course.pk, time_logged=datetime.datetime.utcnow())
+    # The browser is gone by now, so decoding and uploading the screenshots doesn't hold it up
+    if fss is not None:
+        fill_result.form_screenshot_id = await db.shared_gridfs().upload_from_stream("form.png", base64.b64decode(fss))
+    if test:
+        fill_result.confirmation_screenshot_id = fill_result.form_screenshot_id
+    elif css is not None:
+        fill_result.confirmation_screenshot_id = await db.shared_gridfs().upload_from_stream("confirmation.png", base64.b64decode(css))
     return fill_result
 
 
+async def _get_todays_course(db: "db_.LockboxDB", user, password: str, warn_cb: typing.Callable[[LockboxFailureType, str], typing.Awaitable],
+                             log_prefix: str = "Get today's course") -> typing.Optional[typing.Tuple[tdsbconnects.User, tdsbconnects.TimetableItem, typing.Any]]:
+    """
+    Find the course to fill the form for today using fresh data from TDSB Connects.
+
+    Returns the user info, the TDSB course and the Course document, or None if there are no async courses today.
+    Also re-populates the user's courses.
+
+    warn_cb is an async callback used for reporting warnings.
+    Raises a LockboxTaskFailure on failure.
+    """
+    info, _, timetable = await _get_tdsb_user_info(db, user, password, warn_cb, log_prefix)
+    # We got all we need, now find the Course document to fill the form for
+    # If no school today just return and come back tomorrow
+    # This shouldn't happen
+    if not timetable:
+        logger.warning(f"{log_prefix}: No school or async courses for user {user.pk}")
+        return None
+    # We are assuming only one async course per day
+    tdsb_course = timetable[0]
+    if len(timetable) > 1:
+        missed_courses = ", ".join(f"{course.course_code} in period {course.course_period}" for course in timetable[1:])
+        logger.warning(f"User {user.pk} seems to have multiple async courses today. Missed courses: {missed_courses}")
+        await warn_cb(LockboxFailureType.BAD_USER_INFO, f"Warning: Multiple async courses detected for today, but only one form will be filled. Missed courses: {missed_courses}")
+    # Re-populate courses just in case
+    await db.populate_user_courses(user, timetable, clear_previous=False)
+    # Try to get the course from the database
+    db_course = await db.config_cache.get_course_by_code(tdsb_course.course_code)
+    if db_course is None:
+        logger.error(f"{log_prefix}: User {user.pk} populate courses failed for {tdsb_course.course_code}")
+        raise LockboxTaskFailure(LockboxFailureType.INTERNAL, f"Internal error: Failed to find course for {tdsb_course.course_code}", True)
+    return info, tdsb_course, db_course
+
+
+async def _fill_plan_inputs_hash(db: "db_.LockboxDB", user, course) -> str:
+    """
+    Hash everything other than TDSB Connects data that the field values of a fill plan are computed from.
+    """
+    form = await db.config_cache.get_form(course.form_config.pk)
+    inputs = [
+        course.form_url, course.has_attendance_form,
+        [[f.index_on_page, f.expected_label_segment, f.kind, f.target_value, f.critical] for f in form.sub_fields] if form is not None else None,
+        user.login, user.email, user.first_name, user.last_name, user.grade,
+    ]
+    return hashlib.sha256(json.dumps(inputs, default=str).encode("utf-8")).hexdigest()
+
+
+async def _load_fill_plan(db: "db_.LockboxDB", user) -> typing.Optional[typing.Tuple[typing.Any, list, typing.List[typing.Tuple[LockboxFailureType, str]]]]:
+    """
+    Load a user's fill plan for today, if there is one and it's still up to date.
+
+    Returns the Course document (None if there's nothing to fill), the fields in the format taken by
+    ghoster.fill_form(), and the warnings found while preparing the plan as (kind, message) pairs.
+    """
+    # Plans from before warnings had kinds (lists of strings) are ignored; the form is filled live instead
+    plan = await db.FillPlanImpl.find_one({"owner": user.pk, "warnings": {"$not": {"$type": "string"}}})
+    if plan is None or plan.date.date() != datetime.date.today():
+        return None
+    warnings = [(LockboxFailureType(warning["kind"]), warning["message"]) for warning in plan.warnings]
+    if plan.course is None:
+        return None, [], warnings
+    course = await db.config_cache.get_course(plan.course)
+    if course is None:
+        return None
+    # Nothing to work out; the fill form task deals with these
+    if not course.has_attendance_form or course.form_url is None or course.form_config is None:
+        return course, [], warnings
+    if await _fill_plan_inputs_hash(db, user, course) != plan.inputs_hash:
+        return None
+    fields = []
+    for component in plan.components:
+        kind = FormFieldType(component["kind"])
+        value = component["value"]
+        # Dates can only be stored as datetimes
+        if kind == FormFieldType.DATE and isinstance(value, datetime.datetime):
+            value = value.date()
+        fields.append((component["index"], component["title"], kind, value, component["critical"]))
+    return course, fields, warnings
+
+
+async def _prepare_fill_plan(db: "db_.LockboxDB", user) -> bool:
+    """
+    Prepare and store the fill plan for today for a user.
+
+    Returns whether it succeeded. Failures are only logged, since the fill form task can still do it live.
+    """
+    log_prefix = "Prefetch fill plans"
+    try:
+        password = db.fernet.decrypt(user.password).decode("utf-8")
+    except InvalidToken:
+        logger.critical(f"{log_prefix}: User {user.pk}'s password cannot be decrypted")
+        return False
+    warnings = []
+
+    async def collect_warning(kind: LockboxFailureType, message: str):
+        warnings.append({"kind": kind.value, "message": message})
+
+    plan = {
+        "owner": user.pk,
+        "date": datetime.datetime.combine(datetime.date.today(), datetime.time()),
+        "course": None,
+        "inputs_hash": None,
+        "components": [],
+        "warnings": warnings,
+        "time_created": datetime.datetime.utcnow(),
+    }
+    try:
+        found = await _get_todays_course(db, user, password, collect_warning, log_prefix)
+        if found is not None:
+            info, tdsb_course, db_course = found
+            plan["course"] = db_course.pk
+            # Leave the rest to the fill form task if the course isn't set up
+            if db_course.has_attendance_form and db_course.form_url is not None and db_course.form_config is not None:
+                fe_context = await _get_fieldexpr_context(db, user, db_course, info, tdsb_course, collect_warning, log_prefix)
+                plan["inputs_hash"] = await _fill_plan_inputs_hash(db, user, db_course)
+                for index, title, kind, value, critical in await _format_fields(db, db_course, fe_context, log_prefix):
+                    # Dates can only be stored as datetimes
+                    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+                        value = datetime.datetime.combine(value, datetime.time())
+                    plan["components"].append({"index": index, "title": title, "kind": kind.value, "value": value, "critical": critical})
+    except LockboxTaskFailure as e:
+        logger.warning(f"{log_prefix}: Failed for user {user.pk}: {e.message}")
+        return False
+    await db.FillPlanImpl.collection.replace_one({"owner": user.pk}, plan, upsert=True)
+    return True
+
+
+async def prefetch_fill_plans(db: "db_.LockboxDB", owner, retries: int, argument: str) -> typing.Optional[datetime.datetime]: # pylint: disable=unused-argument
+    """
+    Prepare the fill plans for today for every user whose form will be filled today.
+
+    Run by the check day task on school days, so that the fill form tasks don't have to talk to TDSB Connects
+    or work out the field values when they run.
+    """
+    if db.current_day is None or db.current_day <= 0:
+        logger.info("Prefetch fill plans: No school today")
+        return None
+    # Find users with fill form tasks that haven't run yet today
+    end = datetime.datetime.now(tz=LOCAL_TZ).replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+    owners = [task["owner"] async for task in db.TaskImpl.collection.find({"kind": TaskType.FILL_FORM.value,
+        "next_run_at": {"$lt": end.astimezone(datetime.timezone.utc)}}, projection={"owner": True})]
+    logger.info(f"Prefetch fill plans: Preparing plans for {len(owners)} users")
+    semaphore = asyncio.Semaphore(PREFETCH_FILL_PLANS_CONCURRENCY)
+
+    async def _prepare(owner_id) -> bool:
+        async with semaphore:
+            user = await db.UserImpl.find_one({"_id": owner_id})
+            if user is None or not user.active or user.login is None or user.password is None:
+                return False
+            # Don't pile on if TDSB Connects goes down partway
+            if db.tdsb_sessions.breaker.state == tdsb.CircuitBreaker.OPEN:
+                return False
+            try:
+                return await _prepare_fill_plan(db, user)
+            except Exception as e: # pylint: disable=broad-except
+                logger.error(f"Prefetch fill plans: Unexpected error for user {owner_id}: {type(e).__name__}: {e}\n{traceback.format_exc()}")
+                return False
+
+    results = await asyncio.gather(*(_prepare(owner_id) for owner_id in owners))
+    logger.info(f"Prefetch fill plans: Prepared {sum(results)}/{len(owners)} plans")
+    return None
+
+
 async def fill_form(db: "db_.LockboxDB", owner, retries: int, argument: str) -> typing.Optional[datetime.datetime]: # pylint: disable=unused-argument
     """
     Fills in the form for a particular user.
@@ -362,17 +670,11 @@ async def fill_form(db: "db_.LockboxDB", owner, retries: int, argument: str) ->
 
     async def report_failure(kind: LockboxFailureType, message: str):
         """
-        Report a lockbox failure by adding a document to the user's list of failures.
+        Report a lockbox failure by adding it to the user's errors.
 
-        This does commit the user document.
+        This does NOT commit the user document.
         """
-        failure = db.LockboxFailureImpl(_id=bson.ObjectId(), time_logged=datetime.datetime.utcnow(),
-                                        kind=kind.value, message=message)
-        # Make sure it's a new list instance
-        if not owner.errors:
-            owner.errors = []
-        owner.errors.append(failure)
-        await owner.commit()
+        await db.add_user_error(owner.pk, kind, message)
 
     async def set_last_result(result):
         """
@@ -395,9 +697,12 @@ async def fill_form(db: "db_.LockboxDB", owner, retries: int, argument: str) ->
                     logger.warning(f"Fill form: Failed to delete previous result conformation page screenshot for user {owner.pk}: No file")
         owner.last_fill_form_result = result
 
-    async def handle_error(kind: LockboxFailureType, message: str, retry: bool = False, course=None) -> datetime.datetime:
+    async def handle_error(kind: LockboxFailureType, message: str, retry: bool = False, course=None,
+                           form: bson.ObjectId = None) -> datetime.datetime:
         """
         Does error handling and handles either retrying or giving up and rescheduling.
+
+        course and form are the ids of the course and form config the failure was for, if known (for the fill history).
         """
         await set_last_result(db.FillFormResultImpl(result=FillFormResultType.FAILURE.value,
             time_logged=datetime.datetime.utcnow()))
@@ -407,6 +712,8 @@ async def fill_form(db: "db_.LockboxDB", owner, retries: int, argument: str) ->
             course = course.pk
         if course is not None:
             owner.last_fill_form_result.course = course
+        await owner.commit()
+        await db.add_fill_history(owner.pk, owner.last_fill_form_result, form)
         # Report the failure
         if not retry:
             await report_failure(kind, message + "; Will not retry.")
@@ -431,90 +738,81 @@ async def fill_form(db: "db_.LockboxDB", owner, retries: int, argument: str) ->
             logger.critical(f"Fill form: User {owner.pk}'s password cannot be decrypted")
             return await handle_error(LockboxFailureType.INTERNAL, "Internal error: Failed to decrypt password")
 
-        # Try and get data from TDSB Connects
-        try:
-            info, _, timetable = await _get_tdsb_user_info(db, owner, password, report_failure, "Fill form")
-            # We got all we need, now find the Course document to fill the form for and populate fieldexpr_context
-            # If no school today just return and come back tomorrow
-            # This shouldn't happen
-            if not timetable:
-                logger.warning(f"Fill form: No school or async courses for user {owner.pk}")
-                return next_run_time(FILL_FORM_RUN_TIME)
-            # We are assuming only one async course per day
-            tdsb_course = timetable[0]
-            if len(timetable) > 1:
-                missed_courses = ", ".join(f"{course.course_code} in period {course.course_period}" for course in timetable[1:])
-                logger.warning(f"User {owner.pk} seems to have multiple async courses today. Missed courses: {missed_courses}")
-                await report_failure(LockboxFailureType.BAD_USER_INFO, f"Warning: Multiple async courses detected for today, but only one form will be filled. Missed courses: {missed_courses}")
-            # Re-populate courses just in case
-            await db.populate_user_courses(owner, timetable, clear_previous=False)
-            # Try to get the course from the database
-            db_course = await db.CourseImpl.find_one({"course_code": tdsb_course.course_code})
+        # Use the fill plan prepared ahead of time if there is one
+        fields = None
+        plan = await _load_fill_plan(db, owner)
+        if plan is not None:
+            db_course, fields, plan_warnings = plan
+            logger.info(f"Fill form: Using fill plan for user {owner.pk}")
+            for kind, message in plan_warnings:
+                await report_failure(kind, message)
             if db_course is None:
-                logger.error(f"Fill form: User {owner.pk} populate courses failed for {tdsb_course.course_code}")
-                return await handle_error(LockboxFailureType.INTERNAL, f"Internal error: Failed to find course for {tdsb_course.course_code}", True)
-        # If that fails...
-        except LockboxTaskFailure as e:
-            if e.failure_type != LockboxFailureType.TDSB_CONNECTS:
-                logger.error(f"Fill form: User {owner.pk} error {e.failure_type}: {e.message}")
-                return await handle_error(e.failure_type, e.message, e.retry)
-            else:
-                info, tdsb_course = None, None
-                # If TDSB Connects failed, use data stored in the db instead
-                logger.warning(f"Fill form: TDSB Connects failed for user {owner.pk}: {e}")
-                await report_failure(LockboxFailureType.TDSB_CONNECTS, f"Warning: TDSB Connects failed with error '{e}'. Falling back to stored data.")
-                if db.current_day is None:
-                    logger.error("Fill form: Cannot fall back to stored data, don't know what day it is")
-                    return await handle_error(LockboxFailureType.TDSB_CONNECTS, f"Error: TDSB Connects error: '{e}'. Cannot fall back to stored data (don't know what day it is).", True)
-                # Should never happen
-                if db.current_day <= 0:
-                    logger.warning("Fill form: Stored data indicates no school today. This shouldn't happen.")
-                    return next_run_time(FILL_FORM_RUN_TIME)
-                if not owner.courses:
-                    logger.info(f"Fill form: No courses configured for user {owner.pk}")
+                logger.info(f"Fill form: No school or async courses for user {owner.pk}")
+                return next_run_time(FILL_FORM_RUN_TIME)
+        else:
+            # Try and get data from TDSB Connects
+            try:
+                found = await _get_todays_course(db, owner, password, report_failure, "Fill form")
+                if found is None:
                     return next_run_time(FILL_FORM_RUN_TIME)
-                # Find the course that runs today
-                db_course = None
-                for course_id in owner.courses:
-                    # Iterate through all courses the user has
-                    course = await db.CourseImpl.find_one({"_id": course_id})
-                    if course is None:
-                        logger.error(f"Fill form: Broken course reference detected: Course {course_id} for user {owner.pk}.")
-                        continue
-                    # Check if the course runs this period
-                    # This always assumes first period in the morning, should be fine
-                    if f"{db.current_day}-1a" in course.known_slots:
-                        db_course = course
-                        break
+                info, tdsb_course, db_course = found
+            # If that fails...
+            except LockboxTaskFailure as e:
+                if e.failure_type != LockboxFailureType.TDSB_CONNECTS:
+                    logger.error(f"Fill form: User {owner.pk} error {e.failure_type}: {e.message}")
+                    return await handle_error(e.failure_type, e.message, e.retry)
                 else:
-                    logger.info(f"Fill form: No school or async courses for user {owner.pk}")
-                    return next_run_time(FILL_FORM_RUN_TIME)
+                    info, tdsb_course = None, None
+                    # If TDSB Connects failed, use data stored in the db instead
+                    logger.warning(f"Fill form: TDSB Connects failed for user {owner.pk}: {e}")
+                    await report_failure(LockboxFailureType.TDSB_CONNECTS, f"Warning: TDSB Connects failed with error '{e}'. Falling back to stored data.")
+                    if db.current_day is None:
+                        logger.error("Fill form: Cannot fall back to stored data, don't know what day it is")
+                        return await handle_error(LockboxFailureType.TDSB_CONNECTS, f"Error: TDSB Connects error: '{e}'. Cannot fall back to stored data (don't know what day it is).", True)
+                    # Should never happen
+                    if db.current_day <= 0:
+                        logger.warning("Fill form: Stored data indicates no school today. This shouldn't happen.")
+                        return next_run_time(FILL_FORM_RUN_TIME)
+                    if not owner.courses:
+                        logger.info(f"Fill form: No courses configured for user {owner.pk}")
+                        return next_run_time(FILL_FORM_RUN_TIME)
+                    # Find the course that runs today
+                    # This always assumes first period in the morning, should be fine
+                    db_course = await db.find_course_in_slot(owner, f"{db.current_day}-1a")
+                    if db_course is None:
+                        logger.info(f"Fill form: No school or async courses for user {owner.pk}")
+                        return next_run_time(FILL_FORM_RUN_TIME)
 
-        try:
-            # Get fieldexpr context
-            fe_context = await _get_fieldexpr_context(db, owner, db_course, info, tdsb_course, report_failure, "Fill form")
-        except LockboxTaskFailure as e:
-            logger.error(f"Fill form: User {owner.pk} error {e.failure_type}: {e.message}")
-            return await handle_error(e.failure_type, e.message, e.retry, course=db_course)
+            try:
+                # Get fieldexpr context
+                fe_context = await _get_fieldexpr_context(db, owner, db_course, info, tdsb_course, report_failure, "Fill form")
+            except LockboxTaskFailure as e:
+                logger.error(f"Fill form: User {owner.pk} error {e.failure_type}: {e.message}")
+                return await handle_error(e.failure_type, e.message, e.retry, course=db_course.pk,
+                                          form=_form_config_id(db_course))
 
-        # All the code above sets db_course, the Course document to fill the form for, and fieldexpr_context
+        # All the code above sets db_course, the Course document to fill the form for,
+        # and either fieldexpr_context or the fields from the fill plan
         # Check that the form exists & is set up
         if not db_course.has_attendance_form:
             logger.info(f"Fill form: No form for course {db_course.course_code}")
             return next_run_time(FILL_FORM_RUN_TIME)
         if db_course.form_url is None or db_course.form_config is None:
             logger.warning(f"Fill form: Course missing form config: {db_course.course_code}")
-            return await handle_error(LockboxFailureType.CONFIG, f"Course missing form config: {db_course.course_code}")
+            return await handle_error(LockboxFailureType.CONFIG, f"Course missing form config: {db_course.course_code}",
+                                      course=db_course.pk, form=_form_config_id(db_course))
 
         # Start filling the form
         try:
-            result = await _do_fill_form(db, owner, db_course, password, fe_context, not FILL_FORM_SUBMIT_ENABLED, False, report_failure, "Fill form")
+            result = await _do_fill_form(db, owner, db_course, password, None if fields is not None else fe_context,
+                                         not FILL_FORM_SUBMIT_ENABLED, False, report_failure, "Fill form", fields)
         except LockboxTaskFailure as e:
             logger.error(f"Fill form: Filling failed for user {owner.pk} error {e.failure_type}: {e.message}")
-            return await handle_error(e.failure_type, e.message, e.retry)
+            return await handle_error(e.failure_type, e.message, e.retry, course=db_course.pk, form=db_course.form_config.pk)
         # Set the result and finish
         await set_last_result(result)
         await owner.commit()
+        await db.add_fill_history(owner.pk, result, db_course.form_config.pk)
         logger.info(f"Fill form: Finished for user {owner.pk}")
         return next_run_time(FILL_FORM_RUN_TIME)
     except scheduler.TaskError:
@@ -524,11 +822,16 @@ async def fill_form(db: "db_.LockboxDB", owner, retries: int, argument: str) ->
         logger.critical(f"Fill form: Unexpected exception: {type(e).__name__}: {e}\n{traceback.format_exc()}")
         message = f"Critical internal error: {type(e).__name__}: '{e}'; Please contact an admin"
         db_course = locals().get("db_course")
-        return await handle_error(LockboxFailureType.INTERNAL, message, True, course=db_course.pk if db_course is not None else None)
+        if db_course is None:
+            return await handle_error(LockboxFailureType.INTERNAL, message, True)
+        return await handle_error(LockboxFailureType.INTERNAL, message, True, course=db_course.pk, form=_form_config_id(db_course))
 
 async def populate_courses(db: "db_.LockboxDB", owner, retries: int, argument: str) -> typing.Optional[datetime.datetime]: # pylint: disable=unused-argument
     """
     Get courses from TDSB connects for a user and populate the DB.
+
+    If argument is POPULATE_COURSES_IF_CHANGED, the user's courses are left alone (and not marked as pending)
+    if their timetable's fingerprint is the same as last time.
     """
     if owner.login is None or owner.password is None:
         raise scheduler.TaskError("User credentials are incomplete")
@@ -537,18 +840,142 @@ async def populate_courses(db: "db_.LockboxDB", owner, retries: int, argument: s
     except InvalidToken as e:
         logger.critical(f"User {owner.pk}'s password cannot be decrypted")
         raise scheduler.TaskError("Cannot decrypt user password") from e
+    # Don't bother while TDSB Connects is down; come back once it might be up again
+    # (this doesn't count as a retry, and is spread out so that all the deferred tasks don't run at once)
+    if db.tdsb_sessions.breaker.state == tdsb.CircuitBreaker.OPEN:
+        logger.info(f"Populate courses: TDSB Connects is down, deferring for user {owner.pk}")
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=db.tdsb_sessions.breaker.retry_after() + random.uniform(0, 60))
     # Force owner courses into pending
     # NOTE: This action used to be required *before* the task is run, so that in the event of a failure,
     # if the user tried to update before the retry attempt, the retry won't need to do any extra work
     # However to facilitate refreshing all users' courses (for quad changes) this was removed
-    owner.courses = None
-    await owner.commit()
+    # (unless only refreshing if changed, to avoid writes when nothing changed)
+    if_changed = argument == POPULATE_COURSES_IF_CHANGED
+    if not if_changed:
+        owner.courses = None
+        await owner.commit()
     try:
-        courses = await tdsb.get_async_periods(username=owner.login, password=password, include_all_slots=True)
+        await _refresh_courses(db, owner, password, if_changed)
+    except tdsb.CircuitOpenError:
+        # Another task is checking whether it's back up
+        logger.info(f"Populate courses: TDSB Connects is down, deferring for user {owner.pk}")
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=db.tdsb_sessions.breaker.retry_after() + random.uniform(0, 60))
     except aiohttp.ClientError as e:
         # TODO: Improve this error handling
         raise scheduler.TaskError(f"TDSB Connects error: {e}", retry_in=600 if retries < 12 else None)
+
+
+async def _refresh_courses(db: "db_.LockboxDB", owner, password: str, if_changed: bool) -> bool:
+    """
+    Get a user's timetable from TDSB Connects and rebuild their courses from it.
+
+    If if_changed is true, nothing is written if the timetable is the same as last time.
+    Returns whether the courses were rebuilt. TDSB Connects errors are raised as aiohttp.ClientErrors.
+    """
+    calendars = await db.get_school_calendars()
+    courses = await db.tdsb_sessions.run(owner.login, password,
+        lambda session: tdsb.get_async_periods(session, logged_in=True, include_all_slots=True, calendars=calendars))
+    fingerprint = tdsb.timetable_fingerprint(courses)
+    if if_changed and owner.courses is not None and owner.timetable_hash == fingerprint:
+        logger.info(f"Populate courses: Timetable unchanged for user {owner.pk}")
+        return False
+    owner.timetable_hash = fingerprint
     await db.populate_user_courses(owner, courses, clear_previous=True)
+    return True
+
+
+async def _refresh_courses_timed(db: "db_.LockboxDB", user, semaphore: asyncio.Semaphore) -> typing.Tuple[str, float]:
+    """
+    Refresh one user's courses for the update all courses task, if their timetable changed.
+
+    The refresh waits for the semaphore, and the time spent waiting isn't counted, so that only TDSB Connects'
+    response times are measured.
+    Returns the outcome ("changed", "unchanged", "failed" or "outage" if TDSB Connects is having problems)
+    and how long it took in seconds.
+    """
+    try:
+        password = db.fernet.decrypt(user.password).decode("utf-8")
+    except InvalidToken:
+        logger.critical(f"User {user.pk}'s password cannot be decrypted")
+        return "failed", 0.0
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            changed = await _refresh_courses(db, user, password, if_changed=True)
+            outcome = "changed" if changed else "unchanged"
+        except Exception as e: # pylint: disable=broad-except
+            if tdsb.is_outage(e):
+                logger.warning(f"Update all courses: TDSB Connects error for user {user.pk}: {type(e).__name__}: {e}")
+                outcome = "outage"
+            elif isinstance(e, aiohttp.ClientError):
+                logger.warning(f"Update all courses: Failed for user {user.pk}: {type(e).__name__}: {e}")
+                outcome = "failed"
+            else:
+                logger.error(f"Update all courses: Unexpected error for user {user.pk}: {type(e).__name__}: {e}\n{traceback.format_exc()}")
+                outcome = "failed"
+        return outcome, time.perf_counter() - start
+
+
+async def update_all_courses(db: "db_.LockboxDB", owner, retries: int, argument: str) -> typing.Optional[datetime.datetime]: # pylint: disable=unused-argument
+    """
+    Refresh the courses of all users (whose timetables changed) in batches, using the progress stored in the
+    CourseRefresh document.
+
+    Each run refreshes one batch and reschedules itself for UPDATE_COURSES_INTERVAL after the batch started.
+    The batch size is adjusted like TCP congestion control (AIMD): it grows by 1 after each batch that went well,
+    and is halved after a batch where TDSB Connects errored or took longer than UPDATE_COURSES_TARGET_LATENCY
+    per user on average, so that the refresh goes as fast as TDSB Connects allows without overloading it.
+
+    Users that couldn't be refreshed get their own populate courses task so they're retried separately.
+    """
+    refresh = await db.CourseRefreshImpl.find_one()
+    if refresh is None or refresh.time_finished is not None:
+        return None
+    now = datetime.datetime.utcnow()
+    breaker = db.tdsb_sessions.breaker
+    if breaker.state == tdsb.CircuitBreaker.OPEN:
+        refresh.batch_size = max(refresh.batch_size / 2, 1.0)
+        await refresh.commit()
+        logger.info(f"Update all courses: TDSB Connects is down, pausing for {breaker.retry_after():.0f}s")
+        return now + datetime.timedelta(seconds=breaker.retry_after() + 1)
+
+    query = {"login": {"$ne": None}, "password": {"$ne": None}}
+    if refresh.last_user is not None:
+        query["_id"] = {"$gt": refresh.last_user}
+    users = [user async for user in db.UserImpl.find(query, sort=[("_id", 1)], limit=int(refresh.batch_size))]
+    if not users:
+        refresh.time_finished = now
+        await refresh.commit()
+        logger.info(f"Update all courses: Finished; {refresh.changed} changed, {refresh.failed} failed, "
+                    f"{refresh.done} total in {(now - refresh.time_started).total_seconds():.0f}s")
+        return None
+
+    # The task's own slot covers one user; take free slots of the group for the others
+    with db.tdsb_task_slots(TaskType.UPDATE_ALL_COURSES, min(UPDATE_COURSES_CONCURRENCY, len(users)) - 1) as extra:
+        semaphore = asyncio.Semaphore(extra + 1)
+        results = await asyncio.gather(*(_refresh_courses_timed(db, user, semaphore) for user in users))
+    for user, (outcome, _) in zip(users, results):
+        if outcome in ("failed", "outage"):
+            await db.schedule_populate_courses(user, argument=POPULATE_COURSES_IF_CHANGED,
+                run_at=now + datetime.timedelta(seconds=600))
+    outcomes = [outcome for outcome, _ in results]
+    latency = sum(duration for _, duration in results) / len(results)
+
+    # Multiplicative decrease if TDSB Connects is struggling, additive increase otherwise
+    if "outage" in outcomes or latency > UPDATE_COURSES_TARGET_LATENCY:
+        refresh.batch_size = max(refresh.batch_size / 2, 1.0)
+    else:
+        refresh.batch_size = min(refresh.batch_size + 1, float(UPDATE_COURSES_MAX_BATCH_SIZE))
+    refresh.last_user = users[-1].pk
+    failed = outcomes.count("failed") + outcomes.count("outage")
+    refresh.done += len(users) - failed
+    refresh.changed += outcomes.count("changed")
+    refresh.failed += failed
+    refresh.latency = latency if refresh.latency is None else 0.7 * refresh.latency + 0.3 * latency
+    await refresh.commit()
+    logger.info(f"Update all courses: {refresh.done}/{refresh.total} users done, {refresh.failed} failed, average {latency:.1f}s per user, "
+                f"next batch size {int(refresh.batch_size)}")
+    return max(now + datetime.timedelta(seconds=UPDATE_COURSES_INTERVAL), datetime.datetime.utcnow())
 
 
 async def _test_fill_form_inner(db: "db_.LockboxDB", owner, context) -> bool:
@@ -588,7 +1015,9 @@ async def _test_fill_form_inner(db: "db_.LockboxDB", owner, context) -> bool:
         context.fill_result = result
         await context.commit()
 
-    db_course = await db.CourseImpl.find_one({"_id": context.course_config})
+    # The config being tested was probably just saved, so don't use what was cached before
+    await db.config_cache.refresh()
+    db_course = await db.config_cache.get_course(context.course_config)
     if db_course is None:
         logger.error("Test fill form: Context has invalid course")
         message = "Internal error: Failed to find course by id in test setup."
@@ -682,7 +1111,8 @@ async def remove_old_test_result(db: "db_.LockboxDB", owner, retries: int, argum
     """
     Remove an old result
 
-    TODO: use a partial or something to reuse this code for other 'delete' tasks
+    No longer scheduled, since test results expire through a TTL index (see LockboxDB.start_form_test()).
+    Only runs for tasks created before that.
     """
 
     # try to find a context
@@ -735,6 +1165,13 @@ async def get_form_geometry(db: "db_.LockboxDB", owner, retries: int, argument:
         return screenshot_data
 
     logger.info(f"Get form geometry: Getting form geometry for {geom.url}")
+    # Fingerprint the form so the cached result can be revalidated later without a browser
+    try:
+        geom.fingerprint = await formdef.get_form_fingerprint(geom.url, db.http.session)
+    except aiohttp.ClientError as e:
+        logger.warning(f"Get form geometry: Failed to fingerprint form {geom.url}: {e}")
+        geom.fingerprint = None
+    geom.time_fetched = geom.time_validated = datetime.datetime.utcnow()
     try:
         screenshot_data = await asyncio.get_event_loop().run_in_executor(None, _inner)
         if geom.grab_screenshot:
@@ -745,6 +1182,9 @@ async def get_form_geometry(db: "db_.LockboxDB", owner, retries: int, argument:
             else:
                 geom.screenshot_file_id = await db._shared_gridfs.upload_from_stream("form-thumb.png", screenshot_data)
                 logger.info(f"Get form geometry: Success for url {geom.url}")
+        # Keep successful results as a cache instead of letting them expire
+        if geom.response_status is None:
+            geom.expires_at = None
         await geom.commit()
         return None
     except ghoster.GhosterAuthFailed as e:
@@ -757,15 +1197,29 @@ async def get_form_geometry(db: "db_.LockboxDB", owner, retries: int, argument:
     await geom.commit()
 
 
+async def revalidate_form_geometry(db: "db_.LockboxDB", owner, retries: int, argument: str): # pylint: disable=unused-argument
+    """
+    Revalidates the cached form geometry passed in as an argument, see LockboxDB.revalidate_form_geometry().
+    """
+    await db.revalidate_form_geometry(bson.ObjectId(argument))
+    return None
+
+
 async def remove_old_form_geometry(db: "db_.LockboxDB", owner, retries: int, argument: str): # pylint: disable=unused-argument
     """
-    Deletes the form geometry passed in as an argument.
+    Deletes the form geometry passed in as an argument if it failed or never finished.
+
+    Successful results are kept as a persistent cache, see LockboxDB.get_form_geometry().
+    No longer scheduled, since pending and failed results expire through a TTL index. Only runs for tasks created before that.
     """
     geom = await db.CachedFormGeometryImpl.find_one({"_id": bson.ObjectId(argument)})
     if not geom:
-        logger.error(f"Clean form geometry: Cannot find document {argument}")
+        logger.info(f"Clean form geometry: Document {argument} already removed")
         return None
     url = geom.url
+    if geom.geometry is not None and geom.response_status is None:
+        logger.info(f"Clean form geometry: Keeping cached form geometry for url {url}")
+        return None
     try:
         await geom.remove()
         logger.info(f"Form geometry deleted for url {url}")
@@ -773,6 +1227,103 @@ async def remove_old_form_geometry(db: "db_.LockboxDB", owner, retries: int, arg
         logger.error(f"Clean form geometry: Delete error for url {url}: {e}")
 
 
+async def _referenced_screenshots(db: "db_.LockboxDB") -> typing.AsyncIterator[bson.ObjectId]:
+    """
+    Stream the ids of every GridFS file that a document refers to, for the sweep screenshots task.
+    """
+    results = (
+        (db.UserImpl, "last_fill_form_result"),
+        (db.FormFillingTestImpl, "fill_result"),
+    )
+    for impl, field in results:
+        async for doc in impl.collection.find({field: {"$ne": None}}, {f"{field}.form_screenshot_id": 1, f"{field}.confirmation_screenshot_id": 1}):
+            yield doc[field].get("form_screenshot_id")
+            yield doc[field].get("confirmation_screenshot_id")
+    async for form in db.FormImpl.collection.find({"representative_thumbnail": {"$ne": None}}, {"representative_thumbnail": 1}):
+        yield form["representative_thumbnail"]
+    async for geom in db.CachedFormGeometryImpl.collection.find({"screenshot_file_id": {"$ne": None}}, {"screenshot_file_id": 1}):
+        yield geom["screenshot_file_id"]
+
+
+async def _delete_gridfs_files(db: "db_.LockboxDB", file_ids: typing.List[bson.ObjectId]) -> None:
+    """
+    Delete a batch of GridFS files at once, like AsyncIOMotorGridFSBucket.delete() does for one.
+    """
+    await db.shared_db()["fs.files"].delete_many({"_id": {"$in": file_ids}})
+    await db.shared_db()["fs.chunks"].delete_many({"files_id": {"$in": file_ids}})
+
+
+async def _delete_orphaned_chunks(db: "db_.LockboxDB", file_ids: typing.List[bson.ObjectId]) -> int:
+    """
+    Delete the chunks of the files in a batch that don't exist. Returns the number of chunks deleted.
+    """
+    existing = {f["_id"] async for f in db.shared_db()["fs.files"].find({"_id": {"$in": file_ids}}, {"_id": 1})}
+    orphaned = [file_id for file_id in file_ids if file_id not in existing]
+    if not orphaned:
+        return 0
+    return (await db.shared_db()["fs.chunks"].delete_many({"files_id": {"$in": orphaned}})).deleted_count
+
+
+async def sweep_screenshots(db: "db_.LockboxDB", owner, retries: int, argument: str): # pylint: disable=unused-argument
+    """
+    Delete the GridFS files (screenshots) that no document refers to.
+
+    Screenshots are normally deleted along with the result referring to them, but they're leaked if lockbox
+    crashes between uploading one and storing it, and test results and form geometry expire through TTL indexes,
+    which can't delete their screenshots.
+
+    This marks every file referred to (see _referenced_screenshots()), then sweeps the files and leftover chunks older
+    than SCREENSHOT_SWEEP_GRACE that weren't marked, in batches. Younger files are skipped, since they may have been
+    uploaded but not stored in their document yet. Progress is stored in the ScreenshotSweep document.
+    """
+    start = datetime.datetime.utcnow()
+    cutoff = start - datetime.timedelta(seconds=SCREENSHOT_SWEEP_GRACE)
+    await db.ScreenshotSweepImpl.collection.delete_many({})
+    sweep = db.ScreenshotSweepImpl(time_started=start)
+    await sweep.commit()
+
+    referenced = set()
+    async for file_id in _referenced_screenshots(db):
+        if file_id is not None:
+            referenced.add(file_id)
+    sweep.referenced = len(referenced)
+    await sweep.commit()
+
+    async def _sweep(batch: typing.List[bson.ObjectId], scanned: int, size: int):
+        if batch:
+            await _delete_gridfs_files(db, batch)
+        sweep.scanned += scanned
+        sweep.deleted += len(batch)
+        sweep.bytes_freed += size
+        await sweep.commit()
+
+    batch = []
+    scanned = size = 0
+    async for f in db.shared_db()["fs.files"].find({"uploadDate": {"$lt": cutoff}}, {"_id": 1, "length": 1}).sort("_id", 1):
+        scanned += 1
+        if f["_id"] not in referenced:
+            batch.append(f["_id"])
+            size += f.get("length", 0)
+        if scanned == SCREENSHOT_SWEEP_BATCH_SIZE:
+            await _sweep(batch, scanned, size)
+            batch = []
+            scanned = size = 0
+    await _sweep(batch, scanned, size)
+
+    # Chunks without a file are left behind by uploads that never finished (the file is written after the chunks)
+    # File ids are made when the upload starts, so they show how old the chunks are
+    # This only reads the files_id index, not the chunks
+    chunk_file_ids = await db.shared_db()["fs.chunks"].distinct("files_id", {"files_id": {"$lt": bson.ObjectId.from_datetime(cutoff)}})
+    for i in range(0, len(chunk_file_ids), SCREENSHOT_SWEEP_BATCH_SIZE):
+        sweep.orphaned_chunks += await _delete_orphaned_chunks(db, chunk_file_ids[i:i + SCREENSHOT_SWEEP_BATCH_SIZE])
+
+    sweep.time_finished = datetime.datetime.utcnow()
+    await sweep.commit()
+    logger.info(f"Sweep screenshots: Deleted {sweep.deleted} of {sweep.scanned} files ({sweep.bytes_freed} bytes) "
+                f"and {sweep.orphaned_chunks} orphaned chunks, {sweep.referenced} files referenced")
+    return start + datetime.timedelta(seconds=SCREENSHOT_SWEEP_INTERVAL)
+
+
 def set_task_handlers(sched: "scheduler.Scheduler"):
     """
     Set the task handlers entries for the scheduler.
@@ -784,3 +1335,7 @@ def set_task_handlers(sched: "scheduler.Scheduler"):
     sched.TASK_FUNCS[TaskType.REMOVE_OLD_TEST_RESULTS] = remove_old_test_result
     sched.TASK_FUNCS[TaskType.GET_FORM_GEOMETRY] = get_form_geometry
     sched.TASK_FUNCS[TaskType.REMOVE_OLD_FORM_GEOMETRY] = remove_old_form_geometry
+    sched.TASK_FUNCS[TaskType.PREFETCH_FILL_PLANS] = prefetch_fill_plans
+    sched.TASK_FUNCS[TaskType.UPDATE_ALL_COURSES] = update_all_courses
+    sched.TASK_FUNCS[TaskType.SWEEP_SCREENSHOTS] = sweep_screenshots
+    sched.TASK_FUNCS[TaskType.REVALIDATE_FORM_GEOMETRY] = revalidate_form_geometry
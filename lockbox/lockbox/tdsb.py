@@ -2,13 +2,437 @@
 Handles getting info from TDSB.
 """
 
+import aiohttp
+import asyncio
+import collections
 import datetime
+import hashlib
+import json
+import logging
+import os
 import tdsbconnects
+import time
 import typing
+from . import outbound
+
+
+logger = logging.getLogger("tdsb")
+
+
+# Number of days in the day cycle
+CYCLE_LENGTH = 4
+# Number of days to get the day cycle names of in one request
+CALENDAR_CHUNK = 14
+# Max number of days into the future to look for days in the cycle
+CALENDAR_HORIZON = 100
+
+# Max number of requests made at once with one session
+SESSION_CONCURRENCY = 4
+
+# Max number of tasks using TDSB Connects at once (the limit of the scheduler's tdsb_connects group)
+TASK_CONCURRENCY = 7
+
+# Max number of logged in sessions kept around
+SESSION_CACHE_SIZE = 100
+# Max number of connections open to TDSB Connects at once (shared between all sessions)
+# Defaults to enough for every task using TDSB Connects to make SESSION_CONCURRENCY requests at once
+CONNECTION_LIMIT = None # type: typing.Optional[int]
+
+# Timeout in seconds for each request to TDSB Connects
+REQUEST_TIMEOUT = 30.0
+
+# Circuit breaker: how far back to look (in seconds) when computing the error rate,
+# the min number of operations in that time before the breaker can open,
+# the error rate at which it opens, and how long (in seconds) it stays open before letting a trial operation through
+BREAKER_WINDOW = 60.0
+BREAKER_MIN_CALLS = 5
+BREAKER_ERROR_RATE = 0.5
+BREAKER_OPEN_TIME = 300.0
+
+if os.environ.get("LOCKBOX_TDSB_REQUEST_TIMEOUT"):
+    REQUEST_TIMEOUT = float(os.environ["LOCKBOX_TDSB_REQUEST_TIMEOUT"])
+if os.environ.get("LOCKBOX_TDSB_BREAKER_MIN_CALLS"):
+    BREAKER_MIN_CALLS = int(os.environ["LOCKBOX_TDSB_BREAKER_MIN_CALLS"])
+if os.environ.get("LOCKBOX_TDSB_BREAKER_ERROR_RATE"):
+    BREAKER_ERROR_RATE = float(os.environ["LOCKBOX_TDSB_BREAKER_ERROR_RATE"])
+if os.environ.get("LOCKBOX_TDSB_BREAKER_OPEN_TIME"):
+    BREAKER_OPEN_TIME = float(os.environ["LOCKBOX_TDSB_BREAKER_OPEN_TIME"])
+if os.environ.get("LOCKBOX_TDSB_SESSION_CONCURRENCY"):
+    SESSION_CONCURRENCY = int(os.environ["LOCKBOX_TDSB_SESSION_CONCURRENCY"])
+if os.environ.get("LOCKBOX_TDSB_SESSION_CACHE_SIZE"):
+    SESSION_CACHE_SIZE = int(os.environ["LOCKBOX_TDSB_SESSION_CACHE_SIZE"])
+if os.environ.get("LOCKBOX_TDSB_CONNECTION_LIMIT"):
+    CONNECTION_LIMIT = int(os.environ["LOCKBOX_TDSB_CONNECTION_LIMIT"])
+if CONNECTION_LIMIT is None:
+    CONNECTION_LIMIT = TASK_CONCURRENCY * SESSION_CONCURRENCY
+if os.environ.get("LOCKBOX_TDSB_API_URL"):
+    # Applies to every session, including ones not made here
+    tdsbconnects.TDSBConnects.API_URL = os.environ["LOCKBOX_TDSB_API_URL"].rstrip("/") + "/"
+
+
+class CircuitOpenError(aiohttp.ClientError):
+    """
+    Raised instead of contacting TDSB Connects while it's considered to be down.
+
+    This is a ClientError, so it's handled like any other TDSB Connects error.
+    """
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of TDSB Connects, so that an outage doesn't get piled on with requests that will fail anyway.
+
+    The breaker is closed (operations allowed) normally. Once at least BREAKER_MIN_CALLS operations were recorded in
+    the last BREAKER_WINDOW seconds and BREAKER_ERROR_RATE of them failed, it opens and operations are refused.
+    After BREAKER_OPEN_TIME seconds it's half-open, and a single trial operation is let through.
+    The breaker closes if the trial succeeds, and opens again if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self):
+        # (time, healthy) for each recorded operation
+        self._outcomes = collections.deque() # type: typing.Deque[typing.Tuple[float, bool]]
+        self._opened_at = None # type: typing.Optional[float]
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() < self._opened_at + BREAKER_OPEN_TIME:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def retry_after(self) -> float:
+        """
+        Get the number of seconds until the breaker lets a trial operation through (0 if not open).
+        """
+        if self._opened_at is None:
+            return 0
+        return max(self._opened_at + BREAKER_OPEN_TIME - time.monotonic(), 0)
+
+    def acquire(self, force: bool = False) -> typing.Optional[bool]:
+        """
+        Check whether an operation may go ahead. Its outcome must then be recorded with record().
+
+        Returns None if the operation is refused, True if it's the trial operation, and False otherwise.
+        If force is true, the operation is always allowed (its outcome still counts).
+        """
+        state = self.state
+        if state == self.HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False if force or state == self.CLOSED else None
+
+    def record(self, healthy: typing.Optional[bool], trial: bool):
+        """
+        Record the outcome of an allowed operation (trial is the value returned by acquire()).
+
+        healthy is None if the operation didn't finish (e.g. it was cancelled), which doesn't count either way.
+        """
+        if trial:
+            self._trial_running = False
+        if healthy is None:
+            return
+        now = time.monotonic()
+        if self._opened_at is not None:
+            # Any success (the trial or a forced operation) closes the breaker
+            if healthy:
+                logger.info("TDSB Connects is back up, closing circuit breaker")
+                self._opened_at = None
+                self._outcomes.clear()
+            elif self.state == self.HALF_OPEN:
+                logger.warning("TDSB Connects is still down, opening circuit breaker again")
+                self._opened_at = now
+            return
+        self._outcomes.append((now, healthy))
+        while self._outcomes and self._outcomes[0][0] < now - BREAKER_WINDOW:
+            self._outcomes.popleft()
+        failures = sum(1 for _, ok in self._outcomes if not ok)
+        if len(self._outcomes) >= BREAKER_MIN_CALLS and failures >= BREAKER_ERROR_RATE * len(self._outcomes):
+            logger.warning(f"TDSB Connects seems to be down ({failures}/{len(self._outcomes)} operations failed), "
+                           f"opening circuit breaker for {BREAKER_OPEN_TIME}s")
+            self._opened_at = now
+
+
+def is_outage(e: BaseException) -> bool:
+    """
+    Check whether an error from an operation means TDSB Connects is having problems
+    (as opposed to e.g. bad credentials).
+    """
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500 or e.status == 429
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class _PooledTDSBConnects(tdsbconnects.TDSBConnects):
+    """
+    A TDSBConnects session that uses the shared connection pool instead of its own connector.
+
+    Use create() to make one.
+    """
+
+    @classmethod
+    async def create(cls, pool: outbound.ConnectionPool) -> "_PooledTDSBConnects":
+        """
+        Create a session using a connection pool.
+        """
+        # Let the base constructor set everything up, then replace its ClientSession (which hasn't connected yet)
+        # with one using the pool
+        self = cls()
+        await self._session.close()
+        self._session = pool.new_session(raise_for_status=True, headers={
+            "X-Client-App-Info": self.X_CLIENT_APP_INFO,
+        }, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        return self
+
+    async def close(self) -> None:
+        # The base class waits for the connector to close, but the connector is shared
+        await self._session.close()
+
+    @property
+    def expired(self) -> bool:
+        """
+        Whether the access token has expired (or the session was never logged in).
+        """
+        return self._token_expiry is None or time.time() >= self._token_expiry
+
+
+class _LoginLock:
+    """
+    Held while logging in as a user, with the number of operations using or waiting for it.
+    """
+
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class _CachedSession:
+    """
+    An entry in the session cache.
+    """
+
+    __slots__ = ("session", "password_hash", "users", "evicted")
+
+    def __init__(self, session: _PooledTDSBConnects, password_hash: bytes):
+        self.session = session
+        self.password_hash = password_hash
+        # Number of operations currently using this session
+        self.users = 0
+        # Set when removed from the cache; the session is closed once it's no longer used
+        self.evicted = False
+
+
+class SessionCache:
+    """
+    Keeps logged in TDSB Connects sessions around so they can be reused between tasks.
+
+    Sessions are keyed by login, kept until their token expires, and evicted least recently used first
+    once there are more than max_size. All sessions use the given connection pool (which should have a per host
+    limit of CONNECTION_LIMIT); if none is given, the cache makes its own.
+
+    Use run() to do something with a user's session.
+    All operations go through a circuit breaker (see CircuitBreaker), available as the breaker attribute.
+    """
+
+    def __init__(self, pool: outbound.ConnectionPool = None, max_size: int = None):
+        self.max_size = max_size if max_size is not None else SESSION_CACHE_SIZE
+        self._own_pool = pool is None
+        self.pool = pool if pool is not None else outbound.ConnectionPool(limit_per_host=CONNECTION_LIMIT)
+        self._sessions = collections.OrderedDict() # type: typing.OrderedDict[str, _CachedSession]
+        # Held while logging in, so concurrent operations for a user only log in once
+        # Removed once nothing is using or waiting for them
+        self._login_locks = {} # type: typing.Dict[str, _LoginLock]
+        self.breaker = CircuitBreaker()
+
+    async def _release(self, entry: _CachedSession):
+        entry.users -= 1
+        if entry.evicted and entry.users == 0:
+            await entry.session.close()
+
+    async def _evict(self, login: str):
+        entry = self._sessions.pop(login, None)
+        if entry is not None:
+            entry.evicted = True
+            if entry.users == 0:
+                await entry.session.close()
+
+    async def _acquire(self, login: str, password: str) -> typing.Tuple[_CachedSession, bool]:
+        """
+        Get a logged in session for a user, logging in if needed.
+
+        Returns the cache entry (which must be released) and whether the session was freshly logged in.
+        """
+        password_hash = hashlib.sha256(password.encode("utf-8")).digest()
+        login_lock = self._login_locks.get(login)
+        if login_lock is None:
+            login_lock = self._login_locks[login] = _LoginLock()
+        login_lock.users += 1
+        try:
+            async with login_lock.lock:
+                entry = self._sessions.get(login)
+                if entry is not None and entry.password_hash == password_hash and not entry.session.expired:
+                    self._sessions.move_to_end(login)
+                    entry.users += 1
+                    return entry, False
+                await self._evict(login)
+                session = await _PooledTDSBConnects.create(self.pool)
+                try:
+                    await session.login(login, password)
+                except:
+                    await session.close()
+                    raise
+                entry = _CachedSession(session, password_hash)
+                entry.users += 1
+                self._sessions[login] = entry
+                # Evict the least recently used sessions
+                while len(self._sessions) > self.max_size:
+                    await self._evict(next(iter(self._sessions)))
+                return entry, True
+        finally:
+            login_lock.users -= 1
+            if login_lock.users == 0:
+                del self._login_locks[login]
+
+    async def run(self, login: str, password: str,
+                  func: typing.Callable[[tdsbconnects.TDSBConnects], typing.Awaitable[typing.Any]], force: bool = False) -> typing.Any:
+        """
+        Run an async function with a logged in session for a user, and return its result.
+
+        The session must not be closed or used after func returns.
+        If a reused session gets a 401, it is thrown away and func is retried once with a fresh login.
+        Errors from logging in (e.g. a 401 for bad credentials) are raised as-is, and timeouts are raised as
+        aiohttp.ServerTimeoutError.
+
+        Raises CircuitOpenError without doing anything if TDSB Connects is considered to be down, unless force is true.
+        """
+        trial = self.breaker.acquire(force)
+        if trial is None:
+            raise CircuitOpenError(f"TDSB Connects seems to be down; not contacting it for another {self.breaker.retry_after():.0f}s")
+        healthy = None
+        try:
+            result = await self._run(login, password, func)
+            healthy = True
+            return result
+        except asyncio.TimeoutError as e:
+            healthy = False
+            raise aiohttp.ServerTimeoutError(f"Timed out after {REQUEST_TIMEOUT}s") from e
+        except Exception as e:
+            healthy = not is_outage(e)
+            raise
+        finally:
+            self.breaker.record(healthy, trial)
+
+    async def _run(self, login: str, password: str,
+                   func: typing.Callable[[tdsbconnects.TDSBConnects], typing.Awaitable[typing.Any]]) -> typing.Any:
+        entry, fresh = await self._acquire(login, password)
+        try:
+            return await func(entry.session)
+        except aiohttp.ClientResponseError as e:
+            if e.status != 401 or fresh:
+                raise
+            logger.info(f"Cached TDSB Connects session for login {login} was rejected; logging in again")
+        finally:
+            await self._release(entry)
+        if self._sessions.get(login) is entry:
+            await self._evict(login)
+        entry, _ = await self._acquire(login, password)
+        try:
+            return await func(entry.session)
+        finally:
+            await self._release(entry)
+
+    async def invalidate(self, login: str):
+        """
+        Forget the session for a user, e.g. because their credentials changed.
+        """
+        await self._evict(login)
+
+    async def close(self):
+        """
+        Close all sessions, and the connection pool if it was made by the cache.
+        """
+        for login in list(self._sessions):
+            await self._evict(login)
+        if self._own_pool:
+            await self.pool.close()
+
+
+def timetable_fingerprint(items: typing.Iterable[tdsbconnects.TimetableItem]) -> str:
+    """
+    Get a fingerprint of a timetable, covering everything that's stored when populating courses.
+
+    Doesn't depend on the order of the items, or the dates they were fetched for.
+    """
+    slots = sorted({(item.course_code, item.course_teacher_name or "", str(item.course_cycle_day), item.course_period) for item in items})
+    return hashlib.sha256(json.dumps(slots).encode("utf-8")).hexdigest()
+
+
+def find_cycle_dates(start: datetime.date, days: typing.Sequence[str], after: datetime.date) -> typing.Dict[str, datetime.date]:
+    """
+    Find the first date on or after a date for each day in the cycle, from a day cycle calendar.
+
+    start is the date of the first entry in days, which are day cycle names (as returned by School.day_cycle_names()).
+    Returns a dict of day cycle name (e.g. "D1") to date. Days in the cycle not in the calendar are missing.
+    """
+    found = {}
+    for offset in range(max((after - start).days, 0), len(days)):
+        day = days[offset]
+        # School days have the format "D<N>" where N is the number
+        # Non-school days are just "D"
+        if len(day) >= 2 and day not in found:
+            found[day] = start + datetime.timedelta(days=offset)
+            if len(found) == CYCLE_LENGTH:
+                break
+    return found
+
+
+async def _limited(semaphore: typing.Optional[asyncio.Semaphore], awaitable: typing.Awaitable) -> typing.Any:
+    """
+    Await something while holding a semaphore (if there is one).
+    """
+    if semaphore is None:
+        return await awaitable
+    async with semaphore:
+        return await awaitable
+
+
+async def get_day_cycle_calendar(school: tdsbconnects.School, start: datetime.date,
+                                 semaphore: asyncio.Semaphore = None) -> typing.List[str]:
+    """
+    Get the day cycle names of a school for each day from start.
+
+    Goes until every day in the cycle has been seen, or up to CALENDAR_HORIZON days.
+    Since the calendar is the same for all students of a school, the result can be shared between them.
+
+    Requests for several ranges of days are made at once, as many as SESSION_CONCURRENCY at a time.
+    If a semaphore is given, it's held for each request.
+    """
+    days = []
+    chunks = [start + datetime.timedelta(days=i) for i in range(0, CALENDAR_HORIZON, CALENDAR_CHUNK)]
+    for i in range(0, len(chunks), SESSION_CONCURRENCY):
+        # Both ends are inclusive
+        results = await asyncio.gather(*(_limited(semaphore, school.day_cycle_names(chunk_start,
+            chunk_start + datetime.timedelta(days=CALENDAR_CHUNK - 1))) for chunk_start in chunks[i:i + SESSION_CONCURRENCY]))
+        for result in results:
+            days.extend(result[:CALENDAR_CHUNK])
+            # Past the end of the school year; any later days would be misaligned
+            if len(result) < CALENDAR_CHUNK:
+                return days
+        if len(find_cycle_dates(start, days, start)) == CYCLE_LENGTH:
+            break
+    return days
 
 
 async def get_async_periods(session: tdsbconnects.TDSBConnects = None, logged_in: bool = False,
-                            username: str = None, password: str = None, include_all_slots = False) -> typing.List[tdsbconnects.TimetableItem]:
+                            username: str = None, password: str = None, include_all_slots = False,
+                            calendars: typing.Dict[int, typing.Tuple[datetime.date, typing.List[str]]] = None) -> typing.List[tdsbconnects.TimetableItem]:
     """
     Get a list of asynchronous periods for this user, as pytdsbconnects TimetableItems.
 
@@ -21,6 +445,10 @@ async def get_async_periods(session: tdsbconnects.TDSBConnects = None, logged_in
     Note that if a session is provided, it will not be closed at the end of the operation.
 
     By default only grabs async periods; if include_all_slots is True, all periods will be retrieved.
+
+    calendars is an optional dict of school code to day cycle calendar, as (start date, day cycle names)
+    (see get_day_cycle_calendar()). If a school's calendar is missing or doesn't have every day in the cycle,
+    it's fetched from TDSB Connects instead.
     """
     provided = session is not None
     if not provided:
@@ -30,39 +458,36 @@ async def get_async_periods(session: tdsbconnects.TDSBConnects = None, logged_in
             await session.login(username, password)
         # Actually get the courses
         info = await session.get_user_info()
-        found = []
-        for school in info.schools:
+        # Everything below is fetched concurrently, but limit the number of requests at once
+        semaphore = asyncio.Semaphore(SESSION_CONCURRENCY)
+
+        async def _get_school_periods(school: tdsbconnects.School) -> typing.List[tdsbconnects.TimetableItem]:
             # Because we can only get this info through timetables for a specific date,
             # we must first find dates for each of the days in the cycle
             # so we can grab timetables for those dates later
-
-            # The number of days to grab at a time for checking
-            CHECK_RANGE = 14
-            CYCLE_LENGTH = 4
-            day_offsets = {}
-            today = datetime.datetime.today()
-            # Check up to 100 days into the future
-            for i in range(0, 100, CHECK_RANGE):
-                days = await school.day_cycle_names(today + datetime.timedelta(days=i), today + datetime.timedelta(days=i + CHECK_RANGE))
-                for offset, day in enumerate(days):
-                    # School days have the format "D<N>" where N is the number
-                    # Non-school days are just "D"
-                    if len(day) >= 2 and day not in day_offsets:
-                        day_offsets[day] = offset + i
-                        if len(day_offsets) == CYCLE_LENGTH:
-                            break
-                if len(day_offsets) == CYCLE_LENGTH:
-                    break
-            for offset in day_offsets.values():
-                timetable = await school.timetable(today + datetime.timedelta(days=offset))
+            # Use the shared calendar if possible, since it's the same for the entire school
+            today = datetime.date.today()
+            day_dates = {}
+            if calendars and school.code in calendars:
+                day_dates = find_cycle_dates(*calendars[school.code], today)
+            if len(day_dates) < CYCLE_LENGTH:
+                day_dates = find_cycle_dates(today, await get_day_cycle_calendar(school, today, semaphore), today)
+            timetables = await asyncio.gather(*(_limited(semaphore, school.timetable(date)) for date in day_dates.values()))
+            periods = []
+            for timetable in timetables:
                 if include_all_slots:
-                    found.extend(timetable)
+                    periods.extend(timetable)
                 else:
                     for item in timetable:
                         # Get only async periods
                         # Async periods have period strs ending in "a"
                         if item.course_period.endswith("a"):
-                            found.append(item)
+                            periods.append(item)
+            return periods
+
+        found = []
+        for periods in await asyncio.gather(*(_get_school_periods(school) for school in info.schools)):
+            found.extend(periods)
     finally:
         if not provided:
             await session.close()